@@ -2,6 +2,12 @@
 # simulator.py
 import argparse
 import asyncio
+import bisect
+import gzip
+import heapq
+import io
+import itertools
+import math
 import xml.etree.ElementTree as ET
 import json
 import random
@@ -11,10 +17,13 @@ import websockets
 import os
 import re
 import sys
+import time
 import uuid
 
 from datetime import datetime, timezone, timedelta
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Callable, Iterator, Tuple, Optional
+
+import iofreader
 
 # --- Navisport integration (optional) ---
 try:
@@ -38,13 +47,15 @@ class NavisportSender:
 
     CHECKPOINT_REFRESH_INTERVAL = 300  # seconds
 
-    def __init__(self, host: str, event_id: str, chip_base: int = 0, debug: bool = False):
+    def __init__(self, host: str, event_id: str, chip_base: int = 0, debug: bool = False,
+                 clock: Optional['WallClock'] = None):
         self.host = host
         self.event_id = event_id
+        self.clock = clock or WALL_CLOCK
         self._chip_base = chip_base
         self._conn: Optional[Any] = None
         self._cp_by_code: Dict[str, dict] = {}   # control code → checkpoint
-        self._start_times: Dict[str, str] = {}   # runner_id → ISO start timestamp
+        self._start_times: Dict[str, int] = {}   # runner_id → start time, epoch ms
         self._result_ids: Dict[str, str] = {}    # chip → result_id
         self._unknown_codes: set = set()          # codes warned about already
         self._purku_validated: set = set()        # chips whose purku was validated by Navisport (status=Finished)
@@ -54,6 +65,18 @@ class NavisportSender:
         self._loop: Optional[asyncio.AbstractEventLoop] = None
         self._refresh_task: Optional[asyncio.Task] = None
 
+    def to_state(self) -> dict:
+        """Per-runner caches a resumed run needs (see --checkpoint); JSON-serialisable."""
+        return {'start_times': dict(self._start_times),
+                'result_ids': dict(self._result_ids),
+                'purku_validated': sorted(self._purku_validated)}
+
+    def restore_state(self, state: dict):
+        """Take over the caches of a checkpointed run (before the first event)."""
+        self._start_times.update(state['start_times'])
+        self._result_ids.update(state['result_ids'])
+        self._purku_validated.update(state['purku_validated'])
+
     @staticmethod
     def _build_cp_map(cps: list) -> dict:
         """Build code→checkpoint dict; falls back to name when code is None."""
@@ -151,10 +174,10 @@ class NavisportSender:
             except Exception as e:
                 print(f"[navisport] checkpoint refresh failed: {e}")
 
-    def _resolve_chip(self, ev: Dict) -> str:
-        bib = int(ev.get('team_id', 0))
-        leg = ev.get('leg', 1) or 1
-        chip = ev.get('chip', '')
+    def _resolve_chip(self, ev: 'SimEvent') -> str:
+        bib = int(ev.team_id or 0)
+        leg = ev.leg or 1
+        chip = ev.chip
         if chip:
             return str(chip)
         return str(self._chip_base + max(bib, 0) * 1000 + leg)
@@ -163,7 +186,7 @@ class NavisportSender:
     # Helpers (sync, called from executor threads)
     # ------------------------------------------------------------------
 
-    def _find_result(self, ev: Dict, all_results: list) -> Optional[dict]:
+    def _find_result(self, ev: 'SimEvent', all_results: list) -> Optional[dict]:
         """Find an Individual result by chip, falling back to bib+leg lookup."""
         chip = self._resolve_chip(ev)
         result = next(
@@ -173,8 +196,8 @@ class NavisportSender:
         )
         if result:
             return result
-        bib = int(ev.get('team_id', 0))
-        leg = ev.get('leg', 1) or 1
+        bib = int(ev.team_id or 0)
+        leg = ev.leg or 1
         if bib <= 0:
             return None
         team = next(
@@ -200,14 +223,25 @@ class NavisportSender:
             return cp['id'], devices[0] if devices else None
         return None, None
 
-    def _compute_elapsed(self, runner_id: str, timestamp: str) -> Optional[int]:
+    def _now_iso(self) -> str:
+        # 'updated' stamp; on a virtual clock the simulated wall time
+        if self.clock.virtual:
+            return ms_to_navisport(self.clock.now_ms())
+        return _navi_now_iso()
+
+    def _compute_elapsed(self, runner_id: str, ts_ms: int) -> Optional[int]:
         start = self._start_times.get(str(runner_id))
-        if not start:
+        if start is None:
+            return None
+        return max(0, (ts_ms - start) // 1000)
+
+    @staticmethod
+    def _parse_start(value: Optional[str]) -> Optional[int]:
+        """Epoch ms of a Navisport/ISO startTime string, or None."""
+        if not value:
             return None
         try:
-            s = datetime.fromisoformat(start.replace('Z', '+00:00'))
-            t = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-            return max(0, int((t - s).total_seconds()))
+            return iso_to_ms(value)[0]
         except Exception:
             return None
 
@@ -272,12 +306,6 @@ class NavisportSender:
     def _strip_nulls(d: dict) -> dict:
         return {k: v for k, v in d.items() if v is not None}
 
-    @staticmethod
-    def _navisport_ts(ts: str) -> str:
-        """Normalise any ISO timestamp to Navisport's expected UTC format: 2026-07-01T15:21:35.031Z"""
-        dt = datetime.fromisoformat(ts.replace('Z', '+00:00')).astimezone(timezone.utc)
-        return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f"{dt.microsecond // 1000:03d}Z"
-
     def _send_result(self, result: dict, event_id: str, label: str = '') -> str:
         """Send a Result/Update, optionally gated by debug confirmation."""
         result = self._strip_nulls(result)
@@ -304,19 +332,21 @@ class NavisportSender:
                 return 'skipped'
         return self._conn.send_passing(passing)
 
-    def _sync_send_login(self, ev: Dict, timestamp: str):
+    def _sync_send_login(self, ev: 'SimEvent', sent_ms: int):
         """Register runner on Navisport (if not yet) and set status to Competing."""
         if not self._conn:
             return
+        tz_offset = ev.tz_offset
+        timestamp = ms_to_iso(sent_ms, tz_offset)
         event = self._conn.get_event(self.event_id)
         if not event:
             return
-        runner_id = str(ev.get('runner_id', ''))
-        bib = int(ev.get('team_id', 0))
-        leg = ev.get('leg', 1) or 1
+        runner_id = str(ev.runner_id or '')
+        bib = int(ev.team_id or 0)
+        leg = ev.leg or 1
         chip = self._resolve_chip(ev)
-        name = ev.get('runner_name', '') or ''
-        club = ev.get('club', '') or ''
+        name = ev.runner_name or ''
+        club = ev.club or ''
 
         all_results = event.get('results', [])
 
@@ -342,17 +372,21 @@ class NavisportSender:
                     None,
                 )
 
-        iof_start = ev.get('start_time')
+        iof_start_ms = ev.start_ms
+        iof_start = ms_to_iso(iof_start_ms, tz_offset) if iof_start_ms is not None else None
 
         if result:
-            self._start_times[runner_id] = result.get('startTime') or iof_start or timestamp
+            start_ms = self._parse_start(result.get('startTime'))
+            if start_ms is None:
+                start_ms = iof_start_ms if iof_start_ms is not None else sent_ms
+            self._start_times[runner_id] = start_ms
             self._result_ids[chip] = result['id']
             updated = {
                 **result,
                 'chip': chip,
                 'status': 'Competing',
                 'registerTime': timestamp,
-                'updated': _navi_now_iso(),
+                'updated': self._now_iso(),
             }
             if not result.get('startTime') and iof_start:
                 updated['startTime'] = iof_start
@@ -376,7 +410,7 @@ class NavisportSender:
                 if iof_start:
                     individual['startTime'] = iof_start
                     individual['startTimeSource'] = 'Timing device'
-                self._start_times[runner_id] = iof_start or timestamp
+                self._start_times[runner_id] = iof_start_ms if iof_start_ms is not None else sent_ms
                 self._result_ids[chip] = individual['id']
             for r in new_results:
                 self._send_result(r, self.event_id,
@@ -384,12 +418,12 @@ class NavisportSender:
                                   f"name={r.get('name','?')}  chip={chip}  bib={bib}  leg={leg}")
             print(f"[navisport] login: registered {len(new_results)} result(s) chip={chip} bib={bib} leg={leg}")
 
-    def _sync_send_punch(self, ev: Dict, timestamp: str):
+    def _sync_send_punch(self, ev: 'SimEvent', sent_ms: int):
         if not self._conn:
             return
-        runner_id = str(ev.get('runner_id', ''))
-        code = str(ev.get('device_id', ''))
-        device_type = ev.get('device_type', '')
+        runner_id = str(ev.runner_id or '')
+        code = str(ev.device_id or '')
+        device_type = ev.device_type or ''
         chip = self._resolve_chip(ev)
         cp_id, dev_id = self._checkpoint_for(code)
         cp_type = (self._cp_by_code.get(str(code)) or {}).get('type', '')
@@ -406,18 +440,15 @@ class NavisportSender:
             return
 
         # Elapsed from original IOF timestamps — the time-shift cancels out
-        orig_ts_str = ev.get('timestamp')
-        orig_start_str = ev.get('start_time') or self._start_times.get(runner_id)
+        orig_ts = ev.ts_ms
+        orig_start = ev.start_ms
+        if orig_start is None:
+            orig_start = self._start_times.get(runner_id)
         elapsed = None
-        if orig_ts_str and orig_start_str:
-            try:
-                s = datetime.fromisoformat(orig_start_str.replace('Z', '+00:00'))
-                t = datetime.fromisoformat(orig_ts_str.replace('Z', '+00:00'))
-                elapsed = max(0, int((t - s).total_seconds()))
-            except Exception:
-                pass
+        if orig_ts is not None and orig_start is not None:
+            elapsed = max(0, (orig_ts - orig_start) // 1000)
 
-        navi_ts = self._navisport_ts(timestamp)
+        navi_ts = ms_to_navisport(sent_ms)
         passing = {
             'id': str(uuid.uuid4()),
             'eventId': self.event_id,
@@ -436,10 +467,10 @@ class NavisportSender:
                            f"elapsed={elapsed}s  cp={'found' if cp_id else 'unknown'}")
 
         if is_finish:
-            self._sync_finish_result(chip, navi_ts, elapsed, orig_punch_ts=orig_ts_str)
+            self._sync_finish_result(chip, navi_ts, elapsed, orig_punch_ms=orig_ts)
 
     def _sync_finish_result(self, chip: str, timestamp: str, elapsed: Optional[int],
-                            orig_punch_ts: Optional[str] = None):
+                            orig_punch_ms: Optional[int] = None):
         """Send Result/Update with finishTime for the finishing runner."""
         event = self._conn.get_event(self.event_id)
         if not event:
@@ -460,19 +491,16 @@ class NavisportSender:
         if not result:
             return
         # Fallback: use original IOF punch time vs stored IOF start time (shift cancels out)
-        if elapsed is None and orig_punch_ts and result.get('startTime'):
-            try:
-                s = datetime.fromisoformat(result['startTime'].replace('Z', '+00:00'))
-                t = datetime.fromisoformat(orig_punch_ts.replace('Z', '+00:00'))
-                elapsed = max(0, int((t - s).total_seconds()))
-            except Exception:
-                pass
+        if elapsed is None and orig_punch_ms is not None:
+            start_ms = self._parse_start(result.get('startTime'))
+            if start_ms is not None:
+                elapsed = max(0, (orig_punch_ms - start_ms) // 1000)
         finish_result = {
             **result,
             'finishTime': timestamp,
             'finishTimeSource': 'Timing device',
             'status': 'Finished' if result.get('status') in ('Competing', 'Registered', 'Dns') else result.get('status'),
-            'updated': _navi_now_iso(),
+            'updated': self._now_iso(),
         }
         if elapsed is not None:
             finish_result['time'] = elapsed
@@ -484,42 +512,42 @@ class NavisportSender:
     # Async entry points called from schedule_and_send
     # ------------------------------------------------------------------
 
-    def _sync_send_purku(self, ev: Dict, punches: list, purku_ts: str):
-        """Send a full chip card read (all punches) to Navisport via Result/Update."""
+    def _sync_send_purku(self, ev: 'SimEvent', punches: list, purku_ms: int):
+        """
+        Send a full chip card read (all punches) to Navisport via Result/Update.
+
+        ``punches`` carry the original IOF ``time_ms``; like passings, control
+        times are elapsed seconds from the original start so the shift cancels.
+        """
         if not self._conn:
             return
         event_data = self._conn.get_event(self.event_id)
         if not event_data:
             print(f"[navisport] purku: event {self.event_id} not found")
             return
-        runner_id = str(ev.get('runner_id', ''))
+        runner_id = str(ev.runner_id or '')
         chip = self._resolve_chip(ev)
         result = self._find_result(ev, event_data.get('results', []))
         if not result:
-            print(f"[navisport] purku: no result for chip {chip} (bib={ev.get('team_id')} leg={ev.get('leg')})")
+            print(f"[navisport] purku: no result for chip {chip} (bib={ev.team_id} leg={ev.leg})")
             return
 
-        start_time_str = self._start_times.get(runner_id) or result.get('startTime')
-        start_dt = None
-        if start_time_str:
-            try:
-                start_dt = datetime.fromisoformat(start_time_str.replace('Z', '+00:00'))
-            except Exception:
-                pass
+        tz_offset = ev.tz_offset
+        start_ms = self._start_times.get(runner_id)
+        if start_ms is not None:
+            start_time_str = ms_to_iso(start_ms, tz_offset)
+        else:
+            start_time_str = result.get('startTime')
+            start_ms = self._parse_start(start_time_str)
 
         controls = []
         for punch in punches:
-            code = str(punch.get('control', ''))
-            punch_ts_str = punch.get('time', '')
-            if not code or not punch_ts_str:
+            code = str(punch.device_id or '')
+            punch_ms = punch.ts_ms
+            if not code or punch_ms is None:
                 continue
-            if start_dt:
-                try:
-                    pt = datetime.fromisoformat(punch_ts_str.replace('Z', '+00:00'))
-                    secs = max(0, int((pt - start_dt).total_seconds()))
-                    controls.append((code, secs))
-                except Exception:
-                    pass
+            if start_ms is not None:
+                controls.append((code, max(0, (punch_ms - start_ms) // 1000)))
             else:
                 controls.append((code, 0))
 
@@ -527,7 +555,7 @@ class NavisportSender:
             print(f"[navisport] purku: no valid punches for chip {chip}")
             return
 
-        iof_status = ev.get('runner_status')
+        iof_status = ev.runner_status
         navi_status = self._map_iof_status(iof_status) if iof_status else None
         chip_result = _build_chip_result(
             result_id=result['id'],
@@ -536,7 +564,7 @@ class NavisportSender:
             start_time=start_time_str,
             status=navi_status,  # None for OK → Navisport validates; explicit for DNF/DNS/DSQ
         )
-        chip_result['readTime'] = purku_ts
+        chip_result['readTime'] = ms_to_iso(purku_ms, tz_offset)
         status_info = f"  iof={iof_status}→navi={navi_status or '(Navisport validates)'}"
         self._send_result(chip_result, self.event_id,
                           f"Result/Update [purku]  chip={chip}  punches={len(controls)}"
@@ -547,9 +575,21 @@ class NavisportSender:
         # Check whether Navisport accepted all punches (status → Finished).
         # Validated runners need no manual intervention; non-validated runners
         # (missing punches) proceed to itkumuuri + manual_ok training scenario.
+        if self.clock.virtual:
+            # --virtual-time: no wall-clock wait for the service.  Navisport
+            # validates an OK runner whose punches are all on checkpoints it
+            # knows, so decide from the purku itself; the outcome then does
+            # not depend on how fast Navisport answers.
+            unknown = sorted({code for code, _ in controls if self._checkpoint_for(code)[0] is None})
+            if navi_status is None and not unknown:
+                self._purku_validated.add(chip)
+                print(f"[navisport] purku: chip={chip} all punches on known checkpoints → no manual_ok needed")
+            else:
+                reason = f"unknown controls {','.join(unknown)}" if unknown else f"status {navi_status}"
+                print(f"[navisport] purku: chip={chip} {reason} → itkumuuri + manual_ok will follow")
+            return
         try:
-            import time as _time
-            _time.sleep(0.5)  # brief pause so Navisport can finish processing
+            time.sleep(0.5)  # brief pause so Navisport can finish processing
             refreshed = self._conn.get_event(self.event_id)
             if refreshed:
                 refreshed_result = self._find_result(ev, refreshed.get('results', []))
@@ -562,11 +602,11 @@ class NavisportSender:
         except Exception as _e:
             print(f"[navisport] purku: validation check failed for chip={chip}: {_e}")
 
-    def _sync_send_status_update(self, ev: Dict, timestamp: str):
+    def _sync_send_status_update(self, ev: 'SimEvent', sent_ms: int):
         """Send Result/Update with the IOF status for runners who have no chip data (DNS/DNF/DSQ)."""
         if not self._conn:
             return
-        iof_status = ev.get('runner_status', '')
+        iof_status = ev.runner_status
         navi_status = self._map_iof_status(iof_status)
         if not navi_status:
             return  # nothing to set (OK runners go through purku instead)
@@ -576,19 +616,19 @@ class NavisportSender:
         chip = self._resolve_chip(ev)
         result = self._find_result(ev, event_data.get('results', []))
         if not result:
-            print(f"[navisport] status_update: no result for chip {chip} (bib={ev.get('team_id')} leg={ev.get('leg')})")
+            print(f"[navisport] status_update: no result for chip {chip} (bib={ev.team_id} leg={ev.leg})")
             return
         updated = {
             **result,
             'status': navi_status,
-            'updated': _navi_now_iso(),
+            'updated': self._now_iso(),
         }
         self._send_result(updated, self.event_id,
                           f"Result/Update [status_update]  chip={chip}  "
                           f"iof={iof_status}→navi={navi_status}")
         print(f"[navisport] status_update: chip={chip}  {iof_status}→{navi_status}")
 
-    def _sync_send_manual_ok(self, ev: Dict, timestamp: str):
+    def _sync_send_manual_ok(self, ev: 'SimEvent', sent_ms: int):
         """Send Result/Update with status='Ok' — simulates officials approving from paper backup.
 
         Fires ONLY for runners whose purku was NOT fully validated by Navisport
@@ -603,55 +643,64 @@ class NavisportSender:
             return
         chip = self._resolve_chip(ev)
         if chip in self._purku_validated:
-            print(f"[navisport] manual_ok: skipped for chip={chip} (bib={ev.get('team_id')} leg={ev.get('leg')}) — Navisport already validated (Finished), no manual override needed")
+            print(f"[navisport] manual_ok: skipped for chip={chip} (bib={ev.team_id} leg={ev.leg}) — Navisport already validated (Finished), no manual override needed")
             return
         event_data = self._conn.get_event(self.event_id)
         if not event_data:
             return
         result = self._find_result(ev, event_data.get('results', []))
         if not result:
-            print(f"[navisport] manual_ok: no result for chip {chip} (bib={ev.get('team_id')} leg={ev.get('leg')})")
+            print(f"[navisport] manual_ok: no result for chip {chip} (bib={ev.team_id} leg={ev.leg})")
             return
         updated = {
             **result,
             'status': 'Ok',
-            'updated': _navi_now_iso(),
+            'updated': self._now_iso(),
         }
         self._send_result(updated, self.event_id,
                           f"Result/Update [manual_ok]  chip={chip}  status=Ok  "
                           f"(officials approved from backup paper)")
         print(f"[navisport] manual_ok: set status=Ok for chip {chip}")
 
-    # ------------------------------------------------------------------
-    # Async entry points called from schedule_and_send
-    # ------------------------------------------------------------------
-
-    async def on_event(self, event: Dict[str, Any], sent_ts: str, msg_obj: Optional[Dict[str, Any]] = None):
-        if not self._conn:
-            return
-        # In debug mode, wait until the current prompt (if any) is answered
-        # before dispatching this event to an executor thread.
-        if self._debug_gate:
-            await self._debug_gate.wait()
-        loop = asyncio.get_event_loop()
-        etype = event.get('event')
+    def _sync_send_event(self, event: 'SimEvent', sent_ms: int):
+        etype = event.event
 
         if etype == 'login':
-            await loop.run_in_executor(None, self._sync_send_login, event, sent_ts)
+            self._sync_send_login(event, sent_ms)
 
         elif etype == 'punch':
-            await loop.run_in_executor(None, self._sync_send_punch, event, sent_ts)
+            self._sync_send_punch(event, sent_ms)
 
         elif etype == 'results_purku':
-            # Use shifted punches from msg_obj (timestamps already adjusted for sim speed)
-            punches = (msg_obj or {}).get('punches', event.get('punches', []))
-            await loop.run_in_executor(None, self._sync_send_purku, event, punches, sent_ts)
+            self._sync_send_purku(event, event.punches or [], sent_ms)
 
         elif etype == 'status_update':
-            await loop.run_in_executor(None, self._sync_send_status_update, event, sent_ts)
+            self._sync_send_status_update(event, sent_ms)
 
         elif etype == 'manual_ok':
-            await loop.run_in_executor(None, self._sync_send_manual_ok, event, sent_ts)
+            self._sync_send_manual_ok(event, sent_ms)
+
+    def _sync_send_events(self, items: List[Tuple['SimEvent', int]]):
+        for event, sent_ms in items:
+            self._sync_send_event(event, sent_ms)
+
+    # ------------------------------------------------------------------
+    # Async entry points called from EventSink
+    # ------------------------------------------------------------------
+
+    async def on_event(self, event: 'SimEvent', sent_ms: int):
+        await self.on_events([(event, sent_ms)])
+
+    async def on_events(self, items: List[Tuple['SimEvent', int]]):
+        """Send a batch of (event, sent_ms) in order with a single executor hop."""
+        if not self._conn or not items:
+            return
+        # In debug mode, wait until the current prompt (if any) is answered
+        # before dispatching this batch to an executor thread.
+        if self._debug_gate:
+            await self._debug_gate.wait()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._sync_send_events, items)
 
     async def close(self):
         if self._refresh_task:
@@ -669,9 +718,9 @@ class NavisportSender:
 
 
 # --- lajittelun apufunktio ---
-def event_sort_key(ev: Dict[str, Any]):
-    etype = ev.get("event", "")
-    devid = ev.get("device_id", "")
+def event_sort_key(ev: 'SimEvent'):
+    etype = ev.event or ""
+    devid = ev.device_id or ""
 
     if etype == "login":
         m = re.match(r"login_(\d+)", str(devid))
@@ -695,6 +744,11 @@ def event_sort_key(ev: Dict[str, Any]):
 
     return (99, str(devid))
 
+
+def timeline_sort_key(item: Tuple[int, 'SimEvent']):
+    """Order (epoch_ms, event) timeline entries by time, then by event_sort_key()."""
+    return (item[0], event_sort_key(item[1]))
+
 # --- Predefined login devices ---
 PURKU_DEVICES      = [f"purku_{i}" for i in range(1, 6)]      # 5 tulosten purku
 ITKUMUURI_DEVICES = [f"itkumuuri_{i}" for i in range(1, 4)] # 3 itkumuuri
@@ -716,8 +770,9 @@ def checkin_window_for_bib(bib: int, windows: list) -> tuple:
     return (75, 20)
 
 
-def assign_checkin_events(all_by_runner: dict, mass_start_ts: datetime,
-                          bib_map: dict, login_config: dict) -> list:
+def assign_checkin_events(all_by_runner: dict, mass_start_ms: int,
+                          bib_map: dict, login_config: dict,
+                          mass_start_tz: int = 0) -> list:
     """
     Generate login (check-in) events.
 
@@ -725,8 +780,8 @@ def assign_checkin_events(all_by_runner: dict, mass_start_ts: datetime,
     Leg >1 runners check in ~non_first_leg_checkin_minutes_before_start
     before their individual StartTime.
 
-    Returns list of (timestamp, event_dict) tuples.
-    Each event carries a ``login_device`` key (device_id) for later queue
+    Returns list of (epoch_ms, SimEvent) tuples.
+    Each event carries a login device (device_id) for later queue
     simulation — the actual device assignment may be rebalanced during
     event processing if login devices are oversubscribed.
     """
@@ -742,61 +797,221 @@ def assign_checkin_events(all_by_runner: dict, mass_start_ts: datetime,
             continue
 
         first_ev = punches[0][1]
-        leg = first_ev.get('leg', 1)
+        leg = first_ev.leg or 1
         bib = bib_map.get(runner_id, 999)
         device_id = _rnd.choice(login_devices)
-        runner_name = first_ev.get('runner_name', '') or ''
-        club = first_ev.get('club', '') or ''
 
         if leg == 1:
             early_min, late_min = checkin_window_for_bib(bib, windows)
             minutes_before = _rnd.randint(late_min, early_min)
-            login_ts = mass_start_ts - timedelta(minutes=minutes_before)
-            runner_start_dt = mass_start_ts
+            login_ms = mass_start_ms - minutes_before * 60000
+            runner_start_ms, tz_offset = mass_start_ms, mass_start_tz
             note = f'login {minutes_before}min before mass start (bib={bib}, leg 1)'
         else:
-            start_time_str = first_ev.get('start_time')
-            if start_time_str:
-                try:
-                    runner_start_dt = datetime.fromisoformat(start_time_str)
-                except Exception:
-                    runner_start_dt = mass_start_ts
+            if first_ev.start_ms is not None:
+                runner_start_ms, tz_offset = first_ev.start_ms, first_ev.tz_offset
             else:
-                runner_start_dt = mass_start_ts
-            login_ts = runner_start_dt - timedelta(minutes=non_first_min)
+                runner_start_ms, tz_offset = mass_start_ms, mass_start_tz
+            login_ms = runner_start_ms - non_first_min * 60000
             note = f'login {non_first_min}min before leg start (bib={bib}, leg {leg})'
 
-        extra.append((login_ts, {
-            'timestamp': login_ts.isoformat(),
-            'runner_id': runner_id,
-            'runner_name': runner_name,
-            'club': club,
-            'team_id': str(bib),
-            'device_id': device_id,
-            'device_type': 'login',
-            'event': 'login',
-            'status': 'ok',
-            'leg': leg,
-            'start_time': runner_start_dt.isoformat(),
-            'note': note,
-        }))
+        extra.append((login_ms, SimEvent(
+            login_ms, 'login', device_id, 'login', first_ev.runner,
+            tz_offset=tz_offset, status='ok', start_ms=runner_start_ms, note=note)))
     return extra
 
 
+# --- Login queue (check-in desk model) ---
+#
+# Check-ins are served in arrival order by a pool of reader devices.  Each
+# runner takes the device that frees up first; a device that has never been
+# used counts as free at the arrival time, and ties go to the device that has
+# been in the pool longest.  A device can break at the start of a check-in:
+# it leaves the pool, the runner is rerouted (+ extra delay) and the device
+# comes back after the downtime.
+#
+# Idle devices sit in a heap keyed by (free time, pool order) and broken ones
+# in a heap keyed by repair time, so one check-in costs O(log D) instead of a
+# scan over the device list.  The random draws happen in the same order as in
+# the original list-based model, so the same random state gives the same
+# check-in times.  Waits, busy time and queue length are recorded on the
+# way; they are what the desk needs to decide how many readers to rent.
+
+LOGIN_QUEUE_WINDOW_MS = 5 * 60000
+
+
+class LoginQueue:
+    """Discrete-event check-in model over ``device_count`` readers."""
+
+    def __init__(self, device_count: int, processing_seconds: float = 20,
+                 broken_probability: float = 0.0, broken_extra_seconds: float = 60,
+                 downtime_seconds: float = 300):
+        self.devices = [f"login_{i}" for i in range(1, device_count + 1)]
+        self.charge_ms = int(processing_seconds * 1000)
+        self.broken_probability = broken_probability
+        self.broken_extra = broken_extra_seconds
+        self.downtime_ms = int(downtime_seconds * 1000)
+        self._fresh = [(i, d) for i, d in enumerate(self.devices)]   # (pool order, device), never used
+        self._free: List[Tuple[int, int, str]] = []                  # (free at, pool order, device)
+        self._order = len(self.devices)
+        self._repairs: List[Tuple[int, int, str]] = []               # (back at, break seq, device)
+        self._broken: Dict[str, Tuple[int, int]] = {}                # device → (back at, break seq)
+        self._break_seq = 0
+        # statistics
+        self.count = 0
+        self.unserved = 0      # check-ins while every reader was broken
+        self.busy_ms: Dict[str, int] = {d: 0 for d in self.devices}
+        self.breakdowns: Dict[str, int] = {d: 0 for d in self.devices}
+        self.waits: List[int] = []
+        self._queue_edges: List[Tuple[int, int]] = []   # (ms, +1 arrival / -1 service start)
+        self.first_arrival: Optional[int] = None
+        self.last_checkout: Optional[int] = None
+
+    def _repair(self, ts: int):
+        """Return devices whose downtime has elapsed by ``ts``, in the order they broke."""
+        due = []
+        while self._repairs and self._repairs[0][0] <= ts:
+            back, seq, dev = heapq.heappop(self._repairs)
+            if self._broken.get(dev) == (back, seq):   # skip superseded entries
+                del self._broken[dev]
+                due.append((seq, dev))
+        for _, dev in sorted(due):
+            heapq.heappush(self._free, (ts, self._order, dev))
+            self._order += 1
+
+    def _take(self, ts: int) -> Tuple[Optional[str], int, int]:
+        """Pop the earliest-free device: (device, service start, pool order)."""
+        fresh = self._fresh[0] if self._fresh else None
+        used = self._free[0] if self._free else None
+        if fresh is not None and (used is None or (ts, fresh[0]) < used[:2]):
+            heapq.heappop(self._fresh)
+            return fresh[1], ts, fresh[0]
+        if used is not None:
+            heapq.heappop(self._free)
+            return used[2], max(ts, used[0]), used[1]
+        return None, ts, -1
+
+    def check_in(self, ts: int) -> Tuple[str, int, int, List[str]]:
+        """
+        Serve one runner arriving at ``ts`` (calls must come in arrival
+        order).  Returns (device, service start, checkout, note parts).
+        """
+        self._repair(ts)
+        dev, start, order = self._take(ts)
+        if dev is None:
+            dev = self.devices[0]     # every reader is broken: the desk improvises
+        charge = self.charge_ms
+        note_parts = []
+
+        if self.broken_probability > 0 and random.random() < self.broken_probability:
+            # Device breaks — out of the pool until repaired
+            back = start + self.downtime_ms
+            seq = self._broken[dev][1] if dev in self._broken else self._break_seq
+            self._break_seq += 1
+            self._broken[dev] = (back, seq)
+            heapq.heappush(self._repairs, (back, seq, dev))
+            self.breakdowns[dev] += 1
+            note_parts.append(f'{dev} BROKEN')
+
+            # Redirect this runner to an alternative device
+            extra_sec = random.uniform(1, self.broken_extra)
+            charge += int(extra_sec * 1000)
+            note_parts.append(f'+{extra_sec:.0f}s reroute')
+
+            alt, alt_start, alt_order = self._take(ts)
+            if alt is not None:
+                dev, start, order = alt, alt_start, alt_order
+                note_parts.append(f'→ {dev}')
+            else:
+                order = -1
+
+        checkout = start + charge
+        if order >= 0:
+            heapq.heappush(self._free, (checkout, order, dev))
+            self.busy_ms[dev] += charge
+        else:
+            self.unserved += 1
+
+        self.count += 1
+        wait = start - ts
+        self.waits.append(wait)
+        if wait > 0:
+            self._queue_edges.append((ts, 1))
+            self._queue_edges.append((start, -1))
+            note_parts.append(f'queued {wait / 1000:.0f}s')
+        if self.first_arrival is None:
+            self.first_arrival = ts
+        if self.last_checkout is None or checkout > self.last_checkout:
+            self.last_checkout = checkout
+        return dev, start, checkout, note_parts
+
+    def queue_peaks(self) -> List[Tuple[int, int]]:
+        """(window start ms, peak queue length) for every 5-minute window with a queue."""
+        peaks: Dict[int, int] = {}
+        level = 0
+        window = None
+        for ms, delta in sorted(self._queue_edges):
+            w = ms // LOGIN_QUEUE_WINDOW_MS
+            if window is not None and level > 0:
+                # The queue carried over into the windows up to this one
+                for carried in range(window + 1, w + 1):
+                    peaks[carried] = max(peaks.get(carried, 0), level)
+            window = w
+            level += delta
+            if level > peaks.get(w, 0):
+                peaks[w] = level
+        return [(w * LOGIN_QUEUE_WINDOW_MS, n) for w, n in sorted(peaks.items()) if n > 0]
+
+    def report(self, label: str = '', tz_offset: int = 0) -> List[str]:
+        """Lines with waits, per-device utilisation and queue peaks."""
+        if not self.count:
+            return []
+        prefix = f"[login] {label}: " if label else "[login] "
+        broken = sum(self.breakdowns.values())
+        span = max(1, self.last_checkout - self.first_arrival)
+        lines = [f"{prefix}{self.count} check-ins on {len(self.devices)} readers, "
+                 f"{broken} breakdown(s), {ms_to_iso(self.first_arrival, tz_offset)[11:16]}"
+                 f"–{ms_to_iso(self.last_checkout, tz_offset)[11:16]}"]
+        if self.unserved:
+            lines.append(f"[login]   {self.unserved} check-in(s) while every reader was broken")
+
+        waits = sorted(self.waits)
+        p50, p95 = (waits[min(len(waits) - 1, int(q * len(waits)))] / 1000 for q in (0.50, 0.95))
+        queued = sum(1 for w in waits if w > 0)
+        lines.append(f"[login]   wait s: p50 {p50:.0f}  p95 {p95:.0f}  max {waits[-1] / 1000:.0f}"
+                     f"  ({queued} of {self.count} queued)")
+
+        cells = [f"{d[6:]}:{100 * self.busy_ms[d] / span:.0f}%" for d in self.devices]
+        for i in range(0, len(cells), 10):
+            head = "utilisation" if i == 0 else ""
+            lines.append(f"[login]   {head:<11} {'  '.join(cells[i:i + 10])}")
+
+        peaks = [f"{ms_to_iso(ms, tz_offset)[11:16]} {n}" for ms, n in self.queue_peaks()]
+        if not peaks:
+            lines.append("[login]   peak queue  0 in every 5 min window")
+        for i in range(0, len(peaks), 8):
+            head = "peak queue" if i == 0 else ""
+            lines.append(f"[login]   {head:<11} {'  '.join(peaks[i:i + 8])}")
+        return lines
+
+
+def race_type_from_name(name: str) -> str:
+    """Map an IOF <Event><Name> to 'venla' or 'jukola' (default 'venla')."""
+    name_lower = (name or '').lower()
+    if 'venla' in name_lower:
+        return 'venla'
+    if 'jukola' in name_lower:
+        return 'jukola'
+    return 'venla'  # default
+
+
 def detect_race_from_xml(iof_path: str) -> str:
     """Read <Event><Name> from IOF3 XML and return 'venla' or 'jukola'."""
-    import xml.etree.ElementTree as _ET
     try:
-        tree = _ET.parse(iof_path)
-        root = tree.getroot()
+        root = iofreader.parse(iof_path)
         ns_uri = root.tag.split('}')[0].strip('{') if '}' in root.tag else None
         ns = {'iof': ns_uri} if ns_uri else None
-        name = root.findtext('.//iof:Name', namespaces=ns) or ''
-        name_lower = name.lower()
-        if 'venla' in name_lower:
-            return 'venla'
-        if 'jukola' in name_lower:
-            return 'jukola'
+        return race_type_from_name(root.findtext('.//iof:Name', namespaces=ns) or '')
     except Exception:
         pass
     return 'venla'  # default
@@ -804,9 +1019,7 @@ def detect_race_from_xml(iof_path: str) -> str:
 
 def parse_mass_start_time(iof_path: str) -> datetime:
     """Find the earliest start time in the XML as the race start signal."""
-    import xml.etree.ElementTree as _ET
-    tree = _ET.parse(iof_path)
-    root = tree.getroot()
+    root = iofreader.parse(iof_path)
     ns_uri = root.tag.split('}')[0].strip('{') if '}' in root.tag else None
     ns = {'iof': ns_uri} if ns_uri else None
     earliest = None
@@ -856,6 +1069,15 @@ def load_config(path: str = DEFAULT_CONFIG_PATH) -> dict:
     return config
 
 
+def login_config_for_race(config: dict, race: str) -> dict:
+    """
+    Check-in settings for one race: the ``login`` section with the optional
+    ``login_<race>`` section (e.g. ``login_jukola``) merged over it.
+    """
+    login = config.get('login', config)
+    return {**login, **(config.get(f'login_{race}') or {})}
+
+
 def generate_default_config(path: str = DEFAULT_CONFIG_PATH):
     """Write default config file if it doesn't exist."""
     if not os.path.exists(path):
@@ -869,6 +1091,62 @@ def make_message(ev: Dict[str, Any]) -> str:
     # yksi JSON-rivi per tapahtuma
     return json.dumps(ev, separators=(',', ':')) + "\n"
 
+def parse_speed(value: str) -> float:
+    """Speed factor from the CLI / control API: a positive number, or 'max' (= math.inf, unthrottled)."""
+    if str(value).strip().lower() == 'max':
+        return math.inf
+    speed = float(value)
+    if not speed > 0:
+        raise ValueError(f"speed must be positive or 'max', got {value!r}")
+    return speed
+
+
+def speed_label(speed: float) -> str:
+    return 'max' if math.isinf(speed) else f"{speed:g}"
+
+
+def parse_speed_profile(value) -> List[Tuple[Any, float]]:
+    """
+    Speed profile from the CLI ('0=1,1.5=20,9=1') or the config file (a list
+    of {"at": ..., "speed": ...}) as [(at, speed)].  ``at`` is hours after
+    the timeline start (a number) or an ISO timestamp (a string).
+    """
+    if isinstance(value, str):
+        entries = []
+        for part in value.split(','):
+            at, sep, speed = part.strip().rpartition('=')
+            if not sep:
+                raise ValueError(f"expected AT=SPEED, got {part.strip()!r}")
+            entries.append({'at': at.strip(), 'speed': speed})
+    else:
+        entries = value
+    steps = []
+    for entry in entries:
+        at, speed = entry['at'], float(entry['speed'])
+        if not speed > 0 or math.isinf(speed):
+            raise ValueError(f"profile speeds must be positive numbers, got {entry['speed']!r}")
+        if isinstance(at, str):
+            try:
+                at = float(at)
+            except ValueError:
+                iso_to_ms(at)   # validate now, resolved against the timeline later
+        steps.append((at, speed))
+    if not steps:
+        raise ValueError("empty speed profile")
+    return steps
+
+
+def parse_gap_compression(value: str) -> Tuple[int, int]:
+    """'N:M' seconds (idle gaps longer than N play as M) → (gap_ms, keep_ms)."""
+    gap, sep, keep = str(value).partition(':')
+    if not sep:
+        raise ValueError(f"expected N:M seconds, got {value!r}")
+    gap_ms, keep_ms = int(float(gap) * 1000), int(float(keep) * 1000)
+    if not 0 <= keep_ms <= gap_ms or gap_ms <= 0:
+        raise ValueError(f"need 0 <= M <= N and N > 0, got {value!r}")
+    return gap_ms, keep_ms
+
+
 def parse_team_range(range_str: str) -> set[int]:
     """
     Parse string like "1,3,5,14-55" into a set of integers.
@@ -889,364 +1167,2758 @@ def parse_team_range(range_str: str) -> set[int]:
                 raise ValueError(f"Virheellinen bib-numero: '{part}'")
     return result
 
-# --- IOF XML parsing ---
-def parse_iof3_events(iof_path: str, team_range: Optional[set[int]] = None,
-                      team_limit: Optional[int] = None,
-                      leg_set: Optional[set[int]] = None) -> List[Dict[str, Any]]:
-    tree = ET.parse(iof_path)
-    root = tree.getroot()
-    ns_uri = root.tag.split('}')[0].strip('{') if '}' in root.tag else None
-    ns = {'iof': ns_uri} if ns_uri else None
-    events = []
-    all_teams_count = 0
-    included_teams_count = 0
+# --- Epoch-millisecond timestamps ---
+#
+# Inside the simulator every timestamp is an int of epoch milliseconds plus
+# the UTC offset (seconds) of the source time, so the timeline never parses
+# or builds datetime objects per event.  ISO strings are produced only at the
+# wire boundary (WebSocket messages and Navisport payloads).
 
+def dt_to_ms(dt: datetime) -> Tuple[int, int]:
+    """Return (epoch_ms, utc_offset_seconds) for an aware datetime (naive = UTC)."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    off = dt.utcoffset()
+    return (round(dt.timestamp() * 1000), int(off.total_seconds()) if off else 0)
 
-    for team in root.findall('.//iof:TeamResult', ns):
-        all_teams_count += 1
-        team_bib_text = team.findtext('iof:BibNumber', namespaces=ns) or team.get('bib') or team.get('id') or None
 
-        # Suodata joukkueet halutun rangen mukaan
-        if team_range and team_bib_text:
-            try:
-                team_bib_num = int(team_bib_text)
-                if team_bib_num not in team_range:
-                    continue
-            except ValueError:
-                continue
-        included_teams_count += 1
+def iso_to_ms(s: str) -> Tuple[int, int]:
+    """Parse an ISO-8601 string (``Z`` allowed) into (epoch_ms, utc_offset_seconds)."""
+    return dt_to_ms(datetime.fromisoformat(s.replace('Z', '+00:00')))
 
-        # Limit to first N teams (XML order, after bib filter)
-        if team_limit and included_teams_count > team_limit:
-            break
 
-        org = team.find('iof:Organisation', ns)
-        club = org.findtext('iof:Name', namespaces=ns) or '' if org is not None else ''
+def ms_to_datetime(ms: int, tz_offset: int = 0) -> datetime:
+    return datetime.fromtimestamp(ms / 1000, timezone(timedelta(seconds=tz_offset)))
 
-        if ns:
-            members = team.findall('.//iof:TeamMemberResult', ns)
-        else:
-            members = team.findall('.//TeamMemberResult')
-        if not members:
-            continue
 
-        for idx, member in enumerate(members, start=1):
-            # Resolve leg number from <Leg> element; fall back to enumerate index.
-            result_pre = member.find('iof:Result', ns)
-            leg_num = idx
-            if result_pre is not None:
-                leg_txt = result_pre.findtext('iof:Leg', namespaces=ns)
-                if leg_txt:
-                    try:
-                        leg_num = int(leg_txt)
-                    except ValueError:
-                        pass
-            if leg_set and leg_num not in leg_set:
-                continue
+_TZ_SUFFIX: Dict[int, str] = {}
 
-            person_id = None
-            person_el = member.find('iof:Person', ns)
-            if person_el is not None:
-                person_id = (
-                    person_el.findtext('iof:PersonID', namespaces=ns) or
-                    person_el.findtext('iof:Id', namespaces=ns) or
-                    person_el.findtext('iof:ID', namespaces=ns)
-                )
-                name_el = person_el.find('iof:Name', ns)
-                runner_name = ""
-                if name_el is not None:
-                    given = name_el.findtext('iof:Given', namespaces=ns) or ""
-                    family = name_el.findtext('iof:Family', namespaces=ns) or ""
-                    runner_name = f"{given} {family}".strip()
-            else:
-                person_id = member.get('id') or member.get('MemberID') or None
-                runner_name = None
 
-            if not person_id:
-                person_id = f"{team_bib_text or 'team'}:{idx}"
+def _tz_suffix(tz_offset: int) -> str:
+    s = _TZ_SUFFIX.get(tz_offset)
+    if s is None:
+        sign = '-' if tz_offset < 0 else '+'
+        h, rem = divmod(abs(tz_offset), 3600)
+        m, sec = divmod(rem, 60)
+        s = f"{sign}{h:02d}:{m:02d}" + (f":{sec:02d}" if sec else '')
+        _TZ_SUFFIX[tz_offset] = s
+    return s
 
-            result = result_pre
-            if result is None:
-                continue
 
-            start_time_txt = result.findtext('iof:StartTime', namespaces=ns) if ns else result.findtext('StartTime')
-            start_dt = try_parse_time(start_time_txt) if start_time_txt else None
-            if start_dt and start_dt.tzinfo is None:
-                start_dt = start_dt.replace(tzinfo=timezone.utc)
+def ms_to_iso(ms: int, tz_offset: int = 0) -> str:
+    """Format epoch ms like ``datetime.isoformat()`` in the given UTC offset."""
+    secs, msec = divmod(ms + tz_offset * 1000, 1000)
+    s = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(secs))
+    if msec:
+        return f"{s}.{msec:03d}000{_tz_suffix(tz_offset)}"
+    return s + _tz_suffix(tz_offset)
 
-            status_txt = result.findtext('iof:Status', namespaces=ns)
 
-            split_count = 0
-            for split in result.findall('iof:SplitTime', ns):
-                code = split.findtext('iof:ControlCode', namespaces=ns)
-                time_txt = split.findtext('iof:Time', namespaces=ns)
-                if not time_txt or not code:
-                    continue
+def ms_to_navisport(ms: int) -> str:
+    """Navisport's expected UTC format: 2026-07-01T15:21:35.031Z"""
+    secs, msec = divmod(ms, 1000)
+    return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(secs))}.{msec:03d}Z"
 
-                ts = None
-                if start_dt:
-                    try:
-                        offset = int(time_txt)
-                        ts = start_dt + timedelta(seconds=offset)
-                    except ValueError:
-                        try:
-                            hh, mm, ss = map(int, time_txt.split(":"))
-                            delta_sec = (hh*3600 + mm*60 + ss) - (start_dt.hour*3600 + start_dt.minute*60 + start_dt.second)
-                            ts = start_dt + timedelta(seconds=delta_sec)
-                        except Exception:
-                            ts = start_dt
-
-                if ts:
-                    split_count += 1
-                    events.append({
-                        'timestamp': ts.isoformat(),
-                        'runner_id': person_id,
-                        'runner_name': runner_name,
-                        'club': club,
-                        'team_id': team_bib_text,
-                        'device_id': code,
-                        'device_type': guess_device_type(code, None),
-                        'raw_time': time_txt,
-                        'status': status_txt or 'OK',
-                        'event': 'punch',
-                        'leg': leg_num,
-                        'start_time': start_dt.isoformat() if start_dt else None,
-                    })
-
-            # Runners with no split times but a non-OK status (DNS, DSQ, DNF before
-            # first control) need a synthetic marker so they enter the pipeline and
-            # get a login event + a later status update sent to Navisport.
-            if split_count == 0 and status_txt and status_txt.upper() != 'OK':
-                marker_ts = start_dt or datetime.now(timezone.utc)
-                events.append({
-                    'timestamp': marker_ts.isoformat(),
-                    'runner_id': person_id,
-                    'runner_name': runner_name,
-                    'club': club,
-                    'team_id': team_bib_text,
-                    'device_id': 'status_marker',
-                    'device_type': 'status_only',
-                    'status': status_txt,
-                    'event': 'status_only',
-                    'leg': leg_num,
-                    'start_time': start_dt.isoformat() if start_dt else None,
-                })
-
-    events.sort(key=lambda e: e['timestamp'])
-    print(f"Teams in XML: {all_teams_count}")
-    msg = f"Teams included: {included_teams_count}"
-    if team_limit:
-        msg += f" (limited to first {team_limit})"
-    print(msg)
-    return events
 
-def try_parse_time(t: str) -> datetime:
-    # Yritetään useita formaatteja; lisää tarvittaessa 2025-06-14T23:00:00+03:00
-    fmts = ["%Y-%m-%dT%H:%M:%S%z"]
-    for f in fmts:
-        try:
-            dt = datetime.strptime(t, f)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            return dt
-        except Exception:
-            pass
-    # fallback: nykyhetki UTC
-    return datetime.now(timezone.utc)
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
 
-def guess_device_type(control: str, status: str) -> str:
-    # Yksinkertainen heuristiikka;
-    if control is None:
-        return 'unknown'
-    c = control.lower()
-    if 'start' in c or c.startswith('s'):
-        return 'login'
-    if 'mass_start ' in c :
-        return 'mass_start'
-    if 'finish' in c or 'maali' in c or 'f' == c:
-        return 'finish'
-    if 'exchange' in c or 'vaihto' in c:
-        return 'exchange'
-    # oletuksena väliaikarasti
-    return 'split'
 
-# --- Simulator core: schedule and send events with speed factor ---
-async def load_allowed_controls(file_path: str = None, url: str = None) -> set:
-    controls = set()
+# --- Clocks (real and --virtual-time) ---
+#
+# The dispatcher, the sinks and the Navisport sender read time through a
+# clock object: time() is the monotonic scale deadlines are computed on,
+# now_ms() the wall clock stamped into messages.  WallClock is the real
+# thing (the event loop's clock and the system clock).
+#
+# With --virtual-time the dispatcher runs on a VirtualClock instead.  When
+# the next event is not yet due, the dispatcher waits for every send in
+# flight and every device queue to drain, then moves the clock straight to
+# the due time instead of sleeping.  The schedule, the batches and the
+# timestamps on the wire are those of a real-time run started at the
+# clock's start; only the waiting is skipped, so a whole race replays in
+# the time its sends take.  Each instant is delivered completely before
+# the next one, which also makes the delivery order deterministic.
+#
+# The login queue needs no clock: it is simulated on the race timestamps
+# while the timeline is built.
 
-    # Lue paikallinen tiedosto (JSON-lista käytä avuksi jukola_split_controls.html )
-    if file_path and os.path.exists(file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-                try:
-                    data = json.loads(text)
-                    if isinstance(data, list):
-                        for item in data:
-                            if item is not None:
-                                controls.add(str(item).strip().lower())
-                    else:
-                        print(f"Warning: controls file {file_path} does not contain a JSON list")
-                except json.JSONDecodeError:
-                    # Fallback: rivikohtainen lista (kuten alkuperäisessä)
-                    f.seek(0)
-                    for ln in f:
-                        code = ln.strip()
-                        if code:
-                            controls.add(code.lower())
-        except Exception as e:
-            print(f"Warning: could not read controls file {file_path}: {e}")
+class WallClock:
+    """Real time: the running event loop's clock and the system clock."""
 
-    # Hae URLista (odotetaan JSON-listaa) # tämä tulis varmaan suoraa navisportista
-    if url:
-        try:
-            async with aiohttp.ClientSession() as sess:
-                async with sess.get(url, timeout=10) as resp:
-                    if resp.status == 200:
-                        try:
-                            data = await resp.json()
-                        except Exception:
-                            text = await resp.text()
-                            try:
-                                data = json.loads(text)
-                            except Exception:
-                                data = None
-                        if isinstance(data, list):
-                            for item in data:
-                                if item is not None:
-                                    controls.add(str(item).strip().lower())
-                        else:
-                            print(f"Warning: controls URL did not return a JSON list")
-                    else:
-                        print(f"Warning: controls URL returned status {resp.status}")
-        except Exception as e:
-            print(f"Warning: could not fetch controls from {url}: {e}")
+    virtual = False
 
-    return controls
+    def time(self) -> float:
+        return asyncio.get_running_loop().time()
 
+    def now_ms(self) -> int:
+        return now_ms()
 
 
-def normalize(c):
-    return None if c is None else str(c).strip().lower()
+class VirtualClock(WallClock):
+    """
+    Simulated time starting at epoch ms ``start_ms``.  It only moves when the
+    dispatcher calls advance_to().
+    """
 
-def control_allowed(control, allowed_controls:set):
-    if not allowed_controls:
-        return True
-    nc = normalize(control)
-    return nc in allowed_controls
+    virtual = True
 
-# globaali sanakirja laitteiden tiloille ja viestimäärille
-device_status = {}
-device_order = []  # järjestys, jossa laitteet tulostetaan
-device_msg_count = {}
+    def __init__(self, start_ms: int):
+        self.start_ms = start_ms
+        self.elapsed = 0.0                 # seconds since start_ms
 
-def update_dashboard(device_id):
-    """Päivittää vain yhden laitteen rivin konsolissa."""
-    idx = device_order.index(device_id)
-    # siirrä kursori oikealle riville
-    sys.stdout.write(f"\033[{len(device_order) - idx}F")  # siirrytään ylös rivien mukaan
-    sys.stdout.write("\033[K")  # tyhjennä rivi
-    count = device_msg_count.get(device_id, 0)
-    status = device_status.get(device_id, "pending")
-    print(f"{device_id:14}: {status:20} sent: {count}")
-    # siirry takaisin konsolin loppuun
-    sys.stdout.write(f"\033[{len(device_order) - idx}E")
-    sys.stdout.flush()
+    def time(self) -> float:
+        return self.elapsed
 
+    def now_ms(self) -> int:
+        return self.start_ms + round(self.elapsed * 1000)
 
-class DeviceClient:
-    def __init__(self, device_id, host, port):
+    def advance_to(self, t: float):
+        if t > self.elapsed:
+            self.elapsed = t
+
+
+WALL_CLOCK = WallClock()
+
+
+# --- Compact event store ---
+
+class Runner:
+    """
+    Runner dimension record, shared by every event of one competitor, so
+    names, clubs and bibs are stored once per runner instead of once per split.
+    """
+
+    __slots__ = ('runner_id', 'runner_name', 'club', 'team_id', 'leg',
+                 'start_ms', 'tz_offset', 'status', 'chip')
+
+    def __init__(self, runner_id: str, runner_name: Optional[str] = None, club: str = '',
+                 team_id: Optional[str] = None, leg: Optional[int] = None,
+                 start_ms: Optional[int] = None, tz_offset: int = 0,
+                 status: Optional[str] = None, chip: Optional[str] = None):
+        self.runner_id = runner_id
+        self.runner_name = runner_name
+        self.club = club
+        self.team_id = team_id
+        self.leg = leg
+        self.start_ms = start_ms
+        self.tz_offset = tz_offset
+        self.status = status      # IOF <Status>, 'OK' when missing
+        self.chip = chip          # explicit chip number, if known
+
+
+class SimEvent:
+    """
+    One timeline event: punch, status_only, login, mass_start, results_purku,
+    itkumuuri, manual_ok or status_update.
+
+    Runner-level fields are read through the shared ``runner`` record.
+    Control codes and raw split times are interned.  A results_purku event
+    keeps references to the runner's punch events in ``punches``; they are
+    not copied.
+    """
+
+    __slots__ = ('ts_ms', 'event', 'device_id', 'device_type', 'runner', 'tz_offset',
+                 'status', 'raw_time', 'start_ms', 'note', 'punches')
+
+    def __init__(self, ts_ms: int, event: str, device_id: Optional[str], device_type: Optional[str],
+                 runner: Optional[Runner] = None, tz_offset: int = 0,
+                 status: Optional[str] = None, raw_time: Optional[str] = None,
+                 start_ms: Optional[int] = None, note: Optional[str] = None,
+                 punches: Optional[list] = None):
+        self.ts_ms = ts_ms
+        self.event = event
         self.device_id = device_id
-        self.host = host
-        self.port = port
-        self.ws = None
-        self.queue = asyncio.Queue()
-        self.sender_task = None
-        self.sent_count = 0
+        self.device_type = device_type
+        self.runner = runner
+        self.tz_offset = tz_offset
+        self.status = status
+        self.raw_time = raw_time
+        self.start_ms = start_ms
+        self.note = note
+        self.punches = punches
+
+    @property
+    def runner_id(self) -> Optional[str]:
+        return self.runner.runner_id if self.runner else None
+
+    @property
+    def runner_name(self) -> Optional[str]:
+        return self.runner.runner_name if self.runner else None
+
+    @property
+    def club(self) -> str:
+        return self.runner.club if self.runner else ''
+
+    @property
+    def team_id(self) -> Optional[str]:
+        return self.runner.team_id if self.runner else None
+
+    @property
+    def leg(self) -> Optional[int]:
+        return self.runner.leg if self.runner else None
+
+    @property
+    def chip(self) -> Optional[str]:
+        return self.runner.chip if self.runner else None
+
+    @property
+    def runner_status(self) -> str:
+        """The runner's IOF status (for purku / status_update decisions)."""
+        return (self.runner.status if self.runner else None) or ''
+
+    def __repr__(self) -> str:
+        return f"SimEvent({self.event} {self.device_id} runner={self.runner_id} ts={self.ts_ms})"
+
+
+_RUNNER_FIELDS = Runner.__slots__
+_EVENT_COLUMNS = ('ts_ms', 'event', 'device_id', 'device_type', 'tz_offset',
+                  'status', 'raw_time', 'start_ms', 'note')
+
+
+def events_to_columns(events: List[SimEvent]) -> Tuple[list, list]:
+    """Flatten events to (runner rows, event rows) of builtins; runner index is the last column."""
+    runner_idx: Dict[int, int] = {}
+    runners = []
+    rows = []
+    for ev in events:
+        r = ev.runner
+        if r is None:
+            ri = -1
+        else:
+            ri = runner_idx.get(id(r))
+            if ri is None:
+                ri = runner_idx[id(r)] = len(runners)
+                runners.append(tuple(getattr(r, f) for f in _RUNNER_FIELDS))
+        rows.append(tuple(getattr(ev, c) for c in _EVENT_COLUMNS) + (ri,))
+    return runners, rows
 
-        if device_id not in device_order:
-            device_order.append(device_id)
-            device_status[device_id] = "pending"
-            device_msg_count[device_id] = 0
-            # tulostetaan aloitusdashboard
-            print(f"{device_id:10}: {device_status[device_id]:20} sent: 0")
 
-    async def connect(self):
-        if not self.ws:
-            try:
-                self.ws = await websockets.connect(f"ws://{self.host}:{self.port}/sim")
-                device_status[self.device_id] = "connected"
-                update_dashboard(self.device_id)
-            except Exception as e:
-                device_status[self.device_id] = "connect error"
-                update_dashboard(self.device_id)
-                print(f"[{self.device_id}] connect error: {e}")
-                self.ws = None
+def events_from_columns(runners: list, rows: list) -> List[SimEvent]:
+    runner_objs = [Runner(*r) for r in runners]
+    events = []
+    for row in rows:
+        ts_ms, event, device_id, device_type, tz_offset, status, raw_time, start_ms, note, ri = row
+        events.append(SimEvent(
+            ts_ms, event,
+            sys.intern(device_id) if device_id else device_id, device_type,
+            runner_objs[ri] if ri >= 0 else None,
+            tz_offset=tz_offset, status=status,
+            raw_time=sys.intern(raw_time) if raw_time else raw_time,
+            start_ms=start_ms, note=note))
+    return events
 
-        if self.ws and not self.sender_task:
-            self.sender_task = asyncio.create_task(self._sender())
 
-    async def _reconnect(self):
-        for delay in [1, 2, 5]:
-            try:
-                self.ws = await websockets.connect(f"ws://{self.host}:{self.port}/sim")
-                device_status[self.device_id] = "reconnected"
-                update_dashboard(self.device_id)
-                return
-            except Exception as e:
-                device_status[self.device_id] = "reconnecting"
-                update_dashboard(self.device_id)
-                print(f"[{self.device_id}] reconnect failed: {e}")
-                await asyncio.sleep(delay)
-        self.ws = None
-        device_status[self.device_id] = "conn failed"
-        update_dashboard(self.device_id)
+# --- IOF XML parsing ---
+def _iof_ns(root_tag: str) -> Optional[Dict[str, str]]:
+    ns_uri = root_tag.split('}')[0].strip('{') if '}' in root_tag else None
+    return {'iof': ns_uri} if ns_uri else None
+
+
+def _team_bib_text(team, ns) -> Optional[str]:
+    return team.findtext('iof:BibNumber', namespaces=ns) or team.get('bib') or team.get('id') or None
+
+
+def _earlier_start(current: Optional[datetime], text: Optional[str]) -> Optional[datetime]:
+    """Return the earlier of ``current`` and the <StartTime> text (blank/unparseable text is ignored)."""
+    text = (text or '').strip()
+    if text:
+        try:
+            dt = try_parse_time(text)
+            if current is None or dt < current:
+                return dt
+        except Exception:
+            pass
+    return current
+
+
+def _member_leg(member, idx: int, ns) -> int:
+    """Leg number of a <TeamMemberResult>: <Result><Leg> when present, else its position in the team."""
+    result = member.find('iof:Result', ns)
+    if result is not None:
+        leg_txt = result.findtext('iof:Leg', namespaces=ns)
+        if leg_txt:
+            try:
+                return int(leg_txt)
+            except ValueError:
+                pass
+    return idx
+
+
+def _team_result_events(team, ns, team_bib_text: Optional[str],
+                        leg_set: Optional[set[int]] = None) -> List['SimEvent']:
+    """Build the punch / status_only event records for one <TeamResult> element."""
+    events = []
+    org = team.find('iof:Organisation', ns)
+    club = org.findtext('iof:Name', namespaces=ns) or '' if org is not None else ''
+
+    if ns:
+        members = team.findall('.//iof:TeamMemberResult', ns)
+    else:
+        members = team.findall('.//TeamMemberResult')
+
+    for idx, member in enumerate(members, start=1):
+        # Resolve leg number from <Leg> element; fall back to enumerate index.
+        leg_num = _member_leg(member, idx, ns)
+        if leg_set and leg_num not in leg_set:
+            continue
+
+        person_id = None
+        person_el = member.find('iof:Person', ns)
+        if person_el is not None:
+            person_id = (
+                person_el.findtext('iof:PersonID', namespaces=ns) or
+                person_el.findtext('iof:Id', namespaces=ns) or
+                person_el.findtext('iof:ID', namespaces=ns)
+            )
+            name_el = person_el.find('iof:Name', ns)
+            runner_name = ""
+            if name_el is not None:
+                given = name_el.findtext('iof:Given', namespaces=ns) or ""
+                family = name_el.findtext('iof:Family', namespaces=ns) or ""
+                runner_name = f"{given} {family}".strip()
+        else:
+            person_id = member.get('id') or member.get('MemberID') or None
+            runner_name = None
+
+        if not person_id:
+            person_id = f"{team_bib_text or 'team'}:{idx}"
+
+        result = member.find('iof:Result', ns)
+        if result is None:
+            continue
+
+        start_time_txt = result.findtext('iof:StartTime', namespaces=ns) if ns else result.findtext('StartTime')
+        start_dt = try_parse_time(start_time_txt) if start_time_txt else None
+        if start_dt and start_dt.tzinfo is None:
+            start_dt = start_dt.replace(tzinfo=timezone.utc)
+        start_ms, tz_offset = dt_to_ms(start_dt) if start_dt else (None, 0)
+
+        status_txt = result.findtext('iof:Status', namespaces=ns)
+        runner = Runner(person_id, runner_name, club, team_bib_text, leg_num,
+                        start_ms, tz_offset, status_txt or 'OK')
+
+        split_count = 0
+        for split in result.findall('iof:SplitTime', ns):
+            code = split.findtext('iof:ControlCode', namespaces=ns)
+            time_txt = split.findtext('iof:Time', namespaces=ns)
+            if not time_txt or not code:
+                continue
+
+            ts_ms = None
+            if start_ms is not None:
+                try:
+                    ts_ms = start_ms + int(time_txt) * 1000
+                except ValueError:
+                    try:
+                        hh, mm, ss = map(int, time_txt.split(":"))
+                        delta_sec = (hh*3600 + mm*60 + ss) - (start_dt.hour*3600 + start_dt.minute*60 + start_dt.second)
+                        ts_ms = start_ms + delta_sec * 1000
+                    except Exception:
+                        ts_ms = start_ms
+
+            if ts_ms is not None:
+                split_count += 1
+                events.append(SimEvent(
+                    ts_ms, 'punch', sys.intern(code), guess_device_type(code, None), runner,
+                    tz_offset=tz_offset, status=runner.status, raw_time=sys.intern(time_txt),
+                    start_ms=start_ms))
+
+        # Runners with no split times but a non-OK status (DNS, DSQ, DNF before
+        # first control) need a synthetic marker so they enter the pipeline and
+        # get a login event + a later status update sent to Navisport.
+        if split_count == 0 and status_txt and status_txt.upper() != 'OK':
+            marker_ms, marker_tz = (start_ms, tz_offset) if start_dt else dt_to_ms(datetime.now(timezone.utc))
+            events.append(SimEvent(
+                marker_ms, 'status_only', 'status_marker', 'status_only', runner,
+                tz_offset=marker_tz, status=status_txt, start_ms=start_ms))
+    return events
+
+
+def _team_in_range(team_bib_text: Optional[str], team_range: Optional[set[int]]) -> bool:
+    # Suodata joukkueet halutun rangen mukaan
+    if team_range and team_bib_text:
+        try:
+            return int(team_bib_text) in team_range
+        except ValueError:
+            return False
+    return True
+
+
+def _iof_tags(ns: Optional[Dict[str, str]]) -> Dict[str, str]:
+    prefix = f"{{{ns['iof']}}}" if ns else ''
+    return {local: prefix + local for local in ('StartTime', 'Name', 'Class', 'TeamResult')}
+
+
+def _record_race_meta(race: 'LoadedRace', elem, tags: Dict[str, str], ns):
+    """Note a StartTime, the event Name or a Class on ``race``; other elements are ignored."""
+    tag = elem.tag
+    if tag == tags['StartTime']:
+        race.earliest_start = _earlier_start(race.earliest_start, elem.text)
+    elif tag == tags['Name']:
+        if not race.event_name and elem.text:
+            race.event_name = elem.text.strip()
+    elif tag == tags['Class']:
+        class_name = elem.findtext('iof:Name', namespaces=ns) if ns else elem.findtext('Name')
+        if class_name and class_name not in race.class_names:
+            race.class_names.append(class_name.strip())
+
+
+def iter_iof3_events(iof_path: str, team_range: Optional[set[int]] = None,
+                     team_limit: Optional[int] = None,
+                     leg_set: Optional[set[int]] = None,
+                     stats: Optional[Dict[str, int]] = None,
+                     race: Optional['LoadedRace'] = None,
+                     full_scan: bool = False):
+    """
+    Stream punch / status_only events from an IOF3 ResultList one TeamResult at a time.
+
+    Uses incremental parsing: each <TeamResult> is turned into events as soon
+    as its end tag is read and is then cleared and detached from its parent,
+    so peak memory is bounded by a single team instead of the whole document.
+    Reading stops at the first included team past ``team_limit``.
+
+    Events are yielded in document order (not sorted by timestamp), team by
+    team.  If ``stats`` is given, ``teams_seen`` / ``teams_included``
+    counters are written into it as the stream advances.  If ``race`` is
+    given, the same counters plus the event name, class names and earliest
+    <StartTime> are recorded on it; ``full_scan=True`` then reads on past the
+    team limit so that they cover the whole document.
+    """
+    if stats is None:
+        stats = {}
+    stats['teams_seen'] = 0
+    stats['teams_included'] = 0
+    ns = None
+    tags: Dict[str, str] = {}
+    stack = []
+    limit_reached = False
+    context = iofreader.iterparse(iof_path, events=('start', 'end'))
+    try:
+        for action, elem in context:
+            if action == 'start':
+                if not stack:
+                    ns = _iof_ns(elem.tag)
+                    tags = _iof_tags(ns)
+                stack.append(elem)
+                continue
+            stack.pop()
+            if elem.tag != tags['TeamResult']:
+                if race is not None:
+                    _record_race_meta(race, elem, tags, ns)
+                continue
+
+            stats['teams_seen'] += 1
+            team_events = None
+            team_bib_text = _team_bib_text(elem, ns)
+            if not limit_reached and _team_in_range(team_bib_text, team_range):
+                # Limit to first N teams (XML order, after bib filter)
+                if team_limit and stats['teams_included'] >= team_limit:
+                    limit_reached = True
+                else:
+                    stats['teams_included'] += 1
+                    team_events = _team_result_events(elem, ns, team_bib_text, leg_set)
+            if race is not None:
+                race.teams_seen, race.teams_included = stats['teams_seen'], stats['teams_included']
+            if limit_reached and not (full_scan and race is not None):
+                break
+            if team_events:
+                yield from team_events
+
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+    finally:
+        context.close()
+
+
+def parse_iof3_events(iof_path: str, team_range: Optional[set[int]] = None,
+                      team_limit: Optional[int] = None,
+                      leg_set: Optional[set[int]] = None,
+                      stream: bool = False) -> List['SimEvent']:
+    """
+    Parse all punch / status_only events from an IOF3 ResultList, sorted by timestamp.
+
+    With ``stream=True`` the document is read incrementally through
+    iter_iof3_events() instead of building the full ElementTree first.
+    """
+    if stream:
+        stats: Dict[str, int] = {}
+        events = list(iter_iof3_events(iof_path, team_range, team_limit, leg_set, stats))
+        all_teams_count = stats['teams_seen']
+        included_teams_count = stats['teams_included']
+    else:
+        root = iofreader.parse(iof_path)
+        ns = _iof_ns(root.tag)
+        events = []
+        all_teams_count = 0
+        included_teams_count = 0
+
+        for team in root.findall('.//iof:TeamResult', ns):
+            all_teams_count += 1
+            team_bib_text = _team_bib_text(team, ns)
+            if not _team_in_range(team_bib_text, team_range):
+                continue
+
+            # Limit to first N teams (XML order, after bib filter)
+            if team_limit and included_teams_count >= team_limit:
+                break
+            included_teams_count += 1
+
+            events.extend(_team_result_events(team, ns, team_bib_text, leg_set))
+
+    events.sort(key=lambda e: e.ts_ms)
+    print(f"Teams in XML: {all_teams_count}")
+    msg = f"Teams included: {included_teams_count}"
+    if team_limit:
+        msg += f" (limited to first {team_limit})"
+    print(msg)
+    return events
+
+class LoadedRace:
+    """
+    Everything the simulator needs from one IOF3 ResultList, read in a single pass.
+
+    Replaces the separate parse_iof3_events() + detect_race_from_xml() +
+    parse_mass_start_time() parses and the bib-map walk over all events.
+    """
+
+    def __init__(self, iof_path: str):
+        self.iof_path = iof_path
+        self.events: List[SimEvent] = []
+        self.event_name: str = ''
+        self.race: str = 'venla'
+        self.earliest_start: Optional[datetime] = None   # earliest <StartTime> in the document
+        self.bib_map: Dict[str, int] = {}                # runner_id → bib
+        self.class_names: List[str] = []
+        self.teams_seen = 0
+        self.teams_included = 0
+        self.legs: set = set()                           # leg numbers present in events
+        self.start_signal: Optional[datetime] = None     # --mass-start-time override (not cached)
+
+    @property
+    def leg_count(self) -> int:
+        return len(self.legs)
+
+    @property
+    def runner_count(self) -> int:
+        return len({ev.runner_id for ev in self.events})
+
+    @property
+    def mass_start_signal(self) -> datetime:
+        return self.start_signal or self.earliest_start or datetime.now(timezone.utc)
+
+    _STATE_FIELDS = ('iof_path', 'event_name', 'race', 'earliest_start', 'bib_map',
+                     'class_names', 'teams_seen', 'teams_included', 'legs')
+
+    def to_state(self) -> dict:
+        """
+        Builtins-only snapshot used by the timeline cache and parse workers.
+
+        Events are stored column-wise against a runner table, so the pickle
+        never references simulator classes (safe across ``__main__``).
+        """
+        state = {k: getattr(self, k) for k in self._STATE_FIELDS}
+        state['runners'], state['events'] = events_to_columns(self.events)
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'LoadedRace':
+        race = cls(state.get('iof_path', ''))
+        for k in cls._STATE_FIELDS:
+            if k in state:
+                setattr(race, k, state[k])
+        race.events = events_from_columns(state.get('runners', []), state.get('events', []))
+        return race
+
+    def apply_namespace(self, prefix: str, bib_offset: int = 0):
+        """
+        Make this race's runners distinct from other loaded races: runner ids
+        get ``prefix`` and team bibs are shifted by ``bib_offset``.  Navisport
+        chips are derived from the bib, so they move with it.  bib_map keeps
+        the original bibs because check-in windows are per race.
+        """
+        seen = set()
+        for ev in self.events:
+            runner = ev.runner
+            if id(runner) in seen:
+                continue
+            seen.add(id(runner))
+            runner.runner_id = f"{prefix}{runner.runner_id}"
+            if bib_offset and runner.team_id:
+                try:
+                    runner.team_id = str(int(runner.team_id) + bib_offset)
+                except ValueError:
+                    pass
+        self.bib_map = {f"{prefix}{rid}": bib for rid, bib in self.bib_map.items()}
+
+    def add_team_events(self, team_events: List[SimEvent]):
+        self.events.extend(team_events)
+        for ev in team_events:
+            self.legs.add(ev.leg)
+            rid = ev.runner_id
+            bid = ev.team_id
+            if rid and bid and rid not in self.bib_map:
+                try:
+                    self.bib_map[rid] = int(bid)
+                except (ValueError, TypeError):
+                    pass
+
+
+def load_iof_race(iof_path: str, team_range: Optional[set[int]] = None,
+                  team_limit: Optional[int] = None,
+                  leg_set: Optional[set[int]] = None,
+                  stream: bool = False,
+                  full_scan: bool = True,
+                  workers: int = 0) -> LoadedRace:
+    """
+    Read an IOF3 ResultList once and return a LoadedRace.
+
+    The document is walked a single time, collecting the event name, class
+    names, every <StartTime> (for the mass start signal) and the punch /
+    status_only events of the selected teams.  With ``stream=True`` the file
+    is read through iter_iof3_events() and each TeamResult is discarded
+    after use.
+
+    ``full_scan=False`` stops reading once ``team_limit`` teams are included;
+    earliest_start, class_names and teams_seen then only cover the part of
+    the document that was read.
+
+    ``workers > 1`` parses TeamResult blocks in a process pool and merges the
+    results; the outcome is identical to the serial path.  Combining
+    ``team_limit`` with ``team_range`` needs every bib in order, so that case
+    always runs serially, as do compressed (.xml.gz / .xml.zst) files.
+    """
+    if workers > 1 and not (team_limit and team_range) and not iofreader.compression(iof_path):
+        return _load_iof_race_parallel(iof_path, team_range, team_limit, leg_set, full_scan, workers)
+
+    race = LoadedRace(iof_path)
+    if stream:
+        race.add_team_events(list(iter_iof3_events(iof_path, team_range, team_limit, leg_set,
+                                                   race=race, full_scan=full_scan)))
+    else:
+        root = iofreader.parse(iof_path)
+        ns = _iof_ns(root.tag)
+        tags = _iof_tags(ns)
+        limit_reached = False
+        for elem in root.iter():
+            if elem.tag != tags['TeamResult']:
+                _record_race_meta(race, elem, tags, ns)
+                continue
+            race.teams_seen += 1
+            team_bib_text = _team_bib_text(elem, ns)
+            if limit_reached or not _team_in_range(team_bib_text, team_range):
+                continue
+            # Limit to first N teams (XML order, after bib filter)
+            if team_limit and race.teams_included >= team_limit:
+                limit_reached = True
+                if not full_scan:
+                    # the tree walk reaches a team before its children;
+                    # the streaming reader has seen these StartTimes already
+                    for st in elem.iter(tags['StartTime']):
+                        race.earliest_start = _earlier_start(race.earliest_start, st.text)
+                    break
+                continue
+            race.teams_included += 1
+            race.add_team_events(_team_result_events(elem, ns, team_bib_text, leg_set))
+
+    race.events.sort(key=lambda e: e.ts_ms)
+    race.race = race_type_from_name(race.event_name)
+    return race
+
+
+# --- Parallel (process pool) parsing ---
+#
+# The parent memory-maps the file and finds the byte range of every
+# <TeamResult> with a regex.  Workers re-read their ranges, wrap them in the
+# document's own root tag (so the default namespace still applies) and build
+# events exactly like the serial path.  Everything outside the team ranges
+# (Event, Class, ...) is parsed once in the parent as a "skeleton" document;
+# each of its items remembers how many teams precede it, so a load that stops
+# after the first team past --limit-teams sees the same metadata as the
+# serial reader.
+#
+# Comments, CDATA sections and processing instructions are stepped over,
+# so a commented-out TeamResult is not taken for a team.  The tag regexes
+# stay plain (a literal-prefix scan); the next opaque span is tracked
+# separately, which keeps the whole split linear in the file size.
+
+_TEAM_OPEN_RE = re.compile(rb'<(?:[\w.-]+:)?TeamResult[\s>/]')
+_TEAM_CLOSE_RE = re.compile(rb'</(?:[\w.-]+:)?TeamResult\s*>')
+_ROOT_TAG_RE = re.compile(rb'<(?![?!])[^>]*>')
+_XML_DECL_RE = re.compile(rb'^\s*<\?xml[^>]*\?>')
+_OPAQUE_OPEN_RE = re.compile(rb'<!--|<!\[CDATA\[|<\?')
+_OPAQUE_CLOSE = {b'<!--': b'-->', b'<![CDATA[': b']]>', b'<?': b'?>'}
+
+
+class _MarkupScanner:
+    """Tag search over a mapped document that skips comments, CDATA and processing instructions."""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.opaque = (0, 0)           # (start, end) of the next opaque span
+        self._next_opaque(0)
+
+    def _next_opaque(self, pos: int):
+        m = _OPAQUE_OPEN_RE.search(self.buf, pos)
+        if not m:
+            self.opaque = (len(self.buf), len(self.buf))
+            return
+        close = _OPAQUE_CLOSE[m.group(0)]
+        end = self.buf.find(close, m.end())
+        self.opaque = (m.start(), len(self.buf) if end < 0 else end + len(close))
+
+    def search(self, pattern, pos: int):
+        """Searches must move forward through the buffer."""
+        while True:
+            m = pattern.search(self.buf, pos)
+            if not m:
+                return None
+            while self.opaque[1] <= m.start() and self.opaque[1] < len(self.buf):
+                self._next_opaque(self.opaque[1])
+            if self.opaque[0] <= m.start() < self.opaque[1]:
+                pos = self.opaque[1]
+                continue
+            return m
+
+
+def _team_byte_ranges(buf) -> List[Tuple[int, int]]:
+    scanner = _MarkupScanner(buf)
+    ranges = []
+    pos = 0
+    while True:
+        m = scanner.search(_TEAM_OPEN_RE, pos)
+        if not m:
+            break
+        end = scanner.search(_TEAM_CLOSE_RE, m.end())
+        if not end:
+            break
+        ranges.append((m.start(), end.end()))
+        pos = end.end()
+    return ranges
+
+
+def _split_document(buf) -> tuple:
+    """
+    Split a mapped IOF document into its TeamResult byte ranges and the rest.
+
+    Returns ``(ranges, skeleton_parts, prolog, root_open, root_close)``.
+    ``skeleton_parts[i]`` is the text between TeamResult i-1 and i (the last
+    part follows the last team), so joined they are the document with every
+    TeamResult cut out.  The last three are what a worker needs to wrap
+    fragments back into a document.
+    """
+    ranges = _team_byte_ranges(buf)
+    skeleton_parts = []
+    pos = 0
+    for start, end in ranges:
+        skeleton_parts.append(buf[pos:start])
+        pos = end
+    skeleton_parts.append(buf[pos:])
+    head = buf[:ranges[0][0]] if ranges else buf[:]
+
+    decl = _XML_DECL_RE.match(head)
+    prolog = decl.group(0) if decl else b''
+    root_m = _MarkupScanner(head).search(_ROOT_TAG_RE, decl.end() if decl else 0)
+    root_open = root_m.group(0)
+    root_name = re.match(rb'<([^\s>/]+)', root_open).group(1)
+    root_close = b'</' + root_name + b'>'
+    return ranges, skeleton_parts, prolog, root_open, root_close
+
+
+def _skeleton_items(skeleton_parts: List[bytes]) -> List[tuple]:
+    """
+    ``(segment, kind, value)`` for the StartTime, first Name and Class names
+    of the team-less skeleton, in document order.  ``segment`` is the number
+    of TeamResults before the element, so a reader that stops after team k
+    has seen exactly the items with segment <= k.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    items = []
+    ns = None
+    have_name = False
+    for segment, part in enumerate(skeleton_parts):
+        parser.feed(part)
+        for action, elem in parser.read_events():
+            if action == 'start':
+                if ns is None:
+                    ns = _iof_ns(elem.tag)
+                continue
+            local = elem.tag.split('}')[-1]
+            if local == 'StartTime':
+                items.append((segment, 'start', elem.text))
+            elif local == 'Name' and not have_name and elem.text and elem.text.strip():
+                items.append((segment, 'name', elem.text.strip()))
+                have_name = True
+            elif local == 'Class':
+                class_name = elem.findtext('iof:Name', namespaces=ns) if ns else elem.findtext('Name')
+                if class_name:
+                    items.append((segment, 'class', class_name.strip()))
+    parser.close()
+    return items
+
+
+def _apply_skeleton(race: 'LoadedRace', items: List[tuple], last_segment: Optional[int] = None):
+    """Fill event name, class names and earliest start from skeleton items up to ``last_segment``."""
+    for segment, kind, value in items:
+        if last_segment is not None and segment > last_segment:
+            break
+        if kind == 'start':
+            race.earliest_start = _earlier_start(race.earliest_start, value)
+        elif kind == 'name':
+            if not race.event_name:
+                race.event_name = value
+        elif value not in race.class_names:
+            race.class_names.append(value)
+
+
+def _parse_team_chunk(job: tuple) -> dict:
+    """Worker: parse one chunk of TeamResult byte ranges into events (runs in a child process)."""
+    iof_path, prolog, root_open, root_close, ranges, build_flags, team_range, leg_set = job
+    parts = [prolog, root_open]
+    with open(iof_path, 'rb') as f:
+        for start, end in ranges:
+            f.seek(start)
+            parts.append(f.read(end - start))
+    parts.append(root_close)
+    root = ET.fromstring(b''.join(parts))
+    ns = _iof_ns(root.tag)
+    chunk = LoadedRace(iof_path)
+    start_tag = f"{{{ns['iof']}}}StartTime" if ns else 'StartTime'
+    for team, build in zip(list(root), build_flags):
+        chunk.teams_seen += 1
+        for st in team.iter(start_tag):
+            chunk.earliest_start = _earlier_start(chunk.earliest_start, st.text)
+        if build is False:
+            continue
+        team_bib_text = _team_bib_text(team, ns)
+        if build is None and not _team_in_range(team_bib_text, team_range):
+            continue
+        chunk.teams_included += 1
+        chunk.add_team_events(_team_result_events(team, ns, team_bib_text, leg_set))
+    chunk.events.sort(key=lambda e: e.ts_ms)
+    return chunk.to_state()
+
+
+def _load_iof_race_parallel(iof_path: str, team_range: Optional[set[int]],
+                            team_limit: Optional[int], leg_set: Optional[set[int]],
+                            full_scan: bool, workers: int) -> LoadedRace:
+    import mmap
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open(iof_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        ranges, skeleton_parts, prolog, root_open, root_close = _split_document(buf)
+
+    race = LoadedRace(iof_path)
+    last_segment = None
+
+    # build flag per team: True = include, False = scan StartTimes only,
+    # None = worker decides from team_range
+    if team_limit:
+        if not full_scan and len(ranges) > team_limit:
+            # same stopping point as the serial reader: the first team past the limit
+            ranges = ranges[:team_limit + 1]
+            last_segment = team_limit
+        build_flags = [i < team_limit for i in range(len(ranges))]
+    else:
+        build_flags = [None if team_range else True] * len(ranges)
+
+    n_chunks = max(1, min(len(ranges), workers * 4))
+    size = -(-len(ranges) // n_chunks) if ranges else 1
+    jobs = [
+        (iof_path, prolog, root_open, root_close,
+         ranges[i:i + size], build_flags[i:i + size], team_range, leg_set)
+        for i in range(0, len(ranges), size)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunks = [LoadedRace.from_state(s) for s in pool.map(_parse_team_chunk, jobs)]
+    _apply_skeleton(race, _skeleton_items(skeleton_parts), last_segment)
+
+    # Chunks are in document order and each is stably sorted, so a stable
+    # k-way merge reproduces the serial "sort by timestamp" order exactly.
+    race.events = list(heapq.merge(*(c.events for c in chunks), key=lambda e: e.ts_ms))
+    for c in chunks:
+        race.teams_seen += c.teams_seen
+        race.teams_included += c.teams_included
+        race.legs |= c.legs
+        for rid, bib in c.bib_map.items():
+            race.bib_map.setdefault(rid, bib)
+        if c.earliest_start and (race.earliest_start is None or c.earliest_start < race.earliest_start):
+            race.earliest_start = c.earliest_start
+    race.race = race_type_from_name(race.event_name)
+    return race
+
+
+# --- Compiled timeline cache ---
+#
+# A parsed LoadedRace is stored as a zlib-compressed pickle named after a hash
+# of the XML content plus the team/leg filters, so any change to the file or
+# the filters simply misses.  Hits refresh the file mtime; after each write
+# the oldest files are evicted until the directory fits in the size budget.
+# Subset loads that miss go through the TeamResult index below.
+
+TIMELINE_CACHE_VERSION = 4
+TIMELINE_CACHE_SUFFIX = '.race.z'
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'relaysimulator')
+DEFAULT_CACHE_MAX_MB = 512
+
+
+def _file_digest(path: str) -> str:
+    import hashlib
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def timeline_cache_key(iof_path: str, team_range: Optional[set[int]] = None,
+                       team_limit: Optional[int] = None,
+                       leg_set: Optional[set[int]] = None,
+                       full_scan: bool = True) -> str:
+    """Cache key: XML content hash + filter values + cache format version."""
+    import hashlib
+    filters = json.dumps({
+        'v': TIMELINE_CACHE_VERSION,
+        'team_range': sorted(team_range) if team_range else None,
+        'team_limit': team_limit,
+        'legs': sorted(leg_set) if leg_set else None,
+        'full_scan': full_scan,
+    }, sort_keys=True)
+    fhash = hashlib.blake2b(filters.encode(), digest_size=8).hexdigest()
+    return f"{_file_digest(iof_path)}-{fhash}"
+
+
+def _evict_cache(cache_dir: str, max_bytes: int):
+    """Delete least recently used cache files until the directory fits in max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith((TIMELINE_CACHE_SUFFIX, TEAM_INDEX_SUFFIX)):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def _read_cache_file(path: str):
+    import pickle
+    import zlib
+    with open(path, 'rb') as f:
+        return pickle.loads(zlib.decompress(f.read()))
+
+
+def _write_cache_file(path: str, state) -> int:
+    """Atomically write a compressed pickle; returns the stored size in bytes."""
+    import pickle
+    import zlib
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    blob = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(blob)
+    os.replace(tmp, path)
+    return len(blob)
+
+
+def load_iof_race_cached(iof_path: str, team_range: Optional[set[int]] = None,
+                         team_limit: Optional[int] = None,
+                         leg_set: Optional[set[int]] = None,
+                         stream: bool = False,
+                         full_scan: bool = True,
+                         workers: int = 0,
+                         cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                         max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024) -> LoadedRace:
+    """
+    load_iof_race() backed by the on-disk timeline cache (disabled when cache_dir is None).
+
+    On a miss, ``team_range`` / ``leg_set`` loads read only the matching teams
+    through the TeamResult index kept in the same directory.
+    """
+    if not cache_dir:
+        return load_iof_race(iof_path, team_range, team_limit, leg_set, stream, full_scan, workers)
+
+    key = timeline_cache_key(iof_path, team_range, team_limit, leg_set, full_scan)
+    path = os.path.join(cache_dir, key + TIMELINE_CACHE_SUFFIX)
+    if os.path.exists(path):
+        try:
+            state = _read_cache_file(path)
+            os.utime(path)  # LRU: mark as recently used
+            print(f"[cache] hit {os.path.basename(path)}")
+            return LoadedRace.from_state(state)
+        except Exception as e:
+            print(f"[cache] ignoring unreadable cache file {path}: {e}")
+
+    race = None
+    # byte offsets are only meaningful in an uncompressed file
+    if (team_range or leg_set) and not iofreader.compression(iof_path):
+        index = load_team_index(iof_path, cache_dir)
+        if index is not None:
+            race = load_iof_race_indexed(index, team_range, team_limit, leg_set, full_scan, workers)
+    if race is None:
+        race = load_iof_race(iof_path, team_range, team_limit, leg_set, stream, full_scan, workers)
+    try:
+        size = _write_cache_file(path, race.to_state())
+        print(f"[cache] stored {os.path.basename(path)} ({size // 1024} KiB)")
+        _evict_cache(cache_dir, max_bytes)
+    except OSError as e:
+        print(f"[cache] could not write {path}: {e}")
+    return race
+
+
+# --- TeamResult byte-offset index ---
+#
+# Built once per XML file and kept in the cache directory: the byte range,
+# bib, legs and earliest start of every <TeamResult>, plus the skeleton
+# items (event name, classes, StartTimes outside teams) and the root tag.  --team-range and
+# --legs loads use it to seek straight to the matching teams instead of
+# parsing the whole document.  An index is tied to the file's absolute path,
+# size and mtime; any change rebuilds it.
+
+TEAM_INDEX_VERSION = 3
+TEAM_INDEX_SUFFIX = '.idx.z'
+TEAM_INDEX_BATCH = 500          # TeamResults per fragment document when building / loading
+
+
+class TeamIndex:
+    """Byte offsets and per-team summaries of the TeamResults in one IOF3 file."""
+
+    _STATE_FIELDS = ('iof_path', 'size', 'mtime_ns', 'prolog', 'root_open', 'root_close',
+                     'skeleton', 'teams')
+
+    def __init__(self, iof_path: str):
+        self.iof_path = iof_path
+        self.size = 0
+        self.mtime_ns = 0
+        self.prolog = b''
+        self.root_open = b''
+        self.root_close = b''
+        self.skeleton: List[tuple] = []   # _skeleton_items() of the document
+        # (start, end, bib_text, legs, earliest_start) per team, in document order
+        self.teams: List[tuple] = []
+
+    def is_current(self) -> bool:
+        try:
+            st = os.stat(self.iof_path)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+    def to_state(self) -> dict:
+        state = {k: getattr(self, k) for k in self._STATE_FIELDS}
+        state['v'] = TEAM_INDEX_VERSION
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'TeamIndex':
+        index = cls(state.get('iof_path', ''))
+        for k in cls._STATE_FIELDS:
+            if k in state:
+                setattr(index, k, state[k])
+        return index
+
+
+def _team_index_entry(team, ns, start: int, end: int) -> tuple:
+    if ns:
+        members = team.findall('.//iof:TeamMemberResult', ns)
+        start_tag = f"{{{ns['iof']}}}StartTime"
+    else:
+        members = team.findall('.//TeamMemberResult')
+        start_tag = 'StartTime'
+    legs = tuple(sorted({_member_leg(m, idx, ns) for idx, m in enumerate(members, start=1)}))
+    team_start = None
+    for st in team.iter(start_tag):
+        team_start = _earlier_start(team_start, st.text)
+    return (start, end, _team_bib_text(team, ns), legs, team_start)
+
+
+def build_team_index(iof_path: str) -> TeamIndex:
+    """Scan an IOF3 file once and return its TeamIndex."""
+    import mmap
+
+    index = TeamIndex(os.path.abspath(iof_path))
+    st = os.stat(iof_path)
+    index.size, index.mtime_ns = st.st_size, st.st_mtime_ns
+
+    with open(iof_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        ranges, skeleton_parts, index.prolog, index.root_open, index.root_close = _split_document(buf)
+        index.skeleton = _skeleton_items(skeleton_parts)
+
+        for i in range(0, len(ranges), TEAM_INDEX_BATCH):
+            batch = ranges[i:i + TEAM_INDEX_BATCH]
+            doc = b''.join([index.prolog, index.root_open,
+                            *(buf[s:e] for s, e in batch), index.root_close])
+            root = ET.fromstring(doc)
+            ns = _iof_ns(root.tag)
+            for (start, end), team in zip(batch, list(root)):
+                index.teams.append(_team_index_entry(team, ns, start, end))
+    return index
+
+
+def load_team_index(iof_path: str, cache_dir: str) -> Optional[TeamIndex]:
+    """Return the TeamIndex for iof_path from cache_dir, building and storing it if missing or stale."""
+    import hashlib
+    name = hashlib.blake2b(os.path.abspath(iof_path).encode(), digest_size=16).hexdigest()
+    path = os.path.join(cache_dir, name + TEAM_INDEX_SUFFIX)
+    if os.path.exists(path):
+        try:
+            state = _read_cache_file(path)
+            if state.get('v') == TEAM_INDEX_VERSION:
+                index = TeamIndex.from_state(state)
+                if index.is_current():
+                    os.utime(path)
+                    return index
+        except Exception as e:
+            print(f"[index] ignoring unreadable index {path}: {e}")
+
+    t0 = time.time()
+    try:
+        index = build_team_index(iof_path)
+    except Exception as e:
+        print(f"[index] could not index {iof_path}: {e} — reading the whole file")
+        return None
+    try:
+        size = _write_cache_file(path, index.to_state())
+        print(f"[index] built {os.path.basename(path)} for {len(index.teams)} teams "
+              f"({size // 1024} KiB, {time.time() - t0:.1f}s)")
+    except OSError as e:
+        print(f"[index] could not write {path}: {e}")
+    return index
+
+
+def load_iof_race_indexed(index: TeamIndex, team_range: Optional[set[int]] = None,
+                          team_limit: Optional[int] = None,
+                          leg_set: Optional[set[int]] = None,
+                          full_scan: bool = True,
+                          workers: int = 0) -> LoadedRace:
+    """
+    load_iof_race() through a TeamIndex: only the selected TeamResults are read.
+
+    Team selection (bib range, XML-order limit, teams_seen/teams_included
+    counts) follows the serial reader; teams without any leg in ``leg_set``
+    are counted but never read.  Event name, classes and StartTimes outside
+    the teams come from the index's skeleton items, cut at the same team as
+    the serial reader when ``full_scan=False``.
+    """
+
+    race = LoadedRace(index.iof_path)
+
+    selected = []
+    limit_reached = False
+    last_segment = None
+    for pos, (start, end, bib_text, legs, team_start) in enumerate(index.teams):
+        race.teams_seen += 1
+        if team_start and (race.earliest_start is None or team_start < race.earliest_start):
+            race.earliest_start = team_start
+        if limit_reached or not _team_in_range(bib_text, team_range):
+            continue
+        # Limit to first N teams (XML order, after bib filter)
+        if team_limit and race.teams_included >= team_limit:
+            limit_reached = True
+            if not full_scan:
+                last_segment = pos
+                break
+            continue
+        race.teams_included += 1
+        if not leg_set or leg_set.intersection(legs):
+            selected.append((start, end))
+    _apply_skeleton(race, index.skeleton, last_segment)
+
+    jobs = [
+        (index.iof_path, index.prolog, index.root_open, index.root_close,
+         selected[i:i + TEAM_INDEX_BATCH], [True] * len(selected[i:i + TEAM_INDEX_BATCH]),
+         None, leg_set)
+        for i in range(0, len(selected), TEAM_INDEX_BATCH)
+    ]
+    if workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            states = list(pool.map(_parse_team_chunk, jobs))
+    else:
+        states = [_parse_team_chunk(job) for job in jobs]
+    chunks = [LoadedRace.from_state(s) for s in states]
+
+    race.events = list(heapq.merge(*(c.events for c in chunks), key=lambda e: e.ts_ms))
+    for c in chunks:
+        race.legs |= c.legs
+        for rid, bib in c.bib_map.items():
+            race.bib_map.setdefault(rid, bib)
+    race.race = race_type_from_name(race.event_name)
+    print(f"[index] read {len(selected)} of {len(index.teams)} teams")
+    return race
+
+
+def try_parse_time(t: str) -> datetime:
+    # Yritetään useita formaatteja; lisää tarvittaessa 2025-06-14T23:00:00+03:00
+    fmts = ["%Y-%m-%dT%H:%M:%S%z"]
+    for f in fmts:
+        try:
+            dt = datetime.strptime(t, f)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return dt
+        except Exception:
+            pass
+    # fallback: nykyhetki UTC
+    return datetime.now(timezone.utc)
+
+def guess_device_type(control: str, status: str) -> str:
+    # Yksinkertainen heuristiikka;
+    if control is None:
+        return 'unknown'
+    c = control.lower()
+    if 'start' in c or c.startswith('s'):
+        return 'login'
+    if 'mass_start ' in c :
+        return 'mass_start'
+    if 'finish' in c or 'maali' in c or 'f' == c:
+        return 'finish'
+    if 'exchange' in c or 'vaihto' in c:
+        return 'exchange'
+    # oletuksena väliaikarasti
+    return 'split'
+
+# --- Simulator core: schedule and send events with speed factor ---
+async def load_allowed_controls(file_path: str = None, url: str = None) -> set:
+    controls = set()
+
+    # Lue paikallinen tiedosto (JSON-lista käytä avuksi jukola_split_controls.html )
+    if file_path and os.path.exists(file_path):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+                try:
+                    data = json.loads(text)
+                    if isinstance(data, list):
+                        for item in data:
+                            if item is not None:
+                                controls.add(str(item).strip().lower())
+                    else:
+                        print(f"Warning: controls file {file_path} does not contain a JSON list")
+                except json.JSONDecodeError:
+                    # Fallback: rivikohtainen lista (kuten alkuperäisessä)
+                    f.seek(0)
+                    for ln in f:
+                        code = ln.strip()
+                        if code:
+                            controls.add(code.lower())
+        except Exception as e:
+            print(f"Warning: could not read controls file {file_path}: {e}")
+
+    # Hae URLista (odotetaan JSON-listaa) # tämä tulis varmaan suoraa navisportista
+    if url:
+        try:
+            async with aiohttp.ClientSession() as sess:
+                async with sess.get(url, timeout=10) as resp:
+                    if resp.status == 200:
+                        try:
+                            data = await resp.json()
+                        except Exception:
+                            text = await resp.text()
+                            try:
+                                data = json.loads(text)
+                            except Exception:
+                                data = None
+                        if isinstance(data, list):
+                            for item in data:
+                                if item is not None:
+                                    controls.add(str(item).strip().lower())
+                        else:
+                            print(f"Warning: controls URL did not return a JSON list")
+                    else:
+                        print(f"Warning: controls URL returned status {resp.status}")
+        except Exception as e:
+            print(f"Warning: could not fetch controls from {url}: {e}")
+
+    return controls
+
+
+
+def normalize(c):
+    return None if c is None else str(c).strip().lower()
+
+def control_allowed(control, allowed_controls:set):
+    if not allowed_controls:
+        return True
+    nc = normalize(control)
+    return nc in allowed_controls
+
+# globaali sanakirja laitteiden tiloille ja viestimäärille
+device_status = {}
+device_order = []  # järjestys, jossa laitteet tulostetaan
+device_msg_count = {}
+
+def update_dashboard(device_id):
+    """Päivittää vain yhden laitteen rivin konsolissa."""
+    idx = device_order.index(device_id)
+    # siirrä kursori oikealle riville
+    sys.stdout.write(f"\033[{len(device_order) - idx}F")  # siirrytään ylös rivien mukaan
+    sys.stdout.write("\033[K")  # tyhjennä rivi
+    count = device_msg_count.get(device_id, 0)
+    status = device_status.get(device_id, "pending")
+    print(f"{device_id:14}: {status:20} sent: {count}")
+    # siirry takaisin konsolin loppuun
+    sys.stdout.write(f"\033[{len(device_order) - idx}E")
+    sys.stdout.flush()
+
+
+# Each device connection buffers at most DEVICE_QUEUE_MAX batches; when the
+# socket cannot keep up, send_many() blocks and the dispatcher stops pulling
+# new events (backpressure).  DEVICE_SEND_PAUSE paces writes per device.
+DEVICE_QUEUE_MAX = 4
+DEVICE_SEND_PAUSE = 0.05
+
+
+class SinkMeter:
+    """Counts delivered events and the wall-time span they were delivered in."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def record(self, n: int = 1):
+        t = time.monotonic()
+        if self.first is None:
+            self.first = t
+        self.last = t
+        self.count += n
+
+    def to_state(self) -> dict:
+        """Counters with first/last as epoch seconds, comparable between hosts."""
+        to_wall = time.time() - time.monotonic()
+        return {'name': self.name, 'count': self.count,
+                'first': None if self.first is None else self.first + to_wall,
+                'last': None if self.last is None else self.last + to_wall}
+
+    @classmethod
+    def from_state(cls, state: dict, clock_offset: float = 0.0) -> 'SinkMeter':
+        """Meter from to_state(); ``clock_offset`` (s) is subtracted from its times."""
+        meter = cls(state['name'])
+        meter.count = state['count']
+        if state['first'] is not None:
+            meter.first = state['first'] - clock_offset
+            meter.last = state['last'] - clock_offset
+        return meter
+
+    def merge(self, other: 'SinkMeter'):
+        """Add another process's meter (time.monotonic() is system-wide)."""
+        if not other.count:
+            return
+        self.first = other.first if self.first is None else min(self.first, other.first)
+        self.last = other.last if self.last is None else max(self.last, other.last)
+        self.count += other.count
+
+    def report(self) -> Optional[str]:
+        if not self.count:
+            return None
+        span = self.last - self.first
+        rate = f"{self.count / span:.0f} events/s" if span > 0 else "n/a"
+        return f"[throughput] {self.name}: {self.count} events in {span:.2f}s = {rate}"
+
+
+class DeviceClient:
+    def __init__(self, device_id, host, port, meter: Optional[SinkMeter] = None,
+                 pause: float = DEVICE_SEND_PAUSE):
+        self.device_id = device_id
+        self.host = host
+        self.port = port
+        self.ws = None
+        self.queue = asyncio.Queue(maxsize=DEVICE_QUEUE_MAX)
+        self.unsent = 0                    # batches queued and not yet written
+        self.sender_task = None
+        self.sent_count = 0
+        self.meter = meter
+        self.pause = pause
+        # concurrent batches for a new device must share one handshake
+        self._connect_lock = asyncio.Lock()
+
+        if device_id not in device_order:
+            device_order.append(device_id)
+            device_status[device_id] = "pending"
+            device_msg_count[device_id] = 0
+            # tulostetaan aloitusdashboard
+            print(f"{device_id:10}: {device_status[device_id]:20} sent: 0")
+
+    async def connect(self):
+        async with self._connect_lock:
+            if not self.ws:
+                try:
+                    self.ws = await websockets.connect(f"ws://{self.host}:{self.port}/sim")
+                    device_status[self.device_id] = "connected"
+                    update_dashboard(self.device_id)
+                except Exception as e:
+                    device_status[self.device_id] = "connect error"
+                    update_dashboard(self.device_id)
+                    print(f"[{self.device_id}] connect error: {e}")
+                    self.ws = None
+
+            if self.ws and not self.sender_task:
+                self.sender_task = asyncio.create_task(self._sender())
+
+    async def _reconnect(self):
+        for delay in [1, 2, 5]:
+            try:
+                self.ws = await websockets.connect(f"ws://{self.host}:{self.port}/sim")
+                device_status[self.device_id] = "reconnected"
+                update_dashboard(self.device_id)
+                return
+            except Exception as e:
+                device_status[self.device_id] = "reconnecting"
+                update_dashboard(self.device_id)
+                print(f"[{self.device_id}] reconnect failed: {e}")
+                await asyncio.sleep(delay)
+        self.ws = None
+        device_status[self.device_id] = "conn failed"
+        update_dashboard(self.device_id)
 
     async def _sender(self):
+        # Each queue item is a list of messages (one dispatcher batch); the
+        # batch is written back to back and the dashboard updated once.
         while True:
-            msg = await self.queue.get()
-            if msg is None:
+            batch = await self.queue.get()
+            if batch is None:
+                break
+            pending = list(batch)
+            for _ in range(3):
+                try:
+                    while pending:
+                        await self.ws.send(pending[0])
+                        pending.pop(0)
+                        self.sent_count += 1
+                        if self.meter:
+                            self.meter.record()
+                    device_msg_count[self.device_id] = self.sent_count
+                    device_status[self.device_id] = "sent"
+                    update_dashboard(self.device_id)
+                    if self.pause:
+                        await asyncio.sleep(self.pause)
+                    break
+                except Exception:
+                    device_status[self.device_id] = "send error"
+                    update_dashboard(self.device_id)
+                    self.ws = None
+                    await self._reconnect()
+                    if not self.ws:
+                        break
+            self.unsent -= 1
+            self.queue.task_done()
+        if self.ws:
+            await self.ws.close()
+        self.ws = None
+        device_status[self.device_id] = "disconnected"
+        update_dashboard(self.device_id)
+
+    async def send(self, message: str):
+        await self.send_many([message])
+
+    async def send_many(self, messages: List[str]):
+        if not self.ws:
+            await self.connect()
+            if not self.ws:
+                return
+        self.unsent += 1
+        await self.queue.put(messages)
+
+    async def flush(self):
+        """Wait until every queued batch has been written (or given up on)."""
+        if self.unsent:
+            await self.queue.join()
+
+    async def close(self):
+        if self.sender_task:
+            await self.queue.put(None)
+            await self.sender_task
+        if self.ws:
+            await self.ws.close()
+        self.ws = None
+        device_status[self.device_id] = "closed"
+        update_dashboard(self.device_id)
+
+
+class EventSink:
+    """
+    Delivers timeline events to the WebSocket relay (one DeviceClient per
+    device id) and, when configured, to Navisport.
+
+    ``send()`` takes the wall-clock epoch ms the event is sent at and the
+    shift applied to the whole timeline (used for the purku punch times).
+    """
+
+    def __init__(self, host: str, port: int, one_conn_per_device: bool = True,
+                 allowed_controls: Optional[set] = None,
+                 finish_control: Optional[str] = None,
+                 navisport_sender: Optional['NavisportSender'] = None,
+                 no_ws: bool = False,
+                 device_pause: float = DEVICE_SEND_PAUSE,
+                 clock: Optional[WallClock] = None):
+        self.host = host
+        self.port = port
+        self.clock = clock or WALL_CLOCK
+        self.one_conn_per_device = one_conn_per_device
+        self.allowed_controls = allowed_controls or set()
+        self.finish_control = finish_control
+        self.navisport_sender = navisport_sender
+        self.no_ws = no_ws
+        self.device_pause = device_pause
+        self.device_clients: Dict[str, DeviceClient] = {}
+        self.meters = {'ws': SinkMeter('ws'), 'navisport': SinkMeter('navisport')}
+
+    async def start(self):
+        if self.navisport_sender:
+            await self.navisport_sender.connect()
+
+    def accepts(self, event: SimEvent) -> bool:
+        return not (event.event == 'punch'
+                    and not control_allowed(event.device_id, self.allowed_controls))
+
+    def display_id(self, event: SimEvent) -> str:
+        if self.finish_control and str(event.device_id) == str(self.finish_control):
+            return "maali_1"
+        return event.device_id or f"dev_{event.device_type}"
+
+    async def send(self, event: SimEvent, sent_ms: int, shift: int = 0):
+        await self.send_batch([(event, sent_ms)], shift)
+
+    async def send_batch(self, batch: List[Tuple[SimEvent, int]], shift: int = 0):
+        """
+        Send (event, sent_ms) pairs due in the same dispatcher tick: messages
+        are grouped per device connection and Navisport gets the whole batch
+        in one call.  Order is preserved within each device and for Navisport.
+        """
+        if not self.no_ws:
+            per_client: Dict[str, List[str]] = {}
+            for event, sent_ms in batch:
+                display_id, msg_obj = self.message(event, sent_ms, shift)
+                key = display_id if self.one_conn_per_device else f"{display_id}_{self.clock.now_ms() % 1000000}"
+                per_client.setdefault(key, []).append(make_message(msg_obj))
+            for key, messages in per_client.items():
+                if key not in self.device_clients:
+                    self.device_clients[key] = DeviceClient(key, self.host, self.port,
+                                                            self.meters['ws'], self.device_pause)
+                    await self.device_clients[key].connect()
+                await self.device_clients[key].send_many(messages)
+
+        if self.navisport_sender:
+            await self.navisport_sender.on_events(batch)
+            self.meters['navisport'].record(len(batch))
+
+    def message(self, event: SimEvent, sent_ms: int, shift: int = 0) -> Tuple[str, Dict[str, Any]]:
+        """(display device id, relay message) for one event."""
+        display_id = self.display_id(event)
+        tz_offset = event.tz_offset
+        sent_ts = ms_to_iso(sent_ms, tz_offset)
+        msg_obj = {
+            'device_id': display_id,
+            'device_type': event.device_type,
+            'runner_id': event.runner_id,
+            'event': event.event,
+            'timestamp': sent_ts
+        }
+
+        if event.event == 'login':
+            msg_obj.update({'login_time': sent_ts, 'note': event.note})
+        elif event.event == 'results_purku':
+            shifted_punches = [{
+                'control': p.device_id,
+                'time': ms_to_iso(p.ts_ms + shift, tz_offset),
+                'status': p.status,
+                'device_type': p.device_type,
+            } for p in (event.punches or [])]
+            msg_obj.update({'purku_time': sent_ts, 'punches': shifted_punches, 'note': event.note})
+        elif event.event == 'itkumuuri':
+            msg_obj.update({'status': event.status, 'note': event.note})
+        return display_id, msg_obj
+
+    async def flush(self):
+        """Wait for the WebSocket device queues to drain (Navisport sends complete in send_batch)."""
+        for client in self.device_clients.values():
+            await client.flush()
+
+    async def close(self):
+        await asyncio.gather(*(c.close() for c in self.device_clients.values()))
+        if self.navisport_sender:
+            await self.navisport_sender.close()
+
+
+# --- Derived events (purku, itkumuuri, manual_ok, status_update) ---
+#
+# A runner's follow-up events depend only on that runner's own punches.  The
+# random delays and devices are drawn while the timeline is built, in runner
+# order, so the random sequence does not depend on how far the dispatcher
+# has read.  The SimEvents themselves are created only when the merge
+# reaches the runner's last punch; until then a runner costs a few small
+# spec tuples.
+
+def plan_derived_events(evs_sorted: List[Tuple[int, SimEvent]]) -> List[tuple]:
+    """
+    Draw the follow-up events of one runner (punches sorted by time) as
+    (event, ts, device, minutes) specs; see derived_events().
+    """
+    plan = []
+    first_ev = evs_sorted[0][1]
+    iof_runner_status = first_ev.status or ''
+
+    if any(e.event == 'punch' for _, e in evs_sorted):
+        # --- purku (chip dump after finish) ---
+        minutes_after = random.randint(10, 15)
+        purku_ts = evs_sorted[-1][0] + minutes_after * 60000
+        plan.append(('results_purku', purku_ts, random.choice(PURKU_DEVICES), minutes_after))
+
+        # OK runners: hylkäysesitys → itkumuuri → manual_ok
+        # Purku may detect missing punches and set a temporary Dnf
+        # (hylkäysesitys). The runner appeals at itkumuuri where
+        # officials verify the backup paper and approve the result.
+        if iof_runner_status.upper() == 'OK':
+            itkumuuri_delay = random.randint(5, 15)
+            itkumuuri_ts = purku_ts + itkumuuri_delay * 60000
+            plan.append(('hylkaysesitys', itkumuuri_ts, random.choice(ITKUMUURI_DEVICES), itkumuuri_delay))
+            ok_extra = random.randint(5, 45)
+            plan.append(('manual_ok', itkumuuri_ts + ok_extra * 60000, 'officials',
+                         itkumuuri_delay + ok_extra))
+    else:
+        # --- status_update for DNS/DNF/DSQ runners with no chip data ---
+        # Fire shortly after their scheduled start time so Navisport reflects
+        # the correct status without waiting for a chip download.
+        delay_min = random.randint(5, 20)
+        plan.append(('status_update', evs_sorted[0][0] + delay_min * 60000, 'officials', delay_min))
+
+    # itkumuuri for DNF/DSQ runners — OK runners handled above,
+    # DNS runners do not appeal
+    if (iof_runner_status
+            and iof_runner_status.upper() not in ('OK', 'FINISHED', 'DIDNOTSTART')):
+        itkumuuri_delay = random.randint(5, 60)
+        plan.append(('itkumuuri', evs_sorted[-1][0] + itkumuuri_delay * 60000,
+                     random.choice(ITKUMUURI_DEVICES), itkumuuri_delay))
+    return plan
+
+
+def derived_events(evs_sorted: List[Tuple[int, SimEvent]],
+                   plan: List[tuple]) -> List[Tuple[int, SimEvent]]:
+    """Build the SimEvents of a plan from plan_derived_events()."""
+    first_ev = evs_sorted[0][1]
+    rec = first_ev.runner
+    tz_offset = first_ev.tz_offset
+    iof_runner_status = first_ev.status or ''
+    out = []
+    for kind, ts, device, minutes in plan:
+        if kind == 'results_purku':
+            punches_dump = [e for _, e in evs_sorted if e.event == 'punch']
+            ev = SimEvent(ts, 'results_purku', device, 'results_purku', rec,
+                          tz_offset=tz_offset, punches=punches_dump,
+                          note=f'purku {minutes}min after last punch')
+        elif kind == 'hylkaysesitys':
+            ev = SimEvent(ts, 'itkumuuri', device, 'itkumuuri', rec,
+                          tz_offset=tz_offset, status='Ok',
+                          note=f'hylkäysesitys → itkumuuri {minutes}min after purku')
+        elif kind == 'manual_ok':
+            ev = SimEvent(ts, 'manual_ok', device, 'manual_ok', rec,
+                          tz_offset=tz_offset,
+                          note=(f'manual OK {minutes}min after purku '
+                                f'(paper approved at itkumuuri)'))
+        elif kind == 'status_update':
+            ev = SimEvent(ts, 'status_update', device, 'status_update', rec,
+                          tz_offset=tz_offset,
+                          note=f'status update {minutes}min after start (no chip data, status={iof_runner_status})')
+        else:
+            ev = SimEvent(ts, 'itkumuuri', device, 'itkumuuri', rec,
+                          tz_offset=tz_offset, status=iof_runner_status,
+                          note=f'itkumuuri {minutes}min after last event (status={iof_runner_status})')
+        out.append((ts, ev))
+    return out
+
+
+def runner_stream(published: List[Tuple[int, SimEvent]],
+                  evs_sorted: List[Tuple[int, SimEvent]],
+                  plan: List[tuple]) -> Iterator[Tuple[int, SimEvent]]:
+    """
+    One runner's ordered timeline: the published punches, then the derived
+    events, which all fall after the last punch.
+    """
+    yield from sorted(published, key=timeline_sort_key)
+    if plan:
+        yield from sorted(derived_events(evs_sorted, plan), key=timeline_sort_key)
+
+
+def expand_race_events(loaded: 'LoadedRace', cutoff_ms: int,
+                       finish_control: Optional[str], login_cfg: dict, login_only: bool,
+                       mass_start_ms: int, mass_start_tz: int = 0) -> Tuple[list, list]:
+    """
+    Steps 3-4 for one race: (logins in arrival order, ordered per-runner
+    streams of punches and derived events) for the events at or after
+    ``cutoff_ms``.  Logins are not yet through the queue simulation.
+    """
+    filtered = [(ev.ts_ms, ev) for ev in loaded.events if ev.ts_ms >= cutoff_ms]
+    bib_map = loaded.bib_map
+
+    # --- 3. Punchit juoksijoittain ---
+    all_by_runner: Dict[str, List[Tuple[int, SimEvent]]] = {}
+    for ts, ev in filtered:
+        if ev.event not in ('punch', 'status_only'):
+            continue
+        if finish_control and ev.event == 'punch' and str(ev.device_id) == str(finish_control):
+            ev.device_type = 'finish'
+        runner = ev.runner_id or ev.runner_name or 'unknown'
+        all_by_runner.setdefault(runner, []).append((ts, ev))
+
+    # Only real punch events are published to the WebSocket relay
+    published_by_runner: Dict[str, List[Tuple[int, SimEvent]]] = {}
+    for runner, punches in all_by_runner.items():
+        real = [(ts, e) for ts, e in punches if e.event == 'punch']
+        if real:
+            published_by_runner[runner] = real
+
+    # --- 4. Extra eventit ---
+    # login — bib-based + non-first-leg staging, with queue simulation config
+    logins = assign_checkin_events(all_by_runner, mass_start_ms,
+                                   bib_map or {}, login_cfg,
+                                   mass_start_tz=mass_start_tz)
+    logins.sort(key=timeline_sort_key)
+
+    # dump, status updates, itkumuuri — drawn now, built when the merge gets there
+    streams: List[Iterator[Tuple[int, SimEvent]]] = []
+    if not login_only:
+        for runner, punches in all_by_runner.items():
+            if not punches:
+                continue
+            evs_sorted = sorted(punches, key=lambda x: x[0])
+            plan = plan_derived_events(evs_sorted)
+            streams.append(runner_stream(published_by_runner.get(runner, []), evs_sorted, plan))
+    return logins, streams
+
+
+def queue_logins(logins: Iterator[Tuple[int, SimEvent]], login_cfg: dict,
+                 label: str = '') -> Iterator[Tuple[int, SimEvent]]:
+    """
+    Step 5: run logins (in arrival order) through the check-in queue and
+    yield them in timeline order; the queue report is printed at the end.
+    """
+    # Walk through login events chronologically and compute the actual
+    # check-in time given a limited pool of devices and processing_seconds
+    # per runner; see LoginQueue for the breakdown model.
+    _proc_sec = login_cfg.get('processing_seconds', 20)
+    _broken_prob = login_cfg.get('broken_reader_probability', 0.0)
+    if not (_proc_sec > 0 or _broken_prob > 0):
+        yield from logins
+        return
+
+    queue = LoginQueue(login_cfg.get('device_count', 10), _proc_sec, _broken_prob,
+                       login_cfg.get('broken_reader_extra_delay_seconds', 60),
+                       login_cfg.get('broken_reader_downtime_seconds', 300))
+    tz_offset = 0
+    group: List[Tuple[int, SimEvent]] = []
+    for ts, ev in logins:
+        if group and ts != group[0][0]:
+            # The arrival time stays the timeline key; only the device ids
+            # changed, so re-sorting each arrival instant is enough
+            group.sort(key=timeline_sort_key)
+            yield from group
+            group = []
+        dev, _, checkout_ts, note_parts = queue.check_in(ts)
+        ev.device_id = dev
+        ev.ts_ms = checkout_ts
+        tz_offset = ev.tz_offset
+        if note_parts:
+            ev.note = (ev.note or '') + ' | ' + ' '.join(note_parts)
+        group.append((ts, ev))
+    group.sort(key=timeline_sort_key)
+    yield from group
+
+    for line in queue.report(label, tz_offset):
+        print(line)
+
+
+def build_race_timeline(loaded: 'LoadedRace', cutoff_ms: int,
+                        finish_control: Optional[str] = None,
+                        login_config: Optional[dict] = None,
+                        login_only: bool = False) -> Iterator[Tuple[int, SimEvent]]:
+    """
+    Expand one race's punches into the full (epoch_ms, SimEvent) timeline.
+
+    Adds check-in logins (with the login queue simulation), purku,
+    itkumuuri, manual_ok and status_update events for the events at or
+    after ``cutoff_ms``.  The result is a lazy merge of one ordered stream
+    per runner and one for the logins, ordered by timestamp, ties broken by
+    event_sort_key(), so several races can be merged with heapq.merge().
+    """
+    if not any(ev.ts_ms >= cutoff_ms for ev in loaded.events):
+        return iter(())
+    mass_start_signal = loaded.start_signal or loaded.earliest_start
+    if mass_start_signal is not None:
+        mass_start_ms, mass_start_tz = dt_to_ms(mass_start_signal)
+    else:
+        first = min(loaded.events, key=lambda e: e.ts_ms)
+        mass_start_ms, mass_start_tz = first.ts_ms, first.tz_offset
+    login_cfg = login_config_for_race(login_config or {}, loaded.race)
+    logins, streams = expand_race_events(loaded, cutoff_ms, finish_control, login_cfg,
+                                         login_only, mass_start_ms, mass_start_tz)
+
+    # --- 5. Login queue simulation ---
+    logins = list(queue_logins(logins, login_cfg, loaded.event_name or loaded.race))
+
+    # --- 6. Yhdistä ja järjestä ---
+    # Every stream is already ordered and the runner streams keep their
+    # original order, so ties come out as a stable sort of the whole
+    # timeline would give them.
+    return heapq.merge(logins, *streams, key=timeline_sort_key)
+
+
+# --- Dispatcher ---
+#
+# One coroutine drives the whole replay.  Events are pulled lazily from the
+# ordered timeline into a small priority queue keyed by due time; the
+# dispatcher sleeps until the head of the queue is due and hands it to the
+# sink as a send task.  The number of live coroutines is bounded by the sends
+# in flight instead of the length of the timeline.
+#
+# Deadlines are absolute clock.time() values (the event loop's clock, or a
+# virtual one, see "Clocks") derived from one clock reading taken at
+# simulation start, so congestion delays individual sends but never
+# accumulates.  How late each send actually went out is recorded per event
+# type and printed at the end of the run.
+#
+# Everything due within one tick (default 5 ms of wall time) of the head is
+# sent as one batch, so a mass start or a busy exchange costs one task, one
+# queue put per device and one Navisport executor hop instead of hundreds.
+#
+# The race-time → clock.time() mapping is a single anchor point plus the
+# speed.  Pause, resume, speed changes and seeking only move the anchor, so
+# every queued deadline is re-timed at once without touching the queue.
+#
+# ``--speed max`` (speed = math.inf) makes every deadline due at once: events
+# go out in timeline order as fast as the sinks take them.  Memory stays
+# flat because sends in flight and device queues are bounded and the
+# dispatcher waits on them before pulling more of the timeline.
+#
+# With ``--compress-gaps N:M`` the dispatcher schedules on "play time"
+# instead of timeline time: every quiet stretch longer than N seconds (the
+# wait for the mass start, the small hours when few teams are left) is
+# squeezed to M seconds, everything else keeps its spacing.  Only the
+# schedule changes — events still go out with their original timestamps
+# plus the start shift, so split times, purku punch lists and Navisport
+# elapsed times stay consistent.
+
+DISPATCH_LOOKAHEAD = 1024      # timeline items held in the queue ahead of the clock
+DISPATCH_MAX_IN_FLIGHT = 256   # concurrent sink.send_batch() tasks before the dispatcher waits
+DISPATCH_MAX_IN_FLIGHT_EVENTS = 4096   # ... or events in those tasks
+DISPATCH_TICK_MS = 5.0         # events due within this much wall time go out as one batch
+DISPATCH_MAX_BATCH = 512       # batch size cap (matters at very high --speed)
+
+
+class LogHistogram:
+    """
+    Log-linear histogram of non-negative integers: exact below 16, then 8
+    buckets per power of two (at most ~12% relative error).  Max is exact.
+    """
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.n = 0
+        self.max = 0
+
+    @staticmethod
+    def _bucket(value: int) -> int:
+        if value < 16:
+            return value
+        e = value.bit_length() - 4
+        return (e << 3) + (value >> e)
+
+    @staticmethod
+    def _upper(bucket: int) -> int:
+        if bucket < 16:
+            return bucket
+        e = (bucket >> 3) - 1
+        return (((bucket & 7) + 9) << e) - 1
+
+    def add(self, value: int):
+        value = max(0, value)
+        b = self._bucket(value)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.n += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'LogHistogram'):
+        for b, c in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + c
+        self.n += other.n
+        self.max = max(self.max, other.max)
+
+    def to_state(self) -> dict:
+        return {'counts': sorted(self.counts.items()), 'n': self.n, 'max': self.max}
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'LogHistogram':
+        hist = cls()
+        hist.counts = {int(b): c for b, c in state['counts']}
+        hist.n = state['n']
+        hist.max = state['max']
+        return hist
+
+    def percentile(self, q: float) -> int:
+        """Upper bound of the q-quantile (0..1)."""
+        if not self.n:
+            return 0
+        need = q * self.n
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= need:
+                return min(self._upper(b), self.max)
+        return self.max
+
+
+class GapCompressor:
+    """
+    Monotonic timeline ms → play ms mapping that shortens every gap between
+    consecutive timeline items longer than ``gap_ms`` to ``keep_ms``.
+
+    Built on the fly from the ordered timeline with observe().  The mapping
+    is linear inside a compressed gap and has slope 1 elsewhere, so it can
+    be inverted (to_timeline) for seeking and status.
+    """
+
+    def __init__(self, gap_ms: int, keep_ms: int):
+        self.gap_ms = gap_ms
+        self.keep_ms = keep_ms
+        # Gap k spans points [2k, 2k+1]: its start and end in timeline ms and play ms
+        self.points_ts: List[int] = []
+        self.points_play: List[int] = []
+        self.last_ts: Optional[int] = None
+        self.removed = 0                   # timeline ms cut out so far
+        self.frozen = False                # True: the mapping is complete, observe() only maps
+
+    @property
+    def count(self) -> int:
+        return len(self.points_ts) // 2
+
+    _STATE_FIELDS = ('gap_ms', 'keep_ms', 'points_ts', 'points_play', 'last_ts', 'removed', 'frozen')
+
+    def to_state(self) -> dict:
+        return {k: getattr(self, k) for k in self._STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'GapCompressor':
+        gaps = cls(state['gap_ms'], state['keep_ms'])
+        for k in cls._STATE_FIELDS:
+            setattr(gaps, k, state[k])
+        return gaps
+
+    def observe(self, ts: int) -> int:
+        """Play ms of the next timeline item (items must come in timestamp order)."""
+        if self.frozen:
+            return self.to_play(ts)
+        last = self.last_ts
+        if last is not None and ts - last > self.gap_ms:
+            start = last - self.removed
+            self.points_ts += [last, ts]
+            self.points_play += [start, start + self.keep_ms]
+            self.removed += ts - last - self.keep_ms
+        if last is None or ts > last:
+            self.last_ts = ts
+        return self.to_play(ts)
+
+    @staticmethod
+    def _map(x: int, src: List[int], dst: List[int]) -> int:
+        i = bisect.bisect_right(src, x)
+        if i == 0:
+            return x
+        if i % 2 == 0:                     # between gaps: slope 1
+            return x - src[i - 1] + dst[i - 1]
+        x0, x1, y0, y1 = src[i - 1], src[i], dst[i - 1], dst[i]
+        return y0 + (x - x0) * (y1 - y0) // (x1 - x0)
+
+    def to_play(self, ts: int) -> int:
+        return self._map(ts, self.points_ts, self.points_play)
+
+    def to_timeline(self, play_ms: int) -> int:
+        return self._map(play_ms, self.points_play, self.points_ts)
+
+
+class SpeedProfile:
+    """
+    Speed factor as a step function of race time.  ``steps`` are
+    (epoch_ms, speed) pairs; each speed holds until the next step and the
+    first one also applies before its step.
+
+    scaled() maps play ms to scaled ms — the wall ms the replay takes at
+    --speed 1 — and play_at() inverts it.  The piecewise-linear mapping is
+    built once (again by rebuild() when gap compression moves the steps'
+    play positions).  Lookups remember the last segment, so the dispatcher's
+    in-order deadline queries cost O(1).
+    """
+
+    def __init__(self, steps: List[Tuple[int, float]]):
+        self.steps = sorted(steps)
+        self._hint = 0
+        self.rebuild(lambda ts: ts)
+
+    def rebuild(self, to_play):
+        """Recompute the segment table with ``to_play`` mapping timeline ms to play ms."""
+        self.starts = [to_play(ts) for ts, _ in self.steps]   # segment starts, play ms
+        self.speeds = [speed for _, speed in self.steps]
+        self.cum = [0.0]                                       # scaled ms at each start
+        for i in range(1, len(self.starts)):
+            self.cum.append(self.cum[-1] + (self.starts[i] - self.starts[i - 1]) / self.speeds[i - 1])
+        self._hint = 0
+
+    def _segment(self, play_ms: int) -> int:
+        i = self._hint
+        starts = self.starts
+        if not (starts[i] <= play_ms and (i + 1 == len(starts) or play_ms < starts[i + 1])):
+            i = self._hint = max(0, bisect.bisect_right(starts, play_ms) - 1)
+        return i
+
+    def scaled(self, play_ms: int) -> float:
+        i = self._segment(play_ms)
+        return self.cum[i] + (play_ms - self.starts[i]) / self.speeds[i]
+
+    def play_at(self, scaled_ms: float) -> int:
+        i = max(0, bisect.bisect_right(self.cum, scaled_ms) - 1)
+        return self.starts[i] + int((scaled_ms - self.cum[i]) * self.speeds[i])
+
+    def speed_at(self, play_ms: int) -> float:
+        return self.speeds[self._segment(play_ms)]
+
+
+class Dispatcher:
+    """
+    Replays ordered (epoch_ms, SimEvent) items through an EventSink at
+    ``speed`` × realtime, ``base_ms`` being the moment the replay starts.
+    ``start_time`` is the clock.time() that base_ms maps to (default: when
+    run() starts).
+
+    push() queues extra items; they do not need to be in timeline order.
+    pause(), resume(), set_speed() and seek() may be called while run() is
+    running.  With ``gaps`` (a GapCompressor) deadlines follow its play
+    time; race_time() and seek() still speak timeline ms.  With ``profile``
+    (a SpeedProfile) ``speed`` multiplies the profile's speed.  With
+    ``checkpoint`` (a RunCheckpoint) the run state is saved periodically
+    and when run() ends; stop() ends it early.  ``clock`` (default the wall
+    clock) is what ``start_time`` and all deadlines are measured on.
+    """
+
+    def __init__(self, sink: EventSink, timeline, base_ms: int, shift_ms: int, speed: float,
+                 start_time: Optional[float] = None, tick_ms: float = DISPATCH_TICK_MS,
+                 gaps: Optional[GapCompressor] = None,
+                 profile: Optional[SpeedProfile] = None,
+                 checkpoint: Optional['RunCheckpoint'] = None,
+                 clock: Optional[WallClock] = None):
+        self.sink = sink
+        self.clock = clock or WALL_CLOCK
+        self.source = iter(timeline)
+        self.source_done = False
+        self.base_ms = base_ms
+        self.shift_ms = shift_ms
+        self.speed = speed
+        self.tick = tick_ms / 1000
+        self.gaps = gaps
+        self.profile = profile
+        self._profile_gaps = 0             # gaps.count the profile was built for
+        self.queue: list = []              # heap of (play_ms, seq, epoch_ms, SimEvent)
+        self.seq = itertools.count()       # keeps timeline order for equal timestamps
+        self.in_flight: Dict[asyncio.Task, int] = {}   # send task → events in it
+        self.in_flight_events = 0
+        self.errors: List[BaseException] = []
+        self.dispatched = 0
+        self.consumed = 0                  # timeline items taken off the queue (sent, filtered or skipped)
+        self.checkpoint = checkpoint
+        self._next_checkpoint = 0.0        # clock.time() of the next periodic save
+        self.stopping = False
+        self.start_time = start_time
+        self.lateness: Dict[str, LogHistogram] = {}   # event type → lateness in µs
+        self.batch_sizes = LogHistogram()
+        # Play ms anchor_ms is due at clock.time() anchor_time.  Play ms equals
+        # timeline ms unless gaps are compressed.
+        self._set_anchor(self.play_ms(base_ms))
+        self.anchor_time = start_time
+        self.paused = False
+        self.skipped = 0
+        self.last_play = self.anchor_ms    # play ms of the latest dispatched item
+        self._wake = asyncio.Event()
+
+    def play_ms(self, ts: int) -> int:
+        return self.gaps.to_play(ts) if self.gaps else ts
+
+    def scaled(self, play_ms: int) -> float:
+        return self.profile.scaled(play_ms) if self.profile else play_ms
+
+    def deadline(self, play_ms: int) -> float:
+        """clock.time() at which the item at ``play_ms`` is due."""
+        return self.anchor_time + (self.scaled(play_ms) - self.anchor_scaled) / 1000 / self.speed
+
+    def effective_speed(self) -> float:
+        """Speed factor in force right now (``speed`` × the profile's)."""
+        if not self.profile:
+            return self.speed
+        return self.speed * self.profile.speed_at(self._play_time())
+
+    # --- runtime control ---
+
+    def _play_time(self) -> int:
+        """Play ms the replay has reached."""
+        if self.paused or self.anchor_time is None:
+            return self.anchor_ms
+        if math.isinf(self.speed):
+            return max(self.anchor_ms, self.last_play)
+        elapsed = max(0.0, self.clock.time() - self.anchor_time)
+        if self.profile:
+            return max(self.anchor_ms, self.profile.play_at(self.anchor_scaled + elapsed * 1000 * self.speed))
+        return self.anchor_ms + int(elapsed * 1000 * self.speed)
+
+    def race_time(self) -> int:
+        """Timeline epoch ms the replay has reached."""
+        play = self._play_time()
+        return self.gaps.to_timeline(play) if self.gaps else play
+
+    def _set_anchor(self, play_ms: int):
+        self.anchor_ms = play_ms
+        self.anchor_scaled = self.scaled(play_ms)
+
+    def _reanchor(self, play_ms: int):
+        self._set_anchor(play_ms)
+        self.anchor_time = self.clock.time()
+        self._wake.set()
+
+    def pause(self):
+        if not self.paused:
+            self._set_anchor(self._play_time())
+            self.paused = True
+            self._wake.set()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self._reanchor(self.anchor_ms)
+
+    def set_speed(self, speed: float):
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        now_play = self._play_time()
+        self.speed = speed
+        if self.paused:
+            self._set_anchor(now_play)
+        else:
+            self._reanchor(now_play)
+
+    def seek(self, race_ms: int) -> int:
+        """
+        Jump forward to timeline ms ``race_ms``; events before it are dropped
+        unsent.  Returns the number dropped.  Seeking backwards is refused
+        because sent events are no longer held.
+        """
+        if race_ms < self.race_time():
+            raise ValueError("cannot seek backwards: earlier events have already been sent")
+        dropped = 0
+        self._refill()
+        while self.queue and self.queue[0][2] < race_ms:
+            heapq.heappop(self.queue)
+            self._refill()
+            dropped += 1
+        self.skipped += dropped
+        self.consumed += dropped
+        # the refill has observed past race_ms, so its play time is known
+        target = self.play_ms(race_ms)
+        if self.paused:
+            self._set_anchor(target)
+        else:
+            self._reanchor(target)
+        return dropped
+
+    def stop(self):
+        """End run() after the sends in flight (the queue is kept for a checkpoint)."""
+        self.stopping = True
+        self._wake.set()
+
+    # --- checkpoint / resume ---
+
+    def to_state(self) -> dict:
+        """
+        Cursor and clock of the replay, JSON-serialisable.  Only consistent
+        while nothing is in flight; see RunCheckpoint.
+        """
+        loop_now = self.clock.time()
+        return {'cursor': self.consumed, 'done': self.source_done and not self.queue,
+                'base_ms': self.base_ms, 'shift_ms': self.shift_ms,
+                'speed': None if math.isinf(self.speed) else self.speed,
+                'paused': self.paused, 'anchor_ms': self.anchor_ms,
+                'anchor_wall_ms': self.clock.now_ms() + int((self.anchor_time - loop_now) * 1000),
+                'dispatched': self.dispatched, 'skipped': self.skipped}
+
+    def restore_state(self, state: dict):
+        """
+        Continue a checkpointed replay of the same timeline: its first
+        ``cursor`` items are skipped unsent and its clock is taken over, so
+        the remaining events keep their original due times (anything that
+        fell due while the simulator was down goes out at once).  A replay
+        that was paused, or ran at max speed, continues from where it was.
+        """
+        for _ in range(state['cursor']):
+            item = next(self.source, None)
+            if item is None:
+                raise ValueError(f"the timeline has fewer than {state['cursor']} events; "
+                                 "it is not the one the checkpoint was written for")
+            if self.gaps:
+                self.gaps.observe(item[0])   # rebuild the play-time mapping up to the cursor
+        self.consumed = state['cursor']
+        self.dispatched = state['dispatched']
+        self.skipped = state['skipped']
+        self.speed = math.inf if state['speed'] is None else state['speed']
+        self._refill()
+        loop_now = self.clock.time()
+        self._set_anchor(state['anchor_ms'])
+        if state['paused'] or math.isinf(self.speed):
+            self.anchor_time = loop_now
+        else:
+            self.anchor_time = loop_now + (state['anchor_wall_ms'] - self.clock.now_ms()) / 1000
+        self.last_play = self.anchor_ms
+
+    async def _settle(self):
+        """Wait until the sends in flight are done and the device queues have drained."""
+        if self.in_flight:
+            await asyncio.wait(list(self.in_flight))
+        await self.sink.flush()
+
+    async def _save_checkpoint(self):
+        """Let everything sent so far go out, then save the run state."""
+        await self._settle()
+        if not self.errors:
+            self.checkpoint.save(self)
+        self._next_checkpoint = self.clock.time() + self.checkpoint.interval
+
+    async def _sleep(self, delay: Optional[float]):
+        """
+        Sleep up to ``delay`` seconds (None = until woken) or until a control
+        call.  On a virtual clock the time is skipped once everything sent so
+        far has been delivered.
+        """
+        self._wake.clear()
+        if delay is not None and self.clock.virtual:
+            await self._settle()
+            self.clock.advance_to(self.clock.time() + delay)
+            return
+        handle = None
+        if delay is not None:
+            handle = asyncio.get_running_loop().call_later(delay, self._wake.set)
+        try:
+            await self._wake.wait()
+        finally:
+            if handle:
+                handle.cancel()
+
+    def push(self, ts: int, event: SimEvent):
+        heapq.heappush(self.queue, (self.play_ms(ts), next(self.seq), ts, event))
+        self._wake.set()
+
+    def _refill(self):
+        while not self.source_done and len(self.queue) < DISPATCH_LOOKAHEAD:
+            item = next(self.source, None)
+            if item is None:
+                self.source_done = True
                 break
-            for _ in range(3):
-                try:
-                    await self.ws.send(msg)
-                    self.sent_count += 1
-                    device_msg_count[self.device_id] = self.sent_count
-                    device_status[self.device_id] = "sent"
-                    update_dashboard(self.device_id)
-                    await asyncio.sleep(0.05)
-                    break
-                except Exception:
-                    device_status[self.device_id] = "send error"
-                    update_dashboard(self.device_id)
-                    self.ws = None
-                    await self._reconnect()
-                    if not self.ws:
-                        break
-        if self.ws:
-            await self.ws.close()
-        self.ws = None
-        device_status[self.device_id] = "disconnected"
-        update_dashboard(self.device_id)
+            ts = item[0]
+            play = self.gaps.observe(ts) if self.gaps else ts
+            heapq.heappush(self.queue, (play, next(self.seq), ts, item[1]))
+        if self.profile and self.gaps and self.gaps.count != self._profile_gaps:
+            # A new gap only moves profile steps after it, i.e. past every
+            # queued item and the anchor, so no queued deadline changes.
+            self._profile_gaps = self.gaps.count
+            self.profile.rebuild(self.gaps.to_play)
+            self.anchor_scaled = self.scaled(self.anchor_ms)
+
+    def _next_batch(self, now: float) -> List[Tuple[int, int, SimEvent]]:
+        """
+        Pop every accepted item due before now + tick (at most
+        DISPATCH_MAX_BATCH) as (play_ms, epoch_ms, event).
+        """
+        horizon = now + self.tick
+        batch = []
+        while self.queue and len(batch) < DISPATCH_MAX_BATCH and self.deadline(self.queue[0][0]) <= horizon:
+            play, _, ts, event = heapq.heappop(self.queue)
+            self._refill()
+            self.consumed += 1
+            if self.sink.accepts(event):
+                batch.append((play, ts, event))
+        return batch
+
+    def _send_done(self, task: asyncio.Task):
+        self.in_flight_events -= self.in_flight.pop(task, 0)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors.append(task.exception())
+
+    async def run(self):
+        clock = self.clock
+        if self.start_time is None:
+            self.start_time = clock.time()
+        if self.anchor_time is None:
+            self.anchor_time = self.start_time
+        if self.checkpoint:
+            self._next_checkpoint = clock.time() + self.checkpoint.interval
+        self._refill()
+        while self.queue and not self.errors and not self.stopping:
+            if self.paused:
+                await self._sleep(None)
+                continue
+            now = clock.time()
+            delay = self.deadline(self.queue[0][0]) - now
+            if delay > 0:
+                await self._sleep(delay)
+                continue  # re-read the head: a control call or push() may have changed it
+            batch = self._next_batch(now)
+            if not batch:
+                continue
+            while self.in_flight and (len(self.in_flight) >= DISPATCH_MAX_IN_FLIGHT
+                                      or self.in_flight_events >= DISPATCH_MAX_IN_FLIGHT_EVENTS):
+                await asyncio.wait(list(self.in_flight), return_when=asyncio.FIRST_COMPLETED)
+            now = clock.time()
+            if not math.isinf(self.speed):
+                for play, _, event in batch:
+                    hist = self.lateness.get(event.event)
+                    if hist is None:
+                        hist = self.lateness[event.event] = LogHistogram()
+                    hist.add(int((now - self.deadline(play)) * 1_000_000))
+            self.last_play = batch[-1][0]
+            task = asyncio.create_task(self.sink.send_batch(
+                [(event, ts + self.shift_ms) for _, ts, event in batch], self.shift_ms))
+            self.in_flight[task] = len(batch)
+            self.in_flight_events += len(batch)
+            task.add_done_callback(self._send_done)
+            self.dispatched += len(batch)
+            self.batch_sizes.add(len(batch))
+            if self.checkpoint and clock.time() >= self._next_checkpoint:
+                await self._save_checkpoint()
+        if self.in_flight:
+            await asyncio.wait(list(self.in_flight))
+        if self.checkpoint:
+            await self._save_checkpoint()
+        if self.errors:
+            raise self.errors[0]
+
+    def stats(self) -> dict:
+        """Counters behind report(), picklable so shard processes can send them back."""
+        return {'dispatched': self.dispatched, 'skipped': self.skipped,
+                'lateness': self.lateness, 'batch_sizes': self.batch_sizes}
+
+    def report(self) -> List[str]:
+        """Lines with dispatch lateness p50/p95/p99/max (ms) per event type and the batch sizes."""
+        label = speed_label(self.speed) + (' × profile' if self.profile else '')
+        if self.clock.virtual:
+            label += ', virtual time'
+        return dispatch_report(self.stats(), label, self.tick, self.gaps)
+
+
+def dispatch_report(stats: dict, speed_text: str, tick: float,
+                    gaps: Optional[GapCompressor] = None) -> List[str]:
+    """Report lines for Dispatcher.stats() (or several shards' stats merged)."""
+    lines = []
+    lateness = stats['lateness']
+    if lateness:
+        total = LogHistogram()
+        for hist in lateness.values():
+            total.merge(hist)
+        lines += [f"[timing] dispatch lateness at speed {speed_text} (ms):",
+                  f"  {'event':<15}{'n':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+        for name, hist in sorted(lateness.items()) + [('all', total)]:
+            p50, p95, p99 = (hist.percentile(q) / 1000 for q in (0.50, 0.95, 0.99))
+            lines.append(f"  {name:<15}{hist.n:>8}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{hist.max / 1000:>9.1f}")
+    if stats['skipped']:
+        lines.append(f"[timing] {stats['skipped']} events skipped by seek")
+    if gaps and gaps.count:
+        lines.append(f"[timing] {gaps.count} idle gaps over {gaps.gap_ms / 1000:g}s played as "
+                     f"{gaps.keep_ms / 1000:g}s: {gaps.removed / 3600_000:.2f} h of race time skipped")
+    b = stats['batch_sizes']
+    if not b.n:
+        return lines
+    lines.append(f"[timing] {b.n} batches (tick {tick * 1000:g} ms), events per batch: "
+                 f"mean {stats['dispatched'] / b.n:.1f}  p50 {b.percentile(0.50)}  "
+                 f"p95 {b.percentile(0.95)}  p99 {b.percentile(0.99)}  max {b.max}")
+    return lines
+
+
+# --- Runtime control API ---
+#
+# With --control-port the simulator serves a small local HTTP API while the
+# timeline is replaying:
+#
+#   GET  /status                  state, speed, race time and counters
+#   POST /pause   POST /resume
+#   POST /speed?value=20          change the speed factor ('max' = unthrottled)
+#   POST /seek?time=<ISO>         jump forward to a race time
+#   POST /seek?offset=<hours>     ... or to N hours after the timeline start
+#
+# Every call answers with the status JSON, e.g.
+#   curl -X POST 'http://127.0.0.1:8090/speed?value=20'
+
+class ControlServer:
+    """Local HTTP endpoint driving a running Dispatcher."""
+
+    def __init__(self, dispatcher: Dispatcher, host: str, port: int, tz_offset: int = 0):
+        self.dispatcher = dispatcher
+        self.host = host
+        self.port = port
+        self.tz_offset = tz_offset
+        self.runner = None
+
+    def status(self) -> dict:
+        d = self.dispatcher
+        return {
+            'state': 'paused' if d.paused else 'running',
+            'speed': 'max' if math.isinf(d.speed) else d.speed,
+            'effective_speed': 'max' if math.isinf(d.speed) else d.effective_speed(),
+            'race_time': ms_to_iso(d.race_time(), self.tz_offset),
+            'dispatched': d.dispatched,
+            'skipped': d.skipped,
+            'queued': len(d.queue),
+        }
 
-    async def send(self, message: str):
-        if not self.ws:
-            await self.connect()
-            if not self.ws:
-                return
-        await self.queue.put(message)
+    async def start(self):
+        from aiohttp import web
+
+        async def handle(request):
+            action = request.match_info['action']
+            d = self.dispatcher
+            try:
+                if action == 'status':
+                    pass
+                elif request.method != 'POST':
+                    raise ValueError(f"use POST /{action}")
+                elif action == 'pause':
+                    d.pause()
+                elif action == 'resume':
+                    d.resume()
+                elif action == 'speed':
+                    d.set_speed(parse_speed(request.query['value']))
+                elif action == 'seek':
+                    if 'time' in request.query:
+                        # an unescaped '+' in the UTC offset arrives as a space
+                        target, _ = iso_to_ms(request.query['time'].replace(' ', '+'))
+                    else:
+                        target = d.base_ms + int(float(request.query['offset']) * 3600 * 1000)
+                    dropped = d.seek(target)
+                    print(f"[control] seek to {ms_to_iso(target, self.tz_offset)}: {dropped} events skipped")
+                else:
+                    return web.json_response({'error': f"unknown action {action!r}"}, status=404)
+            except (KeyError, ValueError) as e:
+                msg = f"missing parameter {e}" if isinstance(e, KeyError) else str(e)
+                return web.json_response({'error': msg}, status=400)
+            if action != 'status':
+                print(f"[control] {action}: {'paused' if d.paused else 'running'} at speed {speed_label(d.speed)}")
+            return web.json_response(self.status())
+
+        app = web.Application()
+        app.router.add_route('*', '/{action}', handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f"[control] listening on http://{self.host}:{self.port} (status, pause, resume, speed, seek)")
 
     async def close(self):
-        if self.sender_task:
-            await self.queue.put(None)
-            await self.sender_task
-        if self.ws:
-            await self.ws.close()
-        self.ws = None
-        device_status[self.device_id] = "closed"
-        update_dashboard(self.device_id)
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# --- Checkpoint / resume (--checkpoint, --resume) ---
+#
+# A realtime rehearsal runs for hours; a crash should not mean starting
+# over.  With --checkpoint FILE the dispatcher saves a small JSON state file
+# every --checkpoint-interval seconds and once more when the run ends or is
+# stopped with Ctrl-C / SIGTERM:
+#
+#   * the dispatch cursor: how many timeline items have been taken off the
+#     queue (sent, filtered out or skipped by seek), and the clock anchor,
+#     speed and time shift;
+#   * the random generator state the timeline was built from, so rebuilding
+#     from the same inputs yields the same logins, purku delays and devices;
+#   * the NavisportSender caches (start times, result ids, validated purkus);
+#   * the options that shape the timeline, with the size and mtime of every
+#     input file, so a resume with a different command line is refused.
+#
+# Before each save the sends in flight and the WebSocket device queues are
+# drained, so the cursor and the Navisport caches describe exactly what has
+# gone out.  --resume FILE rebuilds the timeline, skips the items before the
+# cursor unsent and keeps the original schedule and wire timestamps: events
+# that fell due while the simulator was down go out at once, the rest on
+# time.  Only events sent after the last save of a hard crash (kill -9,
+# power loss) are sent again; a clean stop resumes without duplicates.
+
+RUN_STATE_VERSION = 1
+CHECKPOINT_INTERVAL_SECONDS = 30
+
+
+def input_signature(path: str) -> list:
+    """[absolute path, size, mtime] of an input file, for comparing runs."""
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, int(st.st_mtime)]
+
+
+class RunCheckpoint:
+    """
+    Resume state of one replay.  ``options`` describe the timeline inputs and
+    ``rng_state`` is random.getstate() from before the timeline was built.
+    The file is replaced atomically on every save.
+    """
+
+    def __init__(self, path: str, options: dict, rng_state: tuple,
+                 interval: float = CHECKPOINT_INTERVAL_SECONDS):
+        self.path = path
+        self.options = options
+        self.rng_state = [rng_state[0], list(rng_state[1]), rng_state[2]]
+        self.interval = interval
+        self.saves = 0
+
+    def save(self, dispatcher: Dispatcher):
+        sender = dispatcher.sink.navisport_sender
+        state = {
+            'version': RUN_STATE_VERSION,
+            'saved': ms_to_iso(now_ms()),
+            'options': self.options,
+            'random': self.rng_state,
+            'dispatch': dispatcher.to_state(),
+            'navisport': sender.to_state() if sender else None,
+        }
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+        self.saves += 1
+
+
+def load_run_state(path: str) -> dict:
+    """Read a --checkpoint file; raises ValueError when it is not one."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"{path}: not a checkpoint file ({e})")
+    if not isinstance(state, dict) or state.get('version') != RUN_STATE_VERSION:
+        raise ValueError(f"{path}: not a version {RUN_STATE_VERSION} checkpoint file")
+    return state
+
+
+def rng_state_from_json(value: list) -> tuple:
+    """random.setstate() argument from the JSON form stored by RunCheckpoint."""
+    return (value[0], tuple(value[1]), value[2])
+
+
+def build_timeline(events: 'List[SimEvent] | LoadedRace | List[LoadedRace]',
+                   start_offset: float = 0.0,
+                   finish_control: Optional[str] = None,
+                   mass_start_times: Optional[List[datetime]] = None,
+                   race: str = 'venla',
+                   bib_map: Optional[dict] = None,
+                   mass_start_signal: Optional[datetime] = None,
+                   login_config: Optional[dict] = None,
+                   login_only: bool = False) -> Optional[Iterator[Tuple[int, SimEvent]]]:
+    """
+    Steps 1-6 of a run: the complete ordered (epoch_ms, SimEvent) timeline,
+    merged lazily from the per-race timelines, or None when nothing is left
+    to send.
+    """
+
+    # Several LoadedRaces (one per --iof file) are expanded separately — each
+    # keeps its own race type, check-in config and mass start — and merged by
+    # timestamp.  A single LoadedRace carries its own bib map and mass start
+    # signal; explicit arguments still take precedence.
+    if isinstance(events, LoadedRace):
+        races = [events]
+    elif events and all(isinstance(e, LoadedRace) for e in events):
+        races = list(events)
+    else:
+        loaded = LoadedRace('')
+        loaded.events = list(events)
+        loaded.race = race
+        races = [loaded]
+    if len(races) == 1:
+        r = races[0]
+        if bib_map is not None:
+            r.bib_map = bib_map
+        r.start_signal = (mass_start_signal or r.start_signal or r.earliest_start
+                          or (mass_start_times or [None])[0])
+
+    # --- 1. Aikajanan valmistelu ---
+    # Timeline entries are (epoch_ms, event) tuples; see "Epoch-millisecond timestamps".
+    firsts = [min(ev.ts_ms for ev in r.events) for r in races if r.events]
+    if not firsts:
+        print("No events found.")
+        return None
+
+    # --- 2. Start offset ---
+    base_time = min(firsts)
+    cutoff_time = base_time + int(start_offset * 3600 * 1000)
+
+    if not any(ev.ts_ms >= cutoff_time for r in races for ev in r.events):
+        print(f"All events skipped by start-offset {start_offset}h")
+        return None
+
+    # --- 3.-6. Per-race timelines ---
+    timelines = [build_race_timeline(r, cutoff_time, finish_control, login_config, login_only)
+                 for r in races]
+
+    # mass start
+    extra_events: List[Tuple[int, SimEvent]] = []
+    mass_start_runner = Runner('mass_start')
+    for dt in (mass_start_times or []):
+        ts, tz_offset = dt_to_ms(dt)
+        event = SimEvent(ts, 'mass_start', 'mass_start', 'mass_start', mass_start_runner,
+                         tz_offset=tz_offset, note='Mass start at known time')
+        extra_events.append((ts, event))
+        print(f"Mass start event added at {ms_to_iso(ts, tz_offset)}")
+    if extra_events:
+        extra_events.sort(key=timeline_sort_key)
+        timelines.append(extra_events)
+
+    # Lazy k-way merge of the already ordered per-race timelines
+    combined = heapq.merge(*timelines, key=timeline_sort_key)
+    first = next(combined, None)
+    if first is None:
+        print("No events found.")
+        return None
+    return itertools.chain([first], combined)
+
+
+async def dispatch_timeline(timeline: Iterator[Tuple[int, SimEvent]],
+                            sink: EventSink,
+                            speed: float,
+                            tick_ms: float = DISPATCH_TICK_MS,
+                            control_port: Optional[int] = None,
+                            compress_gaps: Optional[Tuple[int, int]] = None,
+                            speed_profile: Optional[List[Tuple[Any, float]]] = None,
+                            gaps: Optional[GapCompressor] = None,
+                            base_ms: Optional[int] = None,
+                            start_ms: Optional[int] = None,
+                            shift_ms: Optional[int] = None,
+                            report: bool = True,
+                            on_dispatcher=None,
+                            checkpoint: Optional[RunCheckpoint] = None,
+                            resume: Optional[dict] = None,
+                            clock: Optional[WallClock] = None) -> Optional[Dispatcher]:
+    """
+    Steps 7-8: replay an ordered timeline through a started sink, then close
+    it.  Returns the Dispatcher (for its stats).
+
+    A shard of a larger timeline passes the whole timeline's ``base_ms`` and
+    the common wall-clock ``start_ms`` (epoch ms) it maps to, plus the
+    complete ``gaps`` mapping, so every shard keeps the same clock.  On a
+    host whose clock is off, ``start_ms`` is in local time and ``shift_ms``
+    keeps the wire timestamps on the common clock.  ``on_dispatcher`` is
+    called with the Dispatcher before it starts.
+
+    ``checkpoint`` saves the run state as it goes; Ctrl-C and SIGTERM then
+    stop the replay cleanly.  ``resume`` (the 'dispatch' part of a saved
+    state) continues that run on the same timeline.  ``clock`` replaces the
+    wall clock (see VirtualClock).
+    """
+    first = next(timeline, None)
+    if first is None:
+        print("No events found.")
+        await sink.close()
+        return None
+
+    # --- 7. Shiftataan nykyhetkeen ---
+    # The wall-clock shift and the monotonic start are read together once;
+    # every deadline is derived from them.
+    base_time = first[0] if base_ms is None else base_ms
+    if resume is not None:
+        if resume['base_ms'] != base_time:
+            print("Cannot resume: the timeline does not start where the checkpointed one did")
+            await sink.close()
+            return None
+        shift_ms = resume['shift_ms']
+    clock = clock or WALL_CLOCK
+    loop_now, wall_now = clock.time(), clock.now_ms()
+    if start_ms is None:
+        start_ms = wall_now
+    shift = start_ms - base_time if shift_ms is None else shift_ms
+    start_time = loop_now + (start_ms - wall_now) / 1000
+
+    # Profile steps are hours after the timeline start or ISO times
+    profile = None
+    if speed_profile:
+        steps = [(base_time + int(at * 3600 * 1000) if isinstance(at, (int, float)) else iso_to_ms(at)[0], sp)
+                 for at, sp in speed_profile]
+        profile = SpeedProfile(steps)
+        if report:
+            print("[timing] speed profile: " + ", ".join(
+                f"{ms_to_iso(ts, first[1].tz_offset)} ×{sp:g}" for ts, sp in profile.steps))
+
+    if gaps is None and compress_gaps:
+        gaps = GapCompressor(*compress_gaps)
+    dispatcher = Dispatcher(sink, itertools.chain([first], timeline), base_time, shift, speed,
+                            start_time=start_time, tick_ms=tick_ms, gaps=gaps, profile=profile,
+                            checkpoint=checkpoint, clock=clock)
+    if resume is not None:
+        try:
+            dispatcher.restore_state(resume)
+        except ValueError as e:
+            print(f"Cannot resume: {e}")
+            await sink.close()
+            return None
+        print(f"[checkpoint] resuming after {dispatcher.consumed} events, "
+              f"time shift {shift / 3600_000:+.3f} h, speed {speed_label(dispatcher.speed)}")
+
+    if on_dispatcher:
+        on_dispatcher(dispatcher)
+
+    # With a checkpoint, Ctrl-C / SIGTERM end the replay through stop() so the
+    # final state is saved after the sends in flight (POSIX event loops only)
+    stop_signals = []
+    if checkpoint:
+        import signal
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, dispatcher.stop)
+                stop_signals.append(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
+        print(f"[checkpoint] saving to {checkpoint.path} every {checkpoint.interval:g}s")
 
-async def run_simulator(events: List[Dict[str, Any]],
+    control = None
+    if control_port:
+        control = ControlServer(dispatcher, '127.0.0.1', control_port, tz_offset=first[1].tz_offset)
+        await control.start()
+
+    # --- 8. Lähetä ja sulje ---
+    try:
+        await dispatcher.run()
+    finally:
+        for sig in stop_signals:
+            asyncio.get_running_loop().remove_signal_handler(sig)
+        if control:
+            await control.close()
+        await sink.close()
+        if checkpoint and checkpoint.saves:
+            if dispatcher.stopping:
+                print(f"[checkpoint] stopped after {dispatcher.consumed} events; "
+                      f"continue with --resume {checkpoint.path}")
+            elif not dispatcher.errors:
+                print(f"[checkpoint] run complete ({dispatcher.consumed} events), state in {checkpoint.path}")
+        if report:
+            for line in dispatcher.report():
+                print(line)
+            for meter in sink.meters.values():
+                line = meter.report()
+                if line:
+                    print(line)
+    return dispatcher
+
+
+async def run_simulator(events: 'List[SimEvent] | LoadedRace | List[LoadedRace]',
                         host: str,
                         port: int,
                         speed: float,
@@ -1261,342 +3933,1070 @@ async def run_simulator(events: List[Dict[str, Any]],
                         mass_start_signal: Optional[datetime] = None,
                         login_config: Optional[dict] = None,
                         login_only: bool = False,
-                        no_ws: bool = False):
-
-    if navisport_sender:
-        await navisport_sender.connect()
+                        no_ws: bool = False,
+                        tick_ms: float = DISPATCH_TICK_MS,
+                        control_port: Optional[int] = None,
+                        compress_gaps: Optional[Tuple[int, int]] = None,
+                        speed_profile: Optional[List[Tuple[Any, float]]] = None,
+                        timeline: Optional[Iterator[Tuple[int, SimEvent]]] = None,
+                        checkpoint: Optional[RunCheckpoint] = None,
+                        resume: Optional[dict] = None,
+                        clock: Optional[WallClock] = None):
+    """
+    Build the timeline from ``events`` (see build_timeline) and replay it.
+    A ready ``timeline`` (e.g. from read_timeline()) is replayed as is.
+    ``checkpoint``, ``resume`` and ``clock`` are passed to dispatch_timeline().
+    """
+    if timeline is None:
+        timeline = build_timeline(events, start_offset, finish_control, mass_start_times,
+                                  race, bib_map, mass_start_signal, login_config, login_only)
+        if timeline is None:
+            return
 
-    device_clients: Dict[str, DeviceClient] = {}
+    # Unthrottled runs measure the pipeline, so drop the per-device pacing
+    # too; on a virtual clock there is no wall time to pace against
+    clock = clock or WALL_CLOCK
+    sink = EventSink(host, port, one_conn_per_device, allowed_controls,
+                     finish_control, navisport_sender, no_ws,
+                     device_pause=0.0 if math.isinf(speed) or clock.virtual else DEVICE_SEND_PAUSE,
+                     clock=clock)
+    await sink.start()
+    await dispatch_timeline(timeline, sink, speed, tick_ms, control_port,
+                            compress_gaps, speed_profile, checkpoint=checkpoint, resume=resume,
+                            clock=clock)
+
+
+# --- Timeline export / replay ---
+#
+# --export-timeline writes the fully expanded timeline (logins after the
+# queue simulation, purku, itkumuuri, manual_ok, status_update, mass starts)
+# as JSON lines and exits; --replay-timeline streams such a file straight
+# into the dispatcher with no XML, config or random generation, so every
+# replay of one file sends exactly the same events.
+#
+#   {"timeline": 1}                          header, format version
+#   {"runner": [runner_id, name, ...]}       Runner fields; numbered 0, 1, ...
+#                                            in order of appearance
+#   {"t": ms, "e": [ts_ms, event, ...], "r": 0, "p": [[...], ...], "x": 1}
+#       one timeline item: SimEvent columns, runner number (-1 = none),
+#       for results_purku the punch list as event columns and, optionally,
+#       "x" on the runner's last item in the file (readers can drop it)
+#
+# The file is written with gzip for .gz and zstd for .zst (zstandard
+# package); reading detects the compression from the magic bytes.
+
+TIMELINE_FORMAT_VERSION = 1
+
+
+def _open_timeline_for_write(path: str, tmp: str):
+    """Text file at ``tmp``, compressed according to the final ``path``'s suffix."""
+    if path.endswith('.gz'):
+        return gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6)
+    if path.endswith('.zst'):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdCompressor(level=3).stream_writer(open(tmp, 'wb')),
+                                encoding='utf-8')
+    return open(tmp, 'w', encoding='utf-8')
+
+
+class TimelineWriter:
+    """Writes timeline items one by one; the file appears at ``path`` on close()."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp = f"{path}.{os.getpid()}.tmp"
+        self.f = _open_timeline_for_write(path, self.tmp)
+        self.f.write(json.dumps({'timeline': TIMELINE_FORMAT_VERSION}) + '\n')
+        # id(runner) → (runner number, runner); the reference keeps the id from
+        # being reused by another Runner while the file is being written
+        self.runner_idx: Dict[int, Tuple[int, Runner]] = {}
+        self.runner_count = 0
+        self.count = 0
+
+    def write(self, ts: int, ev: SimEvent, last: bool = False):
+        """Append one item; ``last`` marks the final item of its runner in this file."""
+        r = ev.runner
+        ri = -1
+        if r is not None:
+            entry = self.runner_idx.get(id(r))
+            if entry is None:
+                ri = self.runner_count
+                self.runner_count += 1
+                self.runner_idx[id(r)] = (ri, r)
+                self.f.write(json.dumps({'runner': [getattr(r, k) for k in _RUNNER_FIELDS]},
+                                        separators=(',', ':'), ensure_ascii=False) + '\n')
+            else:
+                ri = entry[0]
+        item = {'t': ts, 'e': [getattr(ev, c) for c in _EVENT_COLUMNS], 'r': ri}
+        if ev.punches:
+            item['p'] = [[getattr(p, c) for c in _EVENT_COLUMNS] for p in ev.punches]
+        if last and ri >= 0:
+            item['x'] = 1
+            del self.runner_idx[id(r)]
+        self.f.write(json.dumps(item, separators=(',', ':'), ensure_ascii=False) + '\n')
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+        os.replace(self.tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmp)
 
-    # --- 1. Aikajanan valmistelu ---
-    all_timeline: List[Tuple[datetime, Dict[str, Any]]] = [
-        (datetime.fromisoformat(ev['timestamp']), ev) for ev in events
-    ]
-    if not all_timeline:
-        print("No events found.")
-        return
-    all_timeline.sort(key=lambda x: x[0])
 
-    # --- 2. Start offset ---
-    base_time = all_timeline[0][0]
-    cutoff_time = base_time + timedelta(hours=start_offset)
-    filtered = [(ts, ev) for ts, ev in all_timeline if ts >= cutoff_time]
-    if not filtered:
-        print(f"All events skipped by start-offset {start_offset}h")
-        return
+def write_timeline(path: str, timeline: Iterator[Tuple[int, SimEvent]]) -> int:
+    """Write an ordered timeline to ``path``; returns the number of items."""
+    with TimelineWriter(path) as w:
+        for ts, ev in timeline:
+            w.write(ts, ev)
+    return w.count
 
-    # --- 3. Punchit juoksijoittain ---
-    all_by_runner: Dict[str, List[Tuple[datetime, Dict[str, Any]]]] = {}
-    for ts, ev in filtered:
-        if ev.get('event') not in ('punch', 'status_only'):
-            continue
-        runner = ev.get('runner_id') or ev.get('runner_name') or 'unknown'
-        all_by_runner.setdefault(runner, []).append((ts, ev))
 
-    # Only real punch events are published to the WebSocket relay
-    published_by_runner: Dict[str, List[Tuple[datetime, Dict[str, Any]]]] = {}
-    for runner, punches in all_by_runner.items():
-        real = [(ts, e) for ts, e in punches if e.get('event') == 'punch']
-        if real:
-            published_by_runner[runner] = real
+def read_timeline(path: str, with_last: bool = False) -> Iterator[Tuple[int, SimEvent]]:
+    """
+    Stream (epoch_ms, SimEvent) items from a file written by write_timeline().
+    The header is checked right away (ValueError); items are read on demand.
+    ``with_last`` yields (epoch_ms, SimEvent, last-item-of-its-runner) instead.
+    """
+    f = iofreader.open_iof(path)
+    try:
+        header = json.loads(f.readline() or b'{}')
+    except ValueError:
+        header = {}
+    if not isinstance(header, dict) or header.get('timeline') != TIMELINE_FORMAT_VERSION:
+        f.close()
+        raise ValueError(f"{path}: not a timeline file of format version {TIMELINE_FORMAT_VERSION}")
+    return _timeline_items(f, with_last)
+
+
+def _timeline_items(f, with_last: bool = False) -> Iterator[tuple]:
+    runners: List[Runner] = []
+    with f:
+        for line in f:
+            item = json.loads(line)
+            if 'runner' in item:
+                runners.append(Runner(*item['runner']))
+                continue
+            ri = item['r']
+            runner = runners[ri] if ri >= 0 else None
+            ev = _event_from_row(item['e'], runner)
+            if 'p' in item:
+                ev.punches = [_event_from_row(row, runner) for row in item['p']]
+            last = 'x' in item
+            if last:
+                runners[ri] = None
+            yield (item['t'], ev, last) if with_last else (item['t'], ev)
+
+
+def _event_from_row(row: list, runner: Optional[Runner]) -> SimEvent:
+    ts_ms, event, device_id, device_type, tz_offset, status, raw_time, start_ms, note = row
+    return SimEvent(ts_ms, event, sys.intern(device_id) if device_id else device_id, device_type,
+                    runner, tz_offset=tz_offset, status=status,
+                    raw_time=sys.intern(raw_time) if raw_time else raw_time,
+                    start_ms=start_ms, note=note)
+
+
+# --- Out-of-core timeline (--memory-budget) ---
+#
+# The normal path keeps every parsed event in memory (LoadedRace.events) and
+# expands the timeline from there.  With --memory-budget MB the XML is read
+# one TeamResult at a time instead, and each team is expanded on the spot
+# (punches, purku, itkumuuri, manual_ok, status_update).  The results are
+# collected in a buffer, and whenever the buffer reaches the budget it is
+# sorted and written to a temporary file as a run in the timeline format
+# above.  The dispatcher then reads a k-way merge of the runs; a run marks
+# each runner's last item so the reader can drop it.  What stays in memory
+# is one buffer plus a few lines per open run, whatever the team count.
+#
+# Logins need the whole race in arrival order for the queue simulation, and
+# leg-1 check-ins hang on the mass start signal, which is only known once
+# the document has been read.  They are therefore spilled separately: leg-1
+# logins relative to the mass start, the others at their absolute time.  At
+# the end of each file the two sets are merged, shifted to the real mass
+# start and fed through the check-in queue into one more run.
+#
+# The random draws happen team by team here, so a spilled build with a
+# given random state differs from an in-memory build; it is equally
+# reproducible.  --start-offset needs the earliest event of the race before
+# the first team is expanded and is not available in this mode.
+
+SPILL_EVENT_BYTES = 320      # memory per buffered timeline item, measured on the Jukola 2025 file
+SPILL_MERGE_FANIN = 64       # runs merged at once; more runs are first merged into bigger ones
+
+
+class TimelineSpill:
+    """Sorted timeline runs in a temporary directory."""
+
+    def __init__(self, budget_bytes: int, directory: Optional[str] = None):
+        import tempfile
+        self.dir = tempfile.mkdtemp(prefix='relaysim-spill-', dir=directory)
+        self.capacity = max(1000, budget_bytes // SPILL_EVENT_BYTES)   # items per buffer
+        self.files = 0
+        self.items = 0
+
+    def write_run(self, items: List[Tuple[int, SimEvent]]) -> Optional[str]:
+        """Write ordered ``items`` as one run file; returns its path (None when empty)."""
+        if not items:
+            return None
+        last = {}
+        for n, (_, ev) in enumerate(items):
+            if ev.runner is not None:
+                last[id(ev.runner)] = n
+        self.files += 1
+        path = os.path.join(self.dir, f"run-{self.files:05d}.jsonl")
+        with TimelineWriter(path) as w:
+            for n, (ts, ev) in enumerate(items):
+                w.write(ts, ev, last=ev.runner is not None and last[id(ev.runner)] == n)
+        self.items += len(items)
+        return path
+
+    def merge(self, paths: List[str]) -> Iterator[Tuple[int, SimEvent]]:
+        """Lazy k-way merge of run files, in timeline order."""
+        paths = list(paths)
+        while len(paths) > SPILL_MERGE_FANIN:
+            group, paths = paths[:SPILL_MERGE_FANIN], paths[SPILL_MERGE_FANIN:]
+            self.files += 1
+            path = os.path.join(self.dir, f"run-{self.files:05d}.jsonl")
+            with TimelineWriter(path) as w:
+                for ts, ev, last in heapq.merge(*(read_timeline(p, with_last=True) for p in group),
+                                                key=timeline_sort_key):
+                    w.write(ts, ev, last=last)
+            for p in group:
+                os.remove(p)
+            paths.append(path)
+        return heapq.merge(*(read_timeline(p) for p in paths), key=timeline_sort_key)
+
+    def cleanup(self):
+        import shutil
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _spilled_timeline(spill: TimelineSpill, timeline: Iterator[Tuple[int, SimEvent]]):
+    """Yield from the merged runs and remove the spill directory afterwards."""
+    try:
+        yield from timeline
+    finally:
+        spill.cleanup()
+
+
+def build_spilled_timeline(iof_paths: List[str], budget_bytes: int,
+                           team_range: Optional[set[int]] = None,
+                           team_limit: Optional[int] = None,
+                           leg_set: Optional[set[int]] = None,
+                           finish_control: Optional[str] = None,
+                           login_config: Optional[dict] = None,
+                           login_only: bool = False,
+                           race_type: Optional[str] = None,
+                           mass_start_overrides: Optional[List[Optional[datetime]]] = None,
+                           mass_start_times: Optional[List[datetime]] = None,
+                           bib_stride: int = 10000,
+                           stop_at_limit: bool = False) -> Optional[Iterator[Tuple[int, SimEvent]]]:
+    """
+    build_timeline() for --iof files that do not fit in memory: the ordered
+    timeline as a merge of sorted runs on disk, or None when nothing is left
+    to send.  The spill directory is removed once the timeline is exhausted.
 
-    # --- 4. Extra eventit ---
-    extra_events: List[Tuple[datetime, Dict[str, Any]]] = []
+    With ``stop_at_limit`` each file is read only up to ``team_limit`` even
+    without a mass start override; the mass start then comes from the teams
+    read (see --stream-parse).
+    """
+    spill = TimelineSpill(budget_bytes)
+    multi = len(iof_paths) > 1
+    runs: List[str] = []
+    try:
+        for n, iof_path in enumerate(iof_paths):
+            label = f"[{os.path.basename(iof_path)}] " if multi else ''
+            buffer: List[Tuple[int, SimEvent]] = []
+            relative: List[Tuple[int, SimEvent]] = []    # leg-1 logins, ms after the mass start
+            absolute: List[Tuple[int, SimEvent]] = []
+            login_runs: Tuple[List[str], List[str]] = ([], [])
+            login_cfg = None
+            parsed = 0
+
+            def flush():
+                for items in (buffer, relative, absolute):
+                    items.sort(key=timeline_sort_key)
+                for path, target in ((spill.write_run(buffer), runs),
+                                     (spill.write_run(relative), login_runs[0]),
+                                     (spill.write_run(absolute), login_runs[1])):
+                    if path:
+                        target.append(path)
+                buffer.clear()
+                relative.clear()
+                absolute.clear()
+
+            def add_team(race: LoadedRace, team_events: List[SimEvent]):
+                nonlocal login_cfg, parsed
+                if login_cfg is None:
+                    # <Event><Name> precedes the teams
+                    login_cfg = login_config_for_race(
+                        login_config or {}, race_type or race_type_from_name(race.event_name))
+                team = LoadedRace(iof_path)
+                team.add_team_events(team_events)
+                parsed += len(team_events)
+                if multi:
+                    team.apply_namespace(f"{n + 1}/", n * bib_stride)
+                team.events.sort(key=lambda e: e.ts_ms)
+                # Mass start 0: leg-1 logins come out relative to it
+                logins, streams = expand_race_events(team, 0, finish_control, login_cfg,
+                                                     login_only, 0, 0)
+                for item in logins:
+                    (relative if item[1].start_ms == 0 else absolute).append(item)
+                for stream in streams:
+                    buffer.extend(stream)
+                if len(buffer) + len(relative) + len(absolute) >= spill.capacity:
+                    flush()
+
+            meta = LoadedRace(iof_path)
+            events = iter_iof3_events(iof_path, team_range, team_limit, leg_set, race=meta,
+                                      full_scan=not (stop_at_limit or (mass_start_overrides and mass_start_overrides[n])))
+            # a team's events come out together; neighbours sharing a bib only make a bigger group
+            for _bib, team_events in itertools.groupby(events, key=lambda ev: ev.team_id):
+                add_team(meta, list(team_events))
+            flush()
+            meta.race = race_type or race_type_from_name(meta.event_name)
+            meta.start_signal = mass_start_overrides[n] if mass_start_overrides else None
+            print(f"{label}Teams in XML: {meta.teams_seen}")
+            msg = f"{label}Teams included: {meta.teams_included}"
+            if team_limit:
+                msg += f" (limited to first {team_limit})"
+            print(msg)
+            print(f"{label}Parsed {parsed} events, spilled in {len(runs)} run(s) so far "
+                  f"(budget {budget_bytes // (1024 * 1024)} MB ≈ {spill.capacity} items per run)")
+            print(f"{label}Race: {meta.race}, mass start signal: {meta.mass_start_signal.isoformat()}")
+            if multi:
+                print(f"{label}Runner ids prefixed '{n + 1}/', bibs shifted by {n * bib_stride}")
+
+            # Check-in queue over the whole race, written as one more run
+            mass_ms, mass_tz = dt_to_ms(meta.mass_start_signal)
+
+            def resolved(items):
+                for ts, ev in items:
+                    ev.ts_ms += mass_ms
+                    ev.start_ms = mass_ms
+                    ev.tz_offset = mass_tz
+                    yield ts + mass_ms, ev
+
+            arrivals = heapq.merge(resolved(spill.merge(login_runs[0])), spill.merge(login_runs[1]),
+                                   key=timeline_sort_key)
+            queued = queue_logins(arrivals, login_config_for_race(login_config or {}, meta.race),
+                                  meta.event_name or meta.race)
+            path = os.path.join(spill.dir, f"logins-{n + 1}.jsonl")
+            with TimelineWriter(path) as w:
+                for ts, ev in queued:
+                    w.write(ts, ev, last=True)
+            if w.count:
+                runs.append(path)
+
+        # mass start
+        mass_start_runner = Runner('mass_start')
+        extra_events = []
+        for dt in (mass_start_times or []):
+            ts, tz_offset = dt_to_ms(dt)
+            extra_events.append((ts, SimEvent(ts, 'mass_start', 'mass_start', 'mass_start',
+                                              mass_start_runner, tz_offset=tz_offset,
+                                              note='Mass start at known time')))
+            print(f"Mass start event added at {ms_to_iso(ts, tz_offset)}")
+        extra_events.sort(key=timeline_sort_key)
+        path = spill.write_run(extra_events)
+        if path:
+            runs.append(path)
+
+        merged = spill.merge(runs)
+        first = next(merged, None)
+    except BaseException:
+        spill.cleanup()
+        raise
+    if first is None:
+        spill.cleanup()
+        print("No events found.")
+        return None
+    print(f"[spill] {spill.items} items in {len(runs)} run(s) under {spill.dir}")
+    return _spilled_timeline(spill, itertools.chain([first], merged))
+
+
+# --- Sharded replay (--workers N) ---
+#
+# One asyncio process tops out on a single core.  With --workers N the
+# parent builds the whole timeline as usual, so the login queue and the
+# random derived events are exactly those of a single-process run.  It then
+# deals the teams out to N shard files in the timeline format above;
+# events without a team (mass starts) go to the first shard.  Every worker
+# process replays its shard with its own event loop, WebSocket connections
+# and Navisport connection.
+#
+# All shards keep one clock.  They share the timeline's base time and, with
+# --compress-gaps, the gap mapping of the whole timeline.  Workers connect
+# first and then wait on a barrier.  When all have arrived the parent picks
+# a start instant SHARD_START_LEAD_MS ahead and releases them, so every
+# shard maps the base time to the same wall-clock ms and stamps identical
+# timestamps.  At the end the workers send their dispatch stats and
+# throughput meters back and the parent prints them merged.
+
+SHARD_START_LEAD_MS = 500     # barrier release → common start instant
+SHARD_READY_TIMEOUT = 120     # seconds to wait for every worker to connect
+
+
+def partition_timeline(timeline: Iterator[Tuple[int, SimEvent]], paths: List[str],
+                       gaps: Optional[GapCompressor] = None) -> Tuple[Optional[int], List[Tuple[int, int]]]:
+    """
+    Deal the teams of an ordered timeline round-robin (in order of first
+    appearance) into one timeline file per path.  ``gaps`` observes the
+    whole timeline on the way.  Returns (base ms, [(events, teams)] per shard).
+    """
+    writers = [TimelineWriter(path) for path in paths]
+    team_shard: Dict[Any, int] = {}
+    base = None
+    try:
+        for ts, ev in timeline:
+            if base is None:
+                base = ts
+            if gaps:
+                gaps.observe(ts)
+            team = ev.team_id
+            if team is None:
+                shard = 0
+            else:
+                shard = team_shard.get(team)
+                if shard is None:
+                    shard = team_shard[team] = len(team_shard) % len(writers)
+            writers[shard].write(ts, ev)
+    finally:
+        for w in writers:
+            w.close()
+    teams = [0] * len(writers)
+    for shard in team_shard.values():
+        teams[shard] += 1
+    return base, [(w.count, t) for w, t in zip(writers, teams)]
+
+
+def _shard_sink(opts: dict, speed: float) -> EventSink:
+    """A worker's own EventSink (and Navisport connection) from the shard options."""
+    navisport_sender = None
+    if opts['navisport']:
+        navisport_sender = NavisportSender(opts['navisport'], opts['navisport_event_id'],
+                                           chip_base=opts['navisport_chip_base'])
+    return EventSink(opts['host'], opts['port'], opts['one_conn_per_device'], opts['allowed_controls'],
+                     opts['finish_control'], navisport_sender, opts['no_ws'],
+                     device_pause=0.0 if math.isinf(speed) else DEVICE_SEND_PAUSE)
+
+
+def _merge_shard_stats(results: List[dict]) -> Tuple[dict, Dict[str, SinkMeter]]:
+    """Merge shard stats (Dispatcher.stats() plus a 'meters' dict) into one."""
+    merged = {'dispatched': 0, 'skipped': 0, 'lateness': {}, 'batch_sizes': LogHistogram()}
+    meters: Dict[str, SinkMeter] = {}
+    for stats in results:
+        merged['dispatched'] += stats['dispatched']
+        merged['skipped'] += stats['skipped']
+        merged['batch_sizes'].merge(stats['batch_sizes'])
+        for name, hist in stats['lateness'].items():
+            merged['lateness'].setdefault(name, LogHistogram()).merge(hist)
+        for name, meter in stats['meters'].items():
+            meters.setdefault(name, SinkMeter(name)).merge(meter)
+    return merged, meters
+
+
+async def _run_shard(path: str, opts: dict, barrier, go, start_value) -> dict:
+    loop = asyncio.get_running_loop()
+    sink = _shard_sink(opts, opts['speed'])
+    await sink.start()
+    await loop.run_in_executor(None, barrier.wait)
+    await loop.run_in_executor(None, go.wait)
+    dispatcher = await dispatch_timeline(read_timeline(path), sink, opts['speed'], opts['tick_ms'],
+                                         speed_profile=opts['speed_profile'], gaps=opts['gaps'],
+                                         base_ms=opts['base_ms'], start_ms=start_value.value,
+                                         report=False)
+    stats = dispatcher.stats()
+    stats['meters'] = sink.meters
+    return stats
+
+
+def _shard_worker(n: int, path: str, opts: dict, barrier, go, start_value, results):
+    """Worker process entry point: replay one shard and send its stats to ``results``."""
+    try:
+        results.put((n, asyncio.run(_run_shard(path, opts, barrier, go, start_value))))
+    except BaseException as e:
+        barrier.abort()    # do not leave the parent waiting for a worker that never arrives
+        results.put((n, {'error': f"{type(e).__name__}: {e}"}))
 
-    # mass start
-    for ts in (mass_start_times or []):
-        event = {
-            'timestamp': ts.isoformat(),
-            'runner_id': 'mass_start',
-            'device_id': 'mass_start',
-            'device_type': 'mass_start',
-            'event': 'mass_start',
-            'note': 'Mass start at known time'
-        }
-        extra_events.append((ts, event))
-        print(f"Mass start event added at {ts.isoformat()}")
 
-    # login — bib-based + non-first-leg staging, with queue simulation config
-    mass_start_signal = mass_start_signal or (mass_start_times or [None])[0] or base_time
-    _login_cfg = login_config or {}
-    if 'login' in _login_cfg:
-        _login_cfg = _login_cfg['login']
-    extra_events += assign_checkin_events(all_by_runner, mass_start_signal,
-                                          bib_map or {}, _login_cfg)
-
-    if login_only:
-        combined = extra_events[:]  # only login + mass start events
-    else:
-        combined = extra_events + [e for lst in published_by_runner.values() for e in lst]
+def run_sharded(timeline: Iterator[Tuple[int, SimEvent]], workers: int, opts: dict,
+                compress_gaps: Optional[Tuple[int, int]] = None):
+    """
+    Replay ``timeline`` in ``workers`` processes, teams partitioned between
+    them.  ``opts`` carries the sink, Navisport and dispatch settings.
+    """
+    import multiprocessing
+    import queue
+    import tempfile
+
+    gaps = GapCompressor(*compress_gaps) if compress_gaps else None
+    with tempfile.TemporaryDirectory(prefix='relaysim-shards-') as tmpdir:
+        paths = [os.path.join(tmpdir, f"shard{n + 1}.jsonl") for n in range(workers)]
+        base_ms, counts = partition_timeline(timeline, paths, gaps)
+        if base_ms is None:
+            print("No events found.")
+            return
+        if gaps:
+            gaps.frozen = True
+        shards = [(n, path) for n, path in enumerate(paths) if counts[n][0]]
+        for n, path in shards:
+            events, teams = counts[n]
+            print(f"[workers] shard {n + 1}: {teams} teams, {events} events")
+
+        opts = dict(opts, gaps=gaps, base_ms=base_ms)
+        barrier = multiprocessing.Barrier(len(shards) + 1)
+        go = multiprocessing.Event()
+        start_value = multiprocessing.Value('q', 0)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_shard_worker, name=f"shard{n + 1}",
+                                         args=(n, path, opts, barrier, go, start_value, results))
+                 for n, path in shards]
+        for proc in procs:
+            proc.start()
 
-    if not login_only:
-        # dump, status updates, itkumuuri
-        for runner, punches in all_by_runner.items():
-            if not punches:
+        try:
+            barrier.wait(timeout=SHARD_READY_TIMEOUT)
+        except threading.BrokenBarrierError:
+            print("[workers] not every worker got ready; aborting")
+        else:
+            start_value.value = now_ms() + SHARD_START_LEAD_MS
+            go.set()
+            print(f"[workers] {len(shards)} workers started together at "
+                  f"{ms_to_iso(start_value.value)} (base {ms_to_iso(base_ms)})")
+
+        # Collect before join(): a worker cannot exit while its result is still queued
+        stats_by_shard: Dict[int, dict] = {}
+        while len(stats_by_shard) < len(procs):
+            try:
+                n, stats = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs):
+                    break
                 continue
-            evs_sorted = sorted(punches, key=lambda x: x[0])
-            first_ev = evs_sorted[0][1]
-            iof_runner_status = first_ev.get('status') or ''
-            has_real_punches = any(e.get('event') == 'punch' for _, e in evs_sorted)
-
-            if has_real_punches:
-                # --- purku (chip dump after finish) ---
-                last_ts = evs_sorted[-1][0]
-                minutes_after = random.randint(10, 15)
-                purku_ts = last_ts + timedelta(minutes=minutes_after)
-                punches_dump = [{
-                    'control': e.get('device_id'),
-                    'time': e.get('timestamp'),
-                    'status': e.get('status'),
-                    'device_type': e.get('device_type')
-                } for _, e in evs_sorted if e.get('event') == 'punch']
-
-                extra_events.append((purku_ts, {
-                    'timestamp': purku_ts.isoformat(),
-                    'runner_id': runner,
-                    'team_id': first_ev.get('team_id'),
-                    'leg': first_ev.get('leg'),
-                    'runner_status': iof_runner_status,
-                    'device_id': random.choice(PURKU_DEVICES),
-                    'device_type': 'results_purku',
-                    'event': 'results_purku',
-                    'purku_time': purku_ts.isoformat(),
-                    'punches': punches_dump,
-                    'note': f'purku {minutes_after}min after last punch'
-                }))
-
-                # OK runners: hylkäysesitys → itkumuuri → manual_ok
-                # Purku may detect missing punches and set a temporary Dnf
-                # (hylkäysesitys). The runner appeals at itkumuuri where
-                # officials verify the backup paper and approve the result.
-                if iof_runner_status.upper() == 'OK':
-                    itkumuuri_delay = random.randint(5, 15)
-                    itkumuuri_ts = purku_ts + timedelta(minutes=itkumuuri_delay)
-                    extra_events.append((itkumuuri_ts, {
-                        'timestamp': itkumuuri_ts.isoformat(),
-                        'runner_id': runner,
-                        'team_id': first_ev.get('team_id'),
-                        'leg': first_ev.get('leg'),
-                        'device_id': random.choice(ITKUMUURI_DEVICES),
-                        'device_type': 'itkumuuri',
-                        'event': 'itkumuuri',
-                        'status': 'Ok',
-                        'note': f'hylkäysesitys → itkumuuri {itkumuuri_delay}min after purku',
-                    }))
-                    ok_extra = random.randint(5, 45)
-                    ok_ts = itkumuuri_ts + timedelta(minutes=ok_extra)
-                    extra_events.append((ok_ts, {
-                        'timestamp': ok_ts.isoformat(),
-                        'runner_id': runner,
-                        'team_id': first_ev.get('team_id'),
-                        'leg': first_ev.get('leg'),
-                        'device_id': 'officials',
-                        'device_type': 'manual_ok',
-                        'event': 'manual_ok',
-                        'note': (f'manual OK {itkumuuri_delay + ok_extra}min after purku '
-                                 f'(paper approved at itkumuuri)'),
-                    }))
+            stats_by_shard[n] = stats
+        for proc in procs:
+            proc.join()
+
+    ok = []
+    for n, _ in shards:
+        stats = stats_by_shard.get(n)
+        if stats is None or 'error' in stats:
+            print(f"[workers] shard {n + 1} failed: {(stats or {}).get('error', 'no result')}")
+        else:
+            ok.append(stats)
+    merged, meters = _merge_shard_stats(ok)
+    label = speed_label(opts['speed']) + (' × profile' if opts['speed_profile'] else '')
+    for line in dispatch_report(merged, f"{label}, {len(shards)} workers", opts['tick_ms'] / 1000, gaps):
+        print(line)
+    for meter in meters.values():
+        line = meter.report()
+        if line:
+            print(line)
+
+
+# --- Coordinator / remote workers (--coordinator, --worker) ---
+#
+# The same sharding over TCP, for more connections and messages than one
+# machine can produce.  The coordinator builds the timeline, splits the
+# teams into --expect-workers shards and waits for that many
+# ``simulator.py --worker HOST:PORT`` processes.  Each worker sends its
+# results to the listener / Navisport named on its own command line.
+#
+# The protocol is JSON lines over one TCP connection per worker:
+#
+#   worker → hello                      coordinator → shard header, the shard's
+#                                       timeline lines, shard_end
+#   worker → ready (sink connected)     coordinator → ping × CLOCK_SYNC_ROUNDS
+#   worker → pong (its wall clock)      coordinator → start
+#   worker → progress ... done | error
+#
+# Clock offsets are estimated NTP style: the coordinator stamps t0, the
+# worker answers with its clock t1 and the reply arrives at t2.  The
+# offset is t1 - (t0 + t2) / 2, and the round with the shortest round trip
+# wins.  Each worker gets the common start instant in its own clock, plus
+# the shift that keeps wire timestamps on the coordinator's clock.
+
+CLOCK_SYNC_ROUNDS = 8
+COORD_START_LEAD_MS = 1000    # last clock sync → common start instant
+COORD_PROGRESS_SECONDS = 5.0  # worker progress report interval
+COORD_STREAM_LIMIT = 1 << 20  # longest accepted protocol line (a purku with its punches)
+
+
+def parse_host_port(value: str, default_host: str = '0.0.0.0') -> Tuple[str, int]:
+    """'HOST:PORT' or 'PORT' → (host, port)."""
+    host, sep, port = str(value).rpartition(':')
+    return (host if sep and host else default_host), int(port)
+
+
+def _wall_ms() -> float:
+    return time.time_ns() / 1_000_000
+
+
+async def _send_json(writer: asyncio.StreamWriter, obj: dict):
+    writer.write(json.dumps(obj, separators=(',', ':')).encode() + b'\n')
+    await writer.drain()
+
+
+async def _recv_json(reader: asyncio.StreamReader) -> dict:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    return json.loads(line)
+
+
+class RemoteWorker:
+    """Coordinator-side state of one connected worker."""
+
+    def __init__(self, n: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, name: str):
+        self.n = n
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.offset_ms = 0.0          # worker clock - coordinator clock
+        self.rtt_ms = 0.0
+        self.dispatched = 0
+        self.stats: Optional[dict] = None
+        self.error: Optional[str] = None
+
+    async def send_shard(self, path: str, header: dict):
+        with open(path, 'rb') as f:
+            lines = f.readlines()
+        await _send_json(self.writer, dict(header, type='shard', lines=len(lines)))
+        for i in range(0, len(lines), 1000):
+            self.writer.writelines(lines[i:i + 1000])
+            await self.writer.drain()
+        await _send_json(self.writer, {'type': 'shard_end'})
+
+    async def sync_clock(self, rounds: int = CLOCK_SYNC_ROUNDS):
+        best = None
+        for _ in range(rounds):
+            t0 = _wall_ms()
+            await _send_json(self.writer, {'type': 'ping', 't0': t0})
+            reply = await _recv_json(self.reader)
+            t2 = _wall_ms()
+            rtt = t2 - t0
+            if best is None or rtt < best[0]:
+                best = (rtt, reply['t1'] - (t0 + t2) / 2)
+        self.rtt_ms, self.offset_ms = best
+
+    async def follow(self):
+        """Read progress until the worker reports done or error."""
+        try:
+            while True:
+                msg = await _recv_json(self.reader)
+                if msg['type'] == 'progress':
+                    self.dispatched = msg['dispatched']
+                elif msg['type'] == 'done':
+                    self.dispatched = msg['stats']['dispatched']
+                    self.stats = msg['stats']
+                    return
+                elif msg['type'] == 'error':
+                    self.error = msg['error']
+                    return
+        except (ConnectionError, ValueError) as e:
+            self.error = f"lost connection: {e}"
 
-            else:
-                # --- status_update for DNS/DNF/DSQ runners with no chip data ---
-                # Fire shortly after their scheduled start time so Navisport reflects
-                # the correct status without waiting for a chip download.
-                start_ts = evs_sorted[0][0]
-                delay_min = random.randint(5, 20)
-                su_ts = start_ts + timedelta(minutes=delay_min)
-                extra_events.append((su_ts, {
-                    'timestamp': su_ts.isoformat(),
-                    'runner_id': runner,
-                    'team_id': first_ev.get('team_id'),
-                    'leg': first_ev.get('leg'),
-                    'runner_status': iof_runner_status,
-                    'device_id': 'officials',
-                    'device_type': 'status_update',
-                    'event': 'status_update',
-                    'note': f'status update {delay_min}min after start (no chip data, status={iof_runner_status})',
-                }))
-
-            # itkumuuri for DNF/DSQ runners — OK runners handled above,
-            # DNS runners do not appeal
-            if (iof_runner_status
-                    and iof_runner_status.upper() not in ('OK', 'FINISHED', 'DIDNOTSTART')):
-                ref_ts = evs_sorted[-1][0]
-                itkumuuri_delay = random.randint(5, 60)
-                itkumuuri_ts = ref_ts + timedelta(minutes=itkumuuri_delay)
-                extra_events.append((itkumuuri_ts, {
-                    'timestamp': itkumuuri_ts.isoformat(),
-                    'runner_id': runner,
-                    'device_id': random.choice(ITKUMUURI_DEVICES),
-                    'device_type': 'itkumuuri',
-                    'event': 'itkumuuri',
-                    'status': iof_runner_status,
-                    'note': f'itkumuuri {itkumuuri_delay}min after last event (status={iof_runner_status})'
-                }))
-
-    # --- 5. Yhdistä ja järjestä ---
-    if not login_only:
-        combined = extra_events + [e for lst in published_by_runner.values() for e in lst]
-    else:
-        combined = extra_events[:]
-    combined.sort(key=lambda x: event_sort_key(x[1]))
 
-    # --- 6. Login queue simulation ---
-    # Walk through login events chronologically and compute the actual
-    # check-in time given a limited pool of devices and processing_seconds
-    # per runner.  When a device breaks mid-check-in it is removed from the
-    # pool; runners queued for it are redistributed to other devices.  The
-    # device re-joins the pool after broken_reader_downtime_seconds.
-    _proc_sec = _login_cfg.get('processing_seconds', 20)
-    _broken_prob = _login_cfg.get('broken_reader_probability', 0.0)
-    _broken_extra = _login_cfg.get('broken_reader_extra_delay_seconds', 60)
-    _broken_downtime = _login_cfg.get('broken_reader_downtime_seconds', 300)
-    _dev_count = _login_cfg.get('device_count', 10)
-    _login_devices = [f"login_{i}" for i in range(1, _dev_count + 1)]
-
-    _FAR_FUTURE = datetime.max.replace(tzinfo=timezone.utc)
-
-    if _proc_sec > 0 or _broken_prob > 0:
-        _busy_until: Dict[str, datetime] = {}
-        _available_devices = list(_login_devices)
-        _broken_devices: Dict[str, datetime] = {}
-
-        for ts, ev in combined:
-            if ev.get('event') != 'login':
-                continue
+def _stats_to_state(stats: dict, meters: Dict[str, SinkMeter]) -> dict:
+    return {'dispatched': stats['dispatched'], 'skipped': stats['skipped'],
+            'lateness': {k: h.to_state() for k, h in stats['lateness'].items()},
+            'batch_sizes': stats['batch_sizes'].to_state(),
+            'meters': {k: m.to_state() for k, m in meters.items()}}
 
-            # Re-add devices whose downtime has elapsed
-            for dev_id, fail_ts in list(_broken_devices.items()):
-                if ts >= fail_ts + timedelta(seconds=_broken_downtime):
-                    _available_devices.append(dev_id)
-                    del _broken_devices[dev_id]
-                    _busy_until[dev_id] = ts  # reset so next min() picks real time
-
-            # Pick earliest-free among available devices
-            if _available_devices:
-                dev = min(_available_devices,
-                          key=lambda d: _busy_until.get(d, ts))
-                actual_start = max(ts, _busy_until.get(dev, ts))
-            else:
-                dev = _login_devices[0]
-                actual_start = ts
 
-            charge = timedelta(seconds=_proc_sec)
-            note_parts = []
-            redirected = False
+def _stats_from_state(state: dict, clock_offset_ms: float) -> dict:
+    return {'dispatched': state['dispatched'], 'skipped': state['skipped'],
+            'lateness': {k: LogHistogram.from_state(h) for k, h in state['lateness'].items()},
+            'batch_sizes': LogHistogram.from_state(state['batch_sizes']),
+            'meters': {k: SinkMeter.from_state(m, clock_offset_ms / 1000) for k, m in state['meters'].items()}}
 
-            if _broken_prob > 0 and random.random() < _broken_prob:
-                # Device breaks — remove from pool
-                _broken_devices[dev] = actual_start
-                _busy_until[dev] = _FAR_FUTURE
-                try:
-                    _available_devices.remove(dev)
-                except ValueError:
-                    pass
-                note_parts.append(f'{dev} BROKEN')
-
-                # Redirect this runner to an alternative device
-                extra_sec = random.uniform(1, _broken_extra)
-                charge += timedelta(seconds=extra_sec)
-                note_parts.append(f'+{extra_sec:.0f}s reroute')
-
-                if _available_devices:
-                    alt_dev = min(
-                        _available_devices,
-                        key=lambda d: _busy_until.get(d, ts))
-                    alt_start = max(ts, _busy_until.get(alt_dev, ts))
-                    dev = alt_dev
-                    actual_start = alt_start
-                    redirected = True
-                    note_parts.append(f'→ {dev}')
-
-            ev['device_id'] = dev
-            checkout_ts = actual_start + charge
-            _busy_until[dev] = checkout_ts
-            ev['timestamp'] = checkout_ts.isoformat()
-
-            queue_wait = (actual_start - ts).total_seconds()
-            if queue_wait > 0:
-                note_parts.append(f'queued {queue_wait:.0f}s')
-            if note_parts:
-                ev['note'] = ev.get('note', '') + ' | ' + ' '.join(note_parts)
-
-        # Re-sort because login timestamps may have shifted
-        combined.sort(key=lambda x: event_sort_key(x[1]))
 
-    # --- 7. Shiftataan nykyhetkeen ---
-    base_time = combined[0][0]
-    now = datetime.now(timezone.utc)
-    shift = now - base_time
+async def run_coordinator(timeline: Iterator[Tuple[int, SimEvent]], listen: str, workers: int,
+                          speed: float, tick_ms: float = DISPATCH_TICK_MS,
+                          speed_profile: Optional[List[Tuple[Any, float]]] = None,
+                          compress_gaps: Optional[Tuple[int, int]] = None):
+    """Split ``timeline`` between ``workers`` remote workers and run them on one clock."""
+    import tempfile
 
-    tasks = []
-    for ts, ev in combined:
-        delay = (ts - base_time).total_seconds() / speed
+    gaps = GapCompressor(*compress_gaps) if compress_gaps else None
+    with tempfile.TemporaryDirectory(prefix='relaysim-coord-') as tmpdir:
+        paths = [os.path.join(tmpdir, f"shard{n + 1}.jsonl") for n in range(workers)]
+        base_ms, counts = partition_timeline(timeline, paths, gaps)
+        if base_ms is None:
+            print("No events found.")
+            return
+        if gaps:
+            gaps.frozen = True
+        total = sum(events for events, _ in counts)
 
-        async def schedule_and_send(delay_sec, event, original_ts):
-            if event.get('event') == 'punch' and not control_allowed(event.get('device_id'), allowed_controls):
-                return
+        # --- wait for the workers ---
+        connected: List[RemoteWorker] = []
+        all_here = asyncio.Event()
 
-            if finish_control and str(event.get("device_id")) == str(finish_control):
-                display_id = "maali_1"
-                event["device_type"] = "finish"
-            else:
-                display_id = event.get('device_id') or f"dev_{event.get('device_type')}"
+        async def on_connect(reader, writer):
+            try:
+                hello = await _recv_json(reader)
+            except (ConnectionError, ValueError):
+                writer.close()
+                return
+            if len(connected) >= workers:
+                await _send_json(writer, {'type': 'error', 'error': 'all shards already assigned'})
+                writer.close()
+                return
+            w = RemoteWorker(len(connected), reader, writer, hello.get('name', '?'))
+            connected.append(w)
+            print(f"[coord] worker {w.n + 1}/{workers} connected: {w.name}")
+            if len(connected) == workers:
+                all_here.set()
+
+        host, port = parse_host_port(listen)
+        server = await asyncio.start_server(on_connect, host, port, limit=COORD_STREAM_LIMIT)
+        print(f"[coord] {total} events in {workers} shards; waiting for workers on {host}:{port}")
+        try:
+            await all_here.wait()
+
+            # --- shards, readiness, clocks, start ---
+            header = {'base_ms': base_ms, 'speed': 'max' if math.isinf(speed) else speed,
+                      'tick_ms': tick_ms, 'speed_profile': speed_profile,
+                      'gaps': gaps.to_state() if gaps else None}
+            await asyncio.gather(*(w.send_shard(paths[w.n], header) for w in connected))
+            for w in connected:
+                msg = await _recv_json(w.reader)
+                if msg.get('type') != 'ready':
+                    raise RuntimeError(f"worker {w.n + 1} ({w.name}): {msg.get('error', msg)}")
+            for w in connected:
+                await w.sync_clock()
+                print(f"[coord] worker {w.n + 1} ({w.name}): {counts[w.n][1]} teams, "
+                      f"{counts[w.n][0]} events, clock offset {w.offset_ms:+.1f} ms (rtt {w.rtt_ms:.1f} ms)")
+            start_ms = int(_wall_ms()) + COORD_START_LEAD_MS
+            shift_ms = start_ms - base_ms
+            for w in connected:
+                await _send_json(w.writer, {'type': 'start', 'start_ms': int(start_ms + w.offset_ms),
+                                            'shift_ms': shift_ms})
+            print(f"[coord] start at {ms_to_iso(start_ms)} (coordinator clock)")
+
+            # --- progress until every worker is done ---
+            followers = asyncio.gather(*(w.follow() for w in connected))
+            while not followers.done():
+                await asyncio.wait([followers], timeout=COORD_PROGRESS_SECONDS)
+                done = sum(w.dispatched for w in connected)
+                print(f"[coord] progress: {done}/{total} events dispatched")
+        finally:
+            for w in connected:
+                w.writer.close()
+            server.close()
+            await server.wait_closed()
+
+    results = []
+    for w in connected:
+        if w.error:
+            print(f"[coord] worker {w.n + 1} ({w.name}) failed: {w.error}")
+        else:
+            results.append(_stats_from_state(w.stats, w.offset_ms))
+    merged, meters = _merge_shard_stats(results)
+    label = speed_label(speed) + (' × profile' if speed_profile else '')
+    for line in dispatch_report(merged, f"{label}, {workers} remote workers", tick_ms / 1000, gaps):
+        print(line)
+    for meter in meters.values():
+        line = meter.report()
+        if line:
+            print(line)
+
+
+async def run_worker(coordinator: str, opts: dict, connect_timeout: float = 60.0):
+    """Replay the shard a coordinator hands out; ``opts`` are this host's sink options."""
+    import tempfile
+    import socket
+
+    host, port = parse_host_port(coordinator, '127.0.0.1')
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port, limit=COORD_STREAM_LIMIT)
+            break
+        except OSError as e:
+            if time.monotonic() > deadline:
+                print(f"[worker] cannot reach coordinator {host}:{port}: {e}")
+                return
+            await asyncio.sleep(1.0)
+    await _send_json(writer, {'type': 'hello', 'name': f"{socket.gethostname()}:{os.getpid()}"})
 
-            await asyncio.sleep(max(0.0, delay_sec))
+    with tempfile.TemporaryDirectory(prefix='relaysim-worker-') as tmpdir:
+        path = os.path.join(tmpdir, 'shard.jsonl')
+        try:
+            header = await _recv_json(reader)
+            if header.get('type') != 'shard':
+                print(f"[worker] coordinator refused: {header.get('error', header)}")
+                return
+            with open(path, 'wb') as f:
+                for _ in range(header['lines']):
+                    f.write(await reader.readline())
+            await _recv_json(reader)   # shard_end
+            speed = parse_speed(header['speed'])
+            print(f"[worker] shard of {header['lines']} lines received from {host}:{port}")
 
-            sent_ts = (original_ts + shift).isoformat()
-            msg_obj = {
-                'device_id': display_id,
-                'device_type': event.get('device_type'),
-                'runner_id': event.get('runner_id'),
-                'event': event.get('event'),
-                'timestamp': sent_ts
-            }
+            try:
+                sink = _shard_sink(opts, speed)
+                await sink.start()
+            except Exception as e:
+                await _send_json(writer, {'type': 'error', 'error': f"sink: {e}"})
+                return
+            await _send_json(writer, {'type': 'ready'})
+            while True:
+                msg = await _recv_json(reader)
+                if msg['type'] == 'ping':
+                    await _send_json(writer, {'type': 'pong', 't1': _wall_ms()})
+                elif msg['type'] == 'start':
+                    break
 
-            if event.get('event') == 'login':
-                msg_obj.update({'login_time': sent_ts, 'note': event.get('note')})
-            elif event.get('event') == 'results_purku':
-                shifted_punches = []
-                for p in event.get('punches', []):
-                    try:
-                        orig_p_dt = datetime.fromisoformat(p['time'])
-                        shifted_p = (orig_p_dt + shift).isoformat()
-                    except Exception:
-                        shifted_p = p.get('time')
-                    shifted_punches.append({**p, 'time': shifted_p})
-                msg_obj.update({'purku_time': sent_ts, 'punches': shifted_punches, 'note': event.get('note')})
-            elif event.get('event') == 'itkumuuri':
-                msg_obj.update({'status': event.get('status'), 'note': event.get('note')})
+            current: List[Dispatcher] = []
 
-            if not no_ws:
-                key = display_id if one_conn_per_device else f"{display_id}_{int(datetime.now().timestamp()*1000)%1000000}"
-                if key not in device_clients:
-                    device_clients[key] = DeviceClient(key, host, port)
-                    await device_clients[key].connect()
-                await device_clients[key].send(make_message(msg_obj))
+            async def report_progress():
+                while True:
+                    await asyncio.sleep(COORD_PROGRESS_SECONDS)
+                    if current:
+                        await _send_json(writer, {'type': 'progress', 'dispatched': current[0].dispatched})
 
-            if navisport_sender:
-                await navisport_sender.on_event(event, sent_ts, msg_obj)
+            progress = asyncio.create_task(report_progress())
+            gaps = GapCompressor.from_state(header['gaps']) if header['gaps'] else None
+            try:
+                dispatcher = await dispatch_timeline(
+                    read_timeline(path), sink, speed, header['tick_ms'],
+                    speed_profile=header['speed_profile'], gaps=gaps,
+                    base_ms=header['base_ms'], start_ms=msg['start_ms'], shift_ms=msg['shift_ms'],
+                    on_dispatcher=current.append)
+            finally:
+                progress.cancel()
+            if dispatcher is None:    # empty shard: more workers than teams
+                empty = {'dispatched': 0, 'skipped': 0, 'lateness': {}, 'batch_sizes': LogHistogram()}
+                stats = _stats_to_state(empty, sink.meters)
+            else:
+                stats = _stats_to_state(dispatcher.stats(), sink.meters)
+            await _send_json(writer, {'type': 'done', 'stats': stats})
+        except (ConnectionError, ValueError) as e:
+            print(f"[worker] coordinator connection failed: {e}")
+        except Exception as e:
+            await _send_json(writer, {'type': 'error', 'error': f"{type(e).__name__}: {e}"})
+            raise
+        finally:
+            writer.close()
+
+
+# --- Follow mode (live, periodically re-exported result files) ---
+#
+# During a race the results system re-exports the whole ResultList every
+# few seconds.  Each new version is split into TeamResult byte blocks; only
+# blocks whose bytes changed since the previous version are parsed, and their
+# events are diffed per runner against what has already been sent.  New
+# punches and status changes go out at once with their original timestamps,
+# so the simulator works as a near-real-time relay of the live race.
+
+FOLLOW_POLL_SECONDS = 5.0
+FOLLOW_SNAPSHOT_SUFFIXES = ('.xml', '.xml.gz', '.xml.zst')
+# IOF statuses of runners that have not finished yet; not worth a status_update on first sight
+_FOLLOW_QUIET_STATUSES = ('OK', 'ACTIVE', 'INACTIVE')
+
+
+class RaceFollower:
+    """Diffs successive versions of one IOF3 ResultList and returns only what changed."""
+
+    def __init__(self, team_range: Optional[set[int]] = None,
+                 leg_set: Optional[set[int]] = None,
+                 finish_control: Optional[str] = None):
+        self.team_range = team_range
+        self.leg_set = leg_set
+        self.finish_control = finish_control
+        self.team_hashes: set = set()                # digests of the TeamResult blocks already seen
+        self.sent_splits: Dict[str, set] = {}        # runner_id → {(control, raw_time)}
+        self.statuses: Dict[str, str] = {}           # runner_id → last IOF status
+        self.versions = 0
+        self.last_changed_teams = 0
+
+    def update(self, iof_path: str) -> List[SimEvent]:
+        """
+        Read one version of the file and return its new punch and status_update
+        events in timestamp order.  Raises if the file is unreadable (e.g.
+        half-written); the follower state is then left unchanged.
+        """
+        import hashlib
+
+        with iofreader.mapped(iof_path) as buf:
+            ranges, _skeleton, prolog, root_open, root_close = _split_document(buf)
+            hashes = set()
+            changed = []
+            for start, end in ranges:
+                digest = hashlib.blake2b(buf[start:end], digest_size=16).digest()
+                hashes.add(digest)
+                if digest not in self.team_hashes:
+                    changed.append((start, end))
+
+            team_events: List[SimEvent] = []
+            for i in range(0, len(changed), TEAM_INDEX_BATCH):
+                batch = changed[i:i + TEAM_INDEX_BATCH]
+                root = ET.fromstring(b''.join([prolog, root_open,
+                                               *(buf[s:e] for s, e in batch), root_close]))
+                ns = _iof_ns(root.tag)
+                for team in root:
+                    team_bib_text = _team_bib_text(team, ns)
+                    if _team_in_range(team_bib_text, self.team_range):
+                        team_events.extend(_team_result_events(team, ns, team_bib_text, self.leg_set))
+
+        new = self._diff(team_events)
+        self.team_hashes = hashes
+        self.versions += 1
+        self.last_changed_teams = len(changed)
+        new.sort(key=lambda e: e.ts_ms)
+        return new
+
+    def _diff(self, team_events: List[SimEvent]) -> List[SimEvent]:
+        new: List[SimEvent] = []
+        runners: Dict[str, Runner] = {}
+        for ev in team_events:
+            rid = ev.runner_id
+            runners[rid] = ev.runner
+            if ev.event != 'punch':
+                continue
+            sent = self.sent_splits.setdefault(rid, set())
+            key = (ev.device_id, ev.raw_time)
+            if key in sent:
+                continue
+            sent.add(key)
+            if self.finish_control and str(ev.device_id) == str(self.finish_control):
+                ev.device_type = 'finish'
+            new.append(ev)
+
+        detected_ms = now_ms()
+        for rid, runner in runners.items():
+            status = runner.status or 'OK'
+            prev = self.statuses.get(rid)
+            self.statuses[rid] = status
+            if status == prev or (prev is None and status.upper() in _FOLLOW_QUIET_STATUSES):
+                continue
+            new.append(SimEvent(
+                detected_ms, 'status_update', 'officials', 'status_update', runner,
+                tz_offset=runner.tz_offset, status=status, start_ms=runner.start_ms,
+                note=f'status {prev or "-"} → {status} (live export)'))
+        return new
 
-        tasks.append(asyncio.create_task(schedule_and_send(delay, ev, ts)))
 
-    # --- 7. Odota kaikki ja sulje ---
-    await asyncio.gather(*tasks)
-    await asyncio.gather(*(c.close() for c in device_clients.values()))
-    if navisport_sender:
-        await navisport_sender.close()
+def _pending_snapshots(path: str, done: Dict[str, tuple]) -> List[str]:
+    """
+    Files under ``path`` (a file, or a directory of snapshots) whose size or
+    mtime differs from what ``done`` records, oldest first.
+    """
+    if os.path.isdir(path):
+        names = [os.path.join(path, n) for n in os.listdir(path)
+                 if n.lower().endswith(FOLLOW_SNAPSHOT_SUFFIXES)]
+    else:
+        names = [path]
+    pending = []
+    for name in names:
+        try:
+            st = os.stat(name)
+        except OSError:
+            continue
+        if done.get(name) != (st.st_size, st.st_mtime_ns):
+            pending.append((st.st_mtime_ns, name))
+    return [name for _, name in sorted(pending)]
+
+
+async def follow_iof(path: str, sink: EventSink, follower: RaceFollower,
+                     interval: float = FOLLOW_POLL_SECONDS):
+    """Poll ``path`` and relay every new punch / status change until cancelled."""
+    loop = asyncio.get_event_loop()
+    done: Dict[str, tuple] = {}
+    await sink.start()
+    print(f"[follow] watching {path} every {interval:g}s — Ctrl+C to stop")
+    try:
+        while True:
+            for snap in _pending_snapshots(path, done):
+                try:
+                    st = os.stat(snap)
+                    t0 = time.time()
+                    new = await loop.run_in_executor(None, follower.update, snap)
+                except Exception as e:
+                    # typically a half-written export; try again on the next poll
+                    print(f"[follow] {os.path.basename(snap)} not readable yet: {e}")
+                    break
+                done[snap] = (st.st_size, st.st_mtime_ns)
+                print(f"[follow] {os.path.basename(snap)} v{follower.versions}: "
+                      f"{follower.last_changed_teams} changed team(s), {len(new)} new event(s) "
+                      f"({time.time() - t0:.2f}s)")
+                for ev in new:
+                    if sink.accepts(ev):
+                        await sink.send(ev, ev.ts_ms)
+            await asyncio.sleep(interval)
+    finally:
+        await sink.close()
 
 
 # --- CLI ---
 
 def main():
     p = argparse.ArgumentParser(description="relay IOF3.xml -> relayreplay for simulating various aspects")
-    p.add_argument('-i', '--iof', required=True, help='path to iof3.xml')
+    p.add_argument('-i', '--iof', action='append', default=[],
+                   help='path to iof3.xml; repeat to replay several races (e.g. Venla and Jukola) on one timeline')
+    p.add_argument('--export-timeline', default=None, metavar='FILE',
+                   help='Build the full timeline, write it to FILE (.jsonl, .jsonl.gz or .jsonl.zst) and exit')
+    p.add_argument('--replay-timeline', default=None, metavar='FILE',
+                   help='Replay a timeline written by --export-timeline instead of reading --iof '
+                        '(no XML parsing, config or random generation)')
+    p.add_argument('--follow', action='store_true', default=False,
+                   help='Live relay: watch the --iof file (or a directory of snapshots) and send only '
+                        'the punches and status changes that appear in each new version')
+    p.add_argument('--follow-interval', type=float, default=FOLLOW_POLL_SECONDS,
+                   help=f'Polling interval in seconds for --follow (default {FOLLOW_POLL_SECONDS:g})')
+    p.add_argument('--bib-stride', type=int, default=10000,
+                   help='With several --iof files, bibs (and so chip numbers) of the N:th file are '
+                        'shifted by (N-1)*stride so the races cannot collide (default 10000)')
     p.add_argument('-H', '--host', default='127.0.0.1', help='server host')
     p.add_argument('-P', '--port', type=int, default=8080, help='server port')
     p.add_argument('-f', '--controls-file', help='Path to file with allowed control codes, one per line')
     p.add_argument('-u', '--controls-url', help='URL returning JSON array of allowed control codes')
-    p.add_argument('-s', '--speed', type=float, default=1.0, help='1.0 realtime, 2.0 twice as fast')
+    p.add_argument('-s', '--speed', type=parse_speed, default=1.0,
+                   help="1.0 realtime, 2.0 twice as fast, 'max' = as fast as the outputs accept")
+    p.add_argument('--speed-profile', type=parse_speed_profile, default=None, metavar='AT=SPEED,...',
+                   help='Speed by race time, e.g. "0=1,1.5=20,10=1": AT is hours after the timeline '
+                        'start or an ISO time; --speed multiplies it (default: config speed_profile)')
+    p.add_argument('--tick-ms', type=float, default=DISPATCH_TICK_MS,
+                   help=f'Events due within this many ms of wall time are sent as one batch '
+                        f'(default {DISPATCH_TICK_MS:g}; 0 = only events that are already due)')
+    p.add_argument('--virtual-time', nargs='?', const='now', default=None, metavar='START',
+                   help='Run on a virtual clock: skip the waiting between events instead of sleeping, '
+                        'with the timestamps of a real-time run started at START (ISO time, '
+                        'default now)')
+    p.add_argument('--compress-gaps', type=parse_gap_compression, default=None, metavar='N:M',
+                   help='Play every idle gap longer than N seconds of race time as M seconds '
+                        '(e.g. 300:10); events keep their original timestamps on the wire')
+    p.add_argument('--workers', type=int, default=1,
+                   help='Replay in N processes, teams split between them, all started on one '
+                        'common clock (default 1)')
+    p.add_argument('--coordinator', default=None, metavar='[HOST:]PORT',
+                   help='Do not send anything: listen on HOST:PORT, split the timeline between '
+                        '--expect-workers remote --worker processes and start them on one clock')
+    p.add_argument('--expect-workers', type=int, default=1,
+                   help='Number of --worker processes the coordinator waits for (default 1)')
+    p.add_argument('--worker', default=None, metavar='HOST:PORT',
+                   help='Replay the shard handed out by the coordinator at HOST:PORT '
+                        '(no --iof; outputs come from this command line)')
+    p.add_argument('--control-port', type=int, default=None,
+                   help='Serve the runtime control API (pause/resume/speed/seek) on 127.0.0.1:PORT')
+    p.add_argument('--checkpoint', default=None, metavar='FILE',
+                   help='Save the run state (dispatch cursor, random state, Navisport caches) to FILE '
+                        'periodically and on Ctrl-C, for --resume')
+    p.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL_SECONDS, metavar='S',
+                   help=f'Seconds between checkpoint saves (default {CHECKPOINT_INTERVAL_SECONDS})')
+    p.add_argument('--resume', default=None, metavar='FILE',
+                   help='Continue the run checkpointed in FILE: same command line, next unsent event, '
+                        'same time shift (keeps saving to FILE unless --checkpoint is given)')
     p.add_argument('-o', '--one-conn-per-device', action='store_true', default=True,
                    help='If set, use one TCP connection per device id (default: create unique client per event)')
     p.add_argument('-t', '--start-offset', type=float, default=0.0,
@@ -1606,6 +5006,24 @@ def main():
                    help='Only process the first N teams (XML order, after --team-range filter)')
     p.add_argument('--legs', default=None,
                    help='Leg numbers to simulate, e.g. "4" or "2-4" or "1,3"')
+    p.add_argument('--stream-parse', action='store_true', default=False,
+                   help='Parse the IOF XML incrementally one TeamResult at a time (bounded memory on large files); '
+                        'with --limit-teams, stop reading after the limit')
+    p.add_argument('--parse-workers', type=int, default=0,
+                   help='Parse TeamResult blocks in N worker processes (default 0 = serial)')
+    p.add_argument('--xml-backend', choices=['auto', *iofreader.BACKENDS], default=None,
+                   help='XML parser: lxml, etree (stdlib) or mmap (stdlib fed from a memory map); '
+                        'default auto = lxml when installed, or $IOF_XML_BACKEND')
+    p.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                   help=f'Directory for the parsed-timeline cache (default: {DEFAULT_CACHE_DIR})')
+    p.add_argument('--cache-max-mb', type=int, default=DEFAULT_CACHE_MAX_MB,
+                   help=f'Size limit of the cache directory; least recently used entries are evicted (default {DEFAULT_CACHE_MAX_MB})')
+    p.add_argument('--no-cache', action='store_true', default=False,
+                   help='Always re-parse the IOF XML; do not read or write the timeline cache or team index')
+    p.add_argument('--memory-budget', type=int, default=None, metavar='MB',
+                   help='Build the timeline out of core: stream the XML team by team and spill '
+                        'sorted runs to a temporary directory whenever MB of events are buffered '
+                        '(default: config memory_budget_mb, else everything in memory)')
     p.add_argument('-m','--finish-control', type=str, help='Control code for finish punch, will be renamed to maali_1')
     p.add_argument('--config', type=str, default=DEFAULT_CONFIG_PATH,
                    help=f'Config file path (default: {DEFAULT_CONFIG_PATH})')
@@ -1618,7 +5036,8 @@ def main():
     p.add_argument('--mass-starts', type=str, default=None,
                    help='Comma-separated ISO timestamps for mass starts, e.g. "2025-06-14T23:00:00+03:00,2025-06-15T09:30:00+03:00"')
     p.add_argument('--mass-start-time', type=str, default=None,
-                   help='Race start signal time (ISO). Defaults to earliest StartTime in XML.')
+                   help='Race start signal time (ISO). Defaults to earliest StartTime in XML. '
+                        'With several --iof files give one comma-separated time per file.')
     p.add_argument('--race', type=str, default=None, choices=['venla', 'jukola', 'auto'],
                    help='Race type for check-in staging (default: auto-detect from XML <Event><Name>)')
     p.add_argument('--navisport', type=str, default=None,
@@ -1636,11 +5055,64 @@ def main():
                         'Press y=send, n=skip, a=send all remaining, q=quit')
 
     args = p.parse_args()
+    if args.worker:
+        if args.iof or args.replay_timeline or args.coordinator:
+            p.error("--worker takes its timeline from the coordinator; drop --iof/--replay-timeline/--coordinator")
+    elif not args.iof and not args.replay_timeline:
+        p.error("--iof is required (or --replay-timeline)")
+    if (args.coordinator or args.worker) and (args.workers > 1 or args.follow or args.control_port
+                                              or args.debug_navisport):
+        p.error("--coordinator/--worker cannot be combined with --workers, --follow, "
+                "--control-port or --debug-navisport")
+    if args.iof and args.replay_timeline:
+        p.error("--replay-timeline replaces --iof; give only one of them")
+
+    if args.workers > 1 and (args.follow or args.control_port or args.debug_navisport):
+        p.error("--workers cannot be combined with --follow, --control-port or --debug-navisport")
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        p.error("--memory-budget must be a positive number of MB")
+    if (args.checkpoint or args.resume) and (args.workers > 1 or args.coordinator or args.worker
+                                             or args.follow or args.export_timeline):
+        p.error("--checkpoint/--resume cannot be combined with --workers, --coordinator, --worker, "
+                "--follow or --export-timeline")
+    if args.checkpoint_interval <= 0:
+        p.error("--checkpoint-interval must be positive")
+    if args.virtual_time and (args.workers > 1 or args.coordinator or args.worker or args.follow
+                              or args.checkpoint or args.resume or math.isinf(args.speed)):
+        p.error("--virtual-time cannot be combined with --workers, --coordinator, --worker, "
+                "--follow, --checkpoint, --resume or --speed max")
+    clock = None
+    if args.virtual_time:
+        try:
+            clock = VirtualClock(now_ms() if args.virtual_time == 'now' else iso_to_ms(args.virtual_time)[0])
+        except ValueError as e:
+            p.error(f"--virtual-time: {e}")
+
+    if args.xml_backend:
+        try:
+            iofreader.set_backend(args.xml_backend)
+        except ValueError as e:
+            print(e)
+            return
 
     # --- Load config (can be overridden by CLI flags below) ---
     login_config = load_config(args.config)
     if args.login_devices is not None:
         login_config['device_count'] = args.login_devices
+    speed_profile = args.speed_profile
+    if speed_profile is None and login_config.get('speed_profile'):
+        try:
+            speed_profile = parse_speed_profile(login_config['speed_profile'])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Invalid speed_profile in {args.config}: {e}")
+            return
+    memory_budget = args.memory_budget
+    if memory_budget is None and login_config.get('memory_budget_mb') and args.iof:
+        memory_budget = int(login_config['memory_budget_mb'])
+    if memory_budget and (args.follow or args.start_offset or args.parse_workers > 1):
+        print("--memory-budget builds the timeline team by team; it cannot be combined with "
+              "--follow, --start-offset or --parse-workers")
+        return
 
     # --- Create device lists ---
     global PURKU_DEVICES, ITKUMUURI_DEVICES
@@ -1675,33 +5147,18 @@ def main():
             print(f"Invalid --legs value: {e}")
             return
 
-    events = parse_iof3_events(args.iof, team_range=team_range,
-                               team_limit=args.limit_teams, leg_set=leg_set)
-    ws_info = "disabled (--no-ws)" if args.no_ws else f"{args.host}:{args.port}"
-    print(f"Parsed {len(events)} events. Speed={args.speed} WS={ws_info}")
-
-    # Detect race & mass start time
-    race = args.race or detect_race_from_xml(args.iof)
-    mass_start_signal = parse_mass_start_time(args.iof)
+    mass_start_overrides: List[Optional[datetime]] = [None] * len(args.iof)
     if args.mass_start_time:
+        values = [s.strip() for s in args.mass_start_time.split(',')]
+        if len(values) not in (1, len(args.iof)):
+            print(f"--mass-start-time needs 1 or {len(args.iof)} values, got {len(values)}")
+            return
         try:
-            mass_start_signal = datetime.fromisoformat(args.mass_start_time)
+            parsed = [datetime.fromisoformat(s) for s in values]
         except ValueError as e:
             print(f"Invalid --mass-start-time '{args.mass_start_time}': {e}")
             return
-    print(f"Race: {race}, mass start signal: {mass_start_signal.isoformat()}")
-
-    # Build bib map (runner_id → bib) from punch events
-    bib_map = {}
-    for ev in events:
-        rid = ev.get('runner_id')
-        bid = ev.get('team_id')
-        if rid and bid and rid not in bib_map:
-            try:
-                bib_map[rid] = int(bid)
-            except (ValueError, TypeError):
-                pass
-    print(f"Bib map: {len(bib_map)} runners")
+        mass_start_overrides = parsed * len(args.iof) if len(parsed) == 1 else parsed
 
     allowed_controls = asyncio.run(load_allowed_controls(args.controls_file, args.controls_url))
     if allowed_controls:
@@ -1719,18 +5176,204 @@ def main():
             return
         navisport_sender = NavisportSender(args.navisport, args.navisport_event_id,
                                            chip_base=args.navisport_chip_base,
-                                           debug=args.debug_navisport)
+                                           debug=args.debug_navisport, clock=clock)
+
+    # Everything a --workers process needs to set up its own sink
+    shard_opts = {
+        'host': args.host, 'port': args.port, 'one_conn_per_device': args.one_conn_per_device,
+        'allowed_controls': allowed_controls, 'finish_control': args.finish_control,
+        'no_ws': args.no_ws, 'navisport': args.navisport,
+        'navisport_event_id': args.navisport_event_id, 'navisport_chip_base': args.navisport_chip_base,
+        'speed': args.speed, 'tick_ms': args.tick_ms, 'speed_profile': speed_profile,
+    }
+
+    if args.worker:
+        asyncio.run(run_worker(args.worker, shard_opts))
+        return
+
+    # --- Checkpoint / resume ---
+    # Everything that shapes the timeline or the Navisport target; a resume
+    # must match the checkpointed run exactly.
+    checkpoint = None
+    resume_state = None
+    if args.checkpoint or args.resume:
+        try:
+            run_options = json.loads(json.dumps({
+                'iof': [input_signature(path) for path in args.iof],
+                'replay_timeline': input_signature(args.replay_timeline) if args.replay_timeline else None,
+                'team_range': args.team_range, 'limit_teams': args.limit_teams, 'legs': args.legs,
+                'start_offset': args.start_offset, 'finish_control': args.finish_control,
+                'login_only': args.login_only, 'mass_starts': args.mass_starts,
+                'mass_start_time': args.mass_start_time, 'race': args.race,
+                'bib_stride': args.bib_stride, 'memory_budget': memory_budget,
+                'purku_devices': args.purku_devices, 'itkumuuri_devices': args.itkumuuri_devices,
+                'config': login_config, 'compress_gaps': args.compress_gaps,
+                'speed_profile': speed_profile, 'navisport': args.navisport,
+                'navisport_event_id': args.navisport_event_id,
+                'navisport_chip_base': args.navisport_chip_base,
+            }))
+        except OSError as e:
+            print(f"Cannot read input file: {e}")
+            return
+        if args.resume:
+            try:
+                resume_state = load_run_state(args.resume)
+            except (OSError, ValueError) as e:
+                print(f"Cannot resume: {e}")
+                return
+            saved = resume_state['options']
+            changed = sorted(k for k in set(run_options) | set(saved) if run_options.get(k) != saved.get(k))
+            if changed:
+                print(f"Cannot resume: {args.resume} was written with different {', '.join(changed)} "
+                      f"(inputs and timeline options must be the same as in the checkpointed run)")
+                return
+            if resume_state['dispatch']['done']:
+                print(f"[checkpoint] {args.resume}: the run was complete, nothing left to send")
+                return
+            random.setstate(rng_state_from_json(resume_state['random']))
+            if navisport_sender and resume_state['navisport']:
+                navisport_sender.restore_state(resume_state['navisport'])
+            print(f"[checkpoint] resuming {args.resume}, saved {resume_state['saved']}")
+        checkpoint = RunCheckpoint(args.checkpoint or args.resume, run_options, random.getstate(),
+                                   args.checkpoint_interval)
+    resume = resume_state['dispatch'] if resume_state else None
+
+    if args.replay_timeline:
+        if not os.path.exists(args.replay_timeline):
+            print(f"Timeline file not found: {args.replay_timeline}")
+            return
+        try:
+            timeline = read_timeline(args.replay_timeline)
+        except ValueError as e:
+            print(e)
+            return
+        print(f"Replaying timeline {args.replay_timeline}. Speed={speed_label(args.speed)}")
+        if args.coordinator:
+            asyncio.run(run_coordinator(timeline, args.coordinator, args.expect_workers, args.speed,
+                                        args.tick_ms, speed_profile, args.compress_gaps))
+            return
+        if args.workers > 1:
+            run_sharded(timeline, args.workers, shard_opts, args.compress_gaps)
+            return
+        asyncio.run(run_simulator([], args.host, args.port, args.speed, args.one_conn_per_device,
+                                  allowed_controls, 0.0, args.finish_control,
+                                  navisport_sender=navisport_sender,
+                                  no_ws=args.no_ws,
+                                  tick_ms=args.tick_ms,
+                                  control_port=args.control_port,
+                                  compress_gaps=args.compress_gaps,
+                                  speed_profile=speed_profile,
+                                  timeline=timeline,
+                                  checkpoint=checkpoint,
+                                  resume=resume,
+                                  clock=clock))
+        return
+
+    if args.follow:
+        if len(args.iof) > 1:
+            print("--follow takes a single --iof file or snapshot directory")
+            return
+        sink = EventSink(args.host, args.port, args.one_conn_per_device, allowed_controls,
+                         args.finish_control, navisport_sender, args.no_ws)
+        follower = RaceFollower(team_range, leg_set, args.finish_control)
+        try:
+            asyncio.run(follow_iof(args.iof[0], sink, follower, args.follow_interval))
+        except KeyboardInterrupt:
+            print("[follow] stopped")
+        return
+
+    multi = len(args.iof) > 1
+    races: List[LoadedRace] = []
+    timeline = None
+    # --stream-parse --limit-teams stops at the limit; without --mass-start-time
+    # the mass start is then the earliest StartTime among the teams read
+    stop_at_limit = bool(args.stream_parse and args.limit_teams)
+    if stop_at_limit and None in mass_start_overrides:
+        print(f"[parse] reading stops after {args.limit_teams} teams; mass start signal taken from "
+              f"the teams read (set --mass-start-time to override)")
+    if memory_budget:
+        timeline = build_spilled_timeline(args.iof, memory_budget * 1024 * 1024,
+                                          team_range=team_range, team_limit=args.limit_teams,
+                                          leg_set=leg_set, finish_control=args.finish_control,
+                                          login_config=login_config, login_only=args.login_only,
+                                          race_type=args.race if args.race != 'auto' else None,
+                                          mass_start_overrides=mass_start_overrides,
+                                          mass_start_times=mass_start_times,
+                                          bib_stride=args.bib_stride,
+                                          stop_at_limit=stop_at_limit)
+        if timeline is None:
+            return
+    else:
+        for n, iof_path in enumerate(args.iof):
+            label = f"[{os.path.basename(iof_path)}] " if multi else ''
+            # Single pass: events, race type, earliest StartTime and bib map
+            loaded = load_iof_race_cached(iof_path, team_range=team_range,
+                                          team_limit=args.limit_teams, leg_set=leg_set,
+                                          stream=args.stream_parse,
+                                          full_scan=mass_start_overrides[n] is None and not stop_at_limit,
+                                          workers=args.parse_workers,
+                                          cache_dir=None if args.no_cache else args.cache_dir,
+                                          max_bytes=args.cache_max_mb * 1024 * 1024)
+            print(f"{label}Teams in XML: {loaded.teams_seen}")
+            msg = f"{label}Teams included: {loaded.teams_included}"
+            if args.limit_teams:
+                msg += f" (limited to first {args.limit_teams})"
+            print(msg)
+            ws_info = "disabled (--no-ws)" if args.no_ws else f"{args.host}:{args.port}"
+            print(f"{label}Parsed {len(loaded.events)} events. Speed={speed_label(args.speed)} WS={ws_info}")
+            if loaded.class_names:
+                print(f"{label}Classes: {', '.join(loaded.class_names)} — {loaded.leg_count} leg(s)")
+
+            # Race & mass start time
+            if args.race and args.race != 'auto':
+                loaded.race = args.race
+            loaded.start_signal = mass_start_overrides[n]
+            print(f"{label}Race: {loaded.race}, mass start signal: {loaded.mass_start_signal.isoformat()}")
+            print(f"{label}Bib map: {len(loaded.bib_map)} runners")
+            if multi:
+                loaded.apply_namespace(f"{n + 1}/", n * args.bib_stride)
+                print(f"{label}Runner ids prefixed '{n + 1}/', bibs shifted by {n * args.bib_stride}")
+            races.append(loaded)
+
+    if args.export_timeline or args.workers > 1 or args.coordinator:
+        if timeline is None:
+            timeline = build_timeline(races if multi else races[0], args.start_offset, args.finish_control,
+                                      mass_start_times=mass_start_times,
+                                      race=races[0].race,
+                                      mass_start_signal=races[0].mass_start_signal if not multi else None,
+                                      login_config=login_config,
+                                      login_only=args.login_only)
+        if timeline is None:
+            return
+        if args.export_timeline:
+            n = write_timeline(args.export_timeline, timeline)
+            print(f"Timeline written: {n} events → {args.export_timeline} "
+                  f"({os.path.getsize(args.export_timeline) / 1e6:.1f} MB)")
+        elif args.coordinator:
+            asyncio.run(run_coordinator(timeline, args.coordinator, args.expect_workers, args.speed,
+                                        args.tick_ms, speed_profile, args.compress_gaps))
+        else:
+            run_sharded(timeline, args.workers, shard_opts, args.compress_gaps)
+        return
 
-    asyncio.run(run_simulator(events, args.host, args.port,
+    asyncio.run(run_simulator(races if multi or not races else races[0], args.host, args.port,
                               args.speed, args.one_conn_per_device,
                               allowed_controls, args.start_offset, args.finish_control,
                               mass_start_times=mass_start_times,
                               navisport_sender=navisport_sender,
-                              race=race, bib_map=bib_map,
-                              mass_start_signal=mass_start_signal,
+                              race=races[0].race if races else 'venla',
+                              mass_start_signal=races[0].mass_start_signal if len(races) == 1 else None,
                               login_config=login_config,
                               login_only=args.login_only,
-                              no_ws=args.no_ws))
+                              no_ws=args.no_ws,
+                              tick_ms=args.tick_ms,
+                              control_port=args.control_port,
+                              compress_gaps=args.compress_gaps,
+                              speed_profile=speed_profile,
+                              timeline=timeline,
+                              checkpoint=checkpoint,
+                              resume=resume,
+                              clock=clock))
 
 if __name__ == '__main__':
     main()
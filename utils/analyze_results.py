@@ -10,10 +10,15 @@ Usage:
 import argparse
 import json
 import math
+import os
 import statistics
-import xml.etree.ElementTree as ET
+import sys
 from collections import defaultdict
 
+# iofreader.py lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import iofreader
+
 
 def infer_leg_from_course_name(name):
     if not name or len(name) < 4:
@@ -24,8 +29,7 @@ def infer_leg_from_course_name(name):
 
 
 def parse_resultlist(iof_path):
-    tree = ET.parse(iof_path)
-    root = tree.getroot()
+    root = iofreader.parse(iof_path)
     ns_uri = root.tag.split('}')[0].strip('{') if '}' in root.tag else None
     ns = {'iof': ns_uri} if ns_uri else None
 
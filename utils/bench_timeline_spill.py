@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Peak memory of the timeline build, in memory vs. spilled to disk.
+
+Scaled copies of an IOF-XML file are written to a temporary directory (the
+TeamResults repeated with new bib numbers until --teams is reached).  For
+every size the full timeline is built and read to the end twice, each in a
+fresh process: once the normal way (whole race in memory) and once with
+--memory-budget (sorted runs on disk, k-way merged).  Wall time and peak
+RSS of each process are reported.
+
+Usage:
+    python utils/bench_timeline_spill.py --iof data/results_j2025_ju_iof_fixed.xml
+    python utils/bench_timeline_spill.py --iof data/results_j2025_ju_iof_fixed.xml \\
+        --teams 2000,8000,32000,64000 --memory-budget 64
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# simulator.py lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_TEAM_RE = re.compile(rb'<TeamResult[\s>].*?</TeamResult>', re.S)
+_BIB_RE = re.compile(rb'<BibNumber>[^<]*</BibNumber>')
+_ID_RE = re.compile(rb'<Id>([^<]*)</Id>')
+
+
+def scaled_copy(src, teams, path):
+    """Write ``src`` with its TeamResults repeated (new bibs) to ``teams`` teams."""
+    with open(src, 'rb') as f:
+        doc = f.read()
+    blocks = [m.span() for m in _TEAM_RE.finditer(doc)]
+    if not blocks:
+        raise SystemExit(f"{src}: no TeamResult elements")
+    head, tail = doc[:blocks[0][0]], doc[blocks[-1][1]:]
+    with open(path, 'wb') as out:
+        out.write(head)
+        for n in range(teams):
+            start, end = blocks[n % len(blocks)]
+            block = _BIB_RE.sub(b'<BibNumber>%d</BibNumber>' % (n + 1), doc[start:end], count=1)
+            copy = n // len(blocks)
+            if copy:
+                block = _ID_RE.sub(lambda m: b'<Id>%s-%d</Id>' % (m.group(1), copy), block)
+            out.write(block + b'\n')
+        out.write(tail)
+
+
+def child(mode, path, budget_mb):
+    import random
+    import simulator
+    random.seed(1)
+    config = simulator.load_config('/nonexistent')
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == 'memory':
+            race = simulator.load_iof_race(path, stream=True)
+            timeline = simulator.build_timeline(race, 0.0, login_config=config,
+                                                mass_start_signal=race.mass_start_signal)
+        else:
+            timeline = simulator.build_spilled_timeline([path], budget_mb * 1024 * 1024,
+                                                        login_config=config)
+        items = sum(1 for _ in timeline)
+    dt = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024   # KiB on Linux
+    print(f"{items} {dt:.1f} {peak:.0f}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark in-memory vs. spilled timeline builds")
+    p.add_argument('--iof', required=True, help='IOF-XML file used as the team template')
+    p.add_argument('--teams', default='2000,8000,32000',
+                   help='comma-separated team counts (default 2000,8000,32000)')
+    p.add_argument('--memory-budget', type=int, default=64, help='spill budget in MB (default 64)')
+    p.add_argument('--modes', default='memory,spill', help='memory, spill or both (default both)')
+    p.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], int(args.child[2]))
+        return
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    print(f"\n  {'teams':>7}{'XML MB':>9}{'items':>11}  {'mode':<14}{'time s':>8}{'peak RSS MB':>13}")
+    print("  " + "-" * 60)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for teams in (int(t) for t in args.teams.split(',')):
+            path = os.path.join(tmpdir, f"teams-{teams}.xml")
+            scaled_copy(args.iof, teams, path)
+            size = os.path.getsize(path) / 1e6
+            for mode in modes:
+                label = mode if mode == 'memory' else f"spill {args.memory_budget} MB"
+                res = subprocess.run([sys.executable, os.path.abspath(__file__), '--iof', args.iof,
+                                      '--child', mode, path, str(args.memory_budget)],
+                                     capture_output=True, text=True)
+                if res.returncode:
+                    print(f"  {teams:>7}{size:>9.0f}{'':>11}  {label:<14}  failed: "
+                          f"{res.stderr.strip().splitlines()[-1:]}")
+                    continue
+                items, secs, peak = res.stdout.split()
+                print(f"  {teams:>7}{size:>9.0f}{int(items):>11}  {label:<14}{float(secs):>8.1f}{float(peak):>13.0f}")
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
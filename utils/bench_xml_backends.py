@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Time the iofreader XML backends on one IOF-XML file.
+
+Every available backend (etree, lxml, mmap) is timed for a full parse() and
+for a streaming iterparse() walk, on the plain file and on gzip / zstd copies
+written to a temporary directory (zstd only when the zstandard package is
+installed).  Best of --repeat runs is reported.
+
+Usage:
+    python utils/bench_xml_backends.py --iof data/results_j2025_ju_iof_fixed.xml
+    python utils/bench_xml_backends.py --iof data/results_j2025_ju_iof_fixed.xml --repeat 5
+"""
+import argparse
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# iofreader.py lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import iofreader
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def walk(path, backend):
+    # Same pattern as the simulator's streaming reader: drop elements once seen
+    stack = []
+    for action, elem in iofreader.iterparse(path, ('start', 'end'), backend):
+        if action == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if len(stack) == 2:
+            elem.clear()
+
+
+def compressed_copies(src, tmpdir):
+    variants = [('xml', src)]
+    gz = os.path.join(tmpdir, os.path.basename(src) + '.gz')
+    with open(src, 'rb') as fin, gzip.open(gz, 'wb', compresslevel=6) as fout:
+        shutil.copyfileobj(fin, fout)
+    variants.append(('xml.gz', gz))
+    try:
+        import zstandard
+    except ImportError:
+        print("  (zstandard not installed — skipping .xml.zst)")
+        return variants
+    zst = os.path.join(tmpdir, os.path.basename(src) + '.zst')
+    with open(src, 'rb') as fin, open(zst, 'wb') as fout:
+        zstandard.ZstdCompressor(level=3).copy_stream(fin, fout)
+    variants.append(('xml.zst', zst))
+    return variants
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark iofreader XML backends")
+    p.add_argument('--iof', required=True, help='IOF-XML file (uncompressed)')
+    p.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported (default 3)')
+    args = p.parse_args()
+
+    backends = iofreader.available_backends()
+    print(f"  {args.iof}: {os.path.getsize(args.iof) / 1e6:.1f} MB, backends: {', '.join(backends)}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        variants = compressed_copies(args.iof, tmpdir)
+        print(f"\n  {'file':<9}{'size MB':>9}  {'backend':<8}{'parse s':>9}{'iterparse s':>13}")
+        print("  " + "-" * 48)
+        for label, path in variants:
+            size = os.path.getsize(path) / 1e6
+            for backend in backends:
+                t_parse = best_of(args.repeat, lambda: iofreader.parse(path, backend))
+                t_iter = best_of(args.repeat, lambda: walk(path, backend))
+                print(f"  {label:<9}{size:>9.1f}  {backend:<8}{t_parse:>9.3f}{t_iter:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
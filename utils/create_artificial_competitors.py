@@ -19,12 +19,17 @@ Usage:
 import argparse
 import math
 import random
+import os
 import statistics
 import sys
 import xml.etree.ElementTree as ET
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 
+# iofreader.py lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import iofreader
+
 IOF_NS = "http://www.orienteering.org/datastandard/3.0"
 
 FI_CLUBS = [
@@ -94,8 +99,7 @@ def infer_leg_from_course_name(name):
 
 def parse_coursedata(courses_path):
     """Parse CourseData XML, return dict: leg -> {course_name -> {controls: [...], lengths: [...]}}"""
-    tree = ET.parse(courses_path)
-    root = tree.getroot()
+    root = iofreader.parse(courses_path)
     ns_uri = root.tag.split('}')[0].strip('{') if '}' in root.tag else IOF_NS
     ns = {'iof': ns_uri}
 
@@ -148,8 +152,7 @@ def parse_coursedata(courses_path):
 
 def analyze_ref_results(ref_path):
     """Parse a reference ResultList and return per-leg speed distributions."""
-    tree = ET.parse(ref_path)
-    root = tree.getroot()
+    root = iofreader.parse(ref_path)
     ns_uri = root.tag.split('}')[0].strip('{') if '}' in root.tag else IOF_NS
     ns = {'iof': ns_uri}
 
@@ -578,7 +581,7 @@ def main():
     n_legs_available = max(courses_by_leg.keys())
     course_names = [sorted(courses_by_leg[leg].keys()) for leg in sorted(courses_by_leg.keys())]
     flat_names = [n for names in course_names for n in names]
-    class_name_el = ET.parse(args.courses).getroot()
+    class_name_el = iofreader.parse(args.courses)
     cf_els = class_name_el.findall('.//{http://www.orienteering.org/datastandard/3.0}CourseFamily')
     class_name = cf_els[0].text if cf_els else "Jukolan Viesti"
 
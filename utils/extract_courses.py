@@ -1,8 +1,14 @@
 import math
+import os
 import re
+import sys
 import xml.etree.ElementTree as ET
 from datetime import datetime
 
+# iofreader.py lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import iofreader
+
 def infer_leg_from_course_name(name):
     """
     Päätellään osuuden numero kurssin nimen perusteella.
@@ -96,8 +102,7 @@ def parse_radat(radat_path):
 
 
 def resultlist_to_coursedata(iof_in, courses_out, radat_file=None, georef=None, img_w=2324, img_h=3220):
-    tree = ET.parse(iof_in)
-    root = tree.getroot()
+    root = iofreader.parse(iof_in)
     ns_uri = root.tag.split('}')[0].strip('{')
     ns = {"iof": ns_uri}
 
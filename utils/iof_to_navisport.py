@@ -1,10 +1,14 @@
 import csv
-import xml.etree.ElementTree as ET
 import argparse
+import os
+import sys
+
+# iofreader.py lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import iofreader
 
 def iof_to_navisport(iof_path, out_csv, max_legs=None):
-    tree = ET.parse(iof_path)
-    root = tree.getroot()
+    root = iofreader.parse(iof_path)
     ns = {'iof': root.tag.split('}')[0].strip('{')}  # IOF namespace
 
     rows = []